@@ -0,0 +1,184 @@
+# controlo de admissão dos pedidos (antes de qualquer leitura do corpo)
+#
+# 1. classes de prioridade: nº máximo de pedidos em simultâneo por classe
+#    ("ingestao", "leitura", "configuracao"); a ingestão nunca ocupa os
+#    últimos lugares, que ficam reservados para o dashboard e as
+#    configurações (503 com Retry-After quando não há lugar). o lugar só
+#    é libertado quando a resposta acaba de ser enviada (inclusive stream)
+# 2. limite por cliente na ingestão: "baldes de tokens" (taxa por segundo
+#    + rajada); um gateway preso num ciclo de reenvios recebe 429 com
+#    Retry-After em vez de ocupar os workers. o balde é o do endereço IP;
+#    o header X-Estufa-Id só separa os gateways atrás do mesmo endereço
+#    (cada um com a taxa normal, o endereço com ADMISSAO_GATEWAYS_POR_IP
+#    vezes mais), por isso um header inventado não gasta o balde de outro
+#    cliente nem ultrapassa o limite do próprio endereço
+#
+# o estado dos baldes fica em memória (MemoriaBaldes); outro backend (ex:
+# partilhado entre processos ou nós) só precisa dos mesmos métodos
+# consumir() e devolver()
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import request, g, abort
+from backend.config.settings import (ADMISSAO_TAXA_INGESTAO, ADMISSAO_RAJADA_INGESTAO,
+                                     ADMISSAO_LIMITES_CLASSE, ADMISSAO_RETRY_OCUPADO,
+                                     ADMISSAO_MAX_CLIENTES, ADMISSAO_GATEWAYS_POR_IP,
+                                     ADMISSAO_INTERVALO_LOG)
+
+
+class MemoriaBaldes:
+    # baldes de tokens em memória, um por cliente
+    # os clientes menos recentes são esquecidos acima de 'max_clientes'
+    # (voltam com o balde cheio)
+
+    def __init__(self, max_clientes=ADMISSAO_MAX_CLIENTES):
+        self.max_clientes = max_clientes
+        self._lock = threading.Lock()
+        self._baldes = OrderedDict()  # cliente -> (tokens, instante)
+
+    def consumir(self, cliente, taxa, rajada, custo=1.0):
+        # retira 'custo' tokens do balde do cliente; devolve 0 se o pedido
+        # foi aceite ou os segundos até haver tokens suficientes
+        agora = time.monotonic()
+        with self._lock:
+            tokens, instante = self._baldes.pop(cliente, (rajada, agora))
+            tokens = min(rajada, tokens + (agora - instante) * taxa)
+            espera = 0.0
+            if tokens >= custo:
+                tokens -= custo
+            else:
+                espera = (custo - tokens) / taxa
+            self._baldes[cliente] = (tokens, agora)
+            while len(self._baldes) > self.max_clientes:
+                self._baldes.popitem(last=False)
+            return espera
+
+    def devolver(self, cliente, rajada, custo=1.0):
+        # repõe tokens consumidos por um pedido que acabou recusado por outro limite
+        with self._lock:
+            if cliente in self._baldes:
+                tokens, instante = self._baldes[cliente]
+                self._baldes[cliente] = (min(rajada, tokens + custo), instante)
+
+
+class ClassesPrioridade:
+    # lugares ocupados por pedidos em curso, com um limite por classe
+    # (todas as classes partilham o mesmo total: o maior dos limites)
+
+    def __init__(self, limites):
+        self.limites = dict(limites)
+        self._lock = threading.Lock()
+        self._em_curso = 0
+
+    def entrar(self, classe):
+        with self._lock:
+            if self._em_curso >= self.limites[classe]:
+                return False
+            self._em_curso += 1
+            return True
+
+    def sair(self):
+        with self._lock:
+            self._em_curso -= 1
+
+
+class LogLimitado:
+    # no máximo uma linha a cada 'intervalo' segundos (as outras só são
+    # contadas): um cliente em ciclo de reenvios não enche o log
+
+    def __init__(self, intervalo=ADMISSAO_INTERVALO_LOG):
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self._ultimo = None
+        self._omitidas = 0
+
+    def registar(self, mensagem):
+        agora = time.monotonic()
+        with self._lock:
+            if self._ultimo is not None and agora - self._ultimo < self.intervalo:
+                self._omitidas += 1
+                return
+            omitidas, self._omitidas, self._ultimo = self._omitidas, 0, agora
+        print(f"Log: {mensagem}" + (f" (+{omitidas} omitidos)" if omitidas else ""))
+
+
+def classe_do_pedido():
+    if request.path == "/api/leituras" and request.method == "POST":
+        return "ingestao"
+    if request.path.startswith("/api/configuracoes"):
+        return "configuracao"
+    return "leitura"
+
+
+def cliente_do_pedido():
+    # (endereço, gateway ou None)
+    return request.remote_addr or "desconhecido", request.headers.get("X-Estufa-Id") or None
+
+
+def _limitar_ingestao(baldes, taxa, rajada):
+    # segundos até o cliente poder voltar a enviar (0 se foi aceite) e a
+    # descrição do cliente limitado
+    endereco, gateway = cliente_do_pedido()
+    if gateway is not None:
+        espera = baldes.consumir((endereco, gateway), taxa, rajada)
+        if espera:
+            return espera, gateway
+    vezes = ADMISSAO_GATEWAYS_POR_IP if gateway is not None else 1
+    espera = baldes.consumir(endereco, taxa * vezes, rajada * vezes)
+    if espera and gateway is not None:
+        baldes.devolver((endereco, gateway), rajada)
+    return espera, endereco
+
+
+def registar(app, baldes=None):
+    # taxa (None desliga o limite por cliente), rajada e limites por
+    # classe podem ser mudados no app.config; o backend dos baldes fica
+    # em app.extensions["admissao"]
+    app.config.setdefault("ADMISSAO_TAXA_INGESTAO", ADMISSAO_TAXA_INGESTAO)
+    app.config.setdefault("ADMISSAO_RAJADA_INGESTAO", ADMISSAO_RAJADA_INGESTAO)
+    app.config.setdefault("ADMISSAO_LIMITES_CLASSE", ADMISSAO_LIMITES_CLASSE)
+    app.extensions["admissao"] = baldes or MemoriaBaldes()
+    classes = ClassesPrioridade(app.config["ADMISSAO_LIMITES_CLASSE"])
+    log_429, log_503 = LogLimitado(), LogLimitado()
+
+    @app.before_request
+    def admitir_pedido():
+        if request.method == "OPTIONS":
+            return None  # preflight do CORS
+        classe = classe_do_pedido()
+
+        # primeiro o lugar: um pedido recusado por falta de lugar não gasta tokens
+        classes.limites = app.config["ADMISSAO_LIMITES_CLASSE"]
+        if not classes.entrar(classe):
+            log_503.registar(f"Sem lugar para um pedido de {classe}.")
+            abort(503, description="Servidor ocupado, tente novamente.", retry_after=ADMISSAO_RETRY_OCUPADO)
+        g.admissao_classe = classe
+
+        taxa = app.config["ADMISSAO_TAXA_INGESTAO"]
+        if classe == "ingestao" and taxa:
+            espera, cliente = _limitar_ingestao(app.extensions["admissao"], taxa,
+                                                app.config["ADMISSAO_RAJADA_INGESTAO"])
+            if espera:
+                log_429.registar(f"Ingestão de {cliente} limitada (tente daqui a {espera:.1f} s).")
+                abort(429, description=f"Demasiadas leituras enviadas por {cliente}.",
+                      retry_after=math.ceil(espera))
+
+    @app.after_request
+    def libertar_lugar_no_fim(response):
+        # uma resposta já pronta liberta o lugar aqui; um stream só o liberta
+        # quando for todo enviado (quando o servidor fecha a resposta)
+        # (registado antes da compressão, por isso corre depois dela)
+        if g.pop("admissao_classe", None) is not None:
+            if response.is_streamed:
+                response.call_on_close(classes.sair)
+            else:
+                classes.sair()
+        return response
+
+    @app.teardown_request
+    def libertar_lugar(_erro):
+        # pedido que terminou sem resposta (exceção propagada)
+        if g.pop("admissao_classe", None) is not None:
+            classes.sair()
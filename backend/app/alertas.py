@@ -0,0 +1,457 @@
+# alertas do histórico (GET /api/alertas) e reavaliação em segundo plano
+#
+# o GET /api/alertas serve sempre um ConjuntoAlertas completo, marcado com a
+# versão das regras que o gerou. quando as regras mudam (PUT/reset das
+# configurações) um TrabalhoReavaliacao percorre os ficheiros em lotes numa
+# thread, guardando um checkpoint a cada lote; só quando termina é que o
+# novo conjunto substitui o anterior (troca atómica, feita pelo service)
+
+import itertools
+import json
+import math
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from .motor_regras import LoteLeituras, AvaliadorIncremental, data_hora_para_epoch, faixa_ideal
+from .vista_memoria import VistaMemoria
+
+# identifica cada "geração" das posições de um ConjuntoAlertas (os cursores
+# de paginação só valem para a geração em que foram emitidos)
+_GERACOES = itertools.count(1)
+
+
+class CursorInvalido(ValueError):
+    pass
+
+
+def _montar_lote(documentos, tabela_regras):
+    lote = LoteLeituras()
+    for documento in documentos:
+        lote.adicionar_documento(documento, tabela_regras, documento.get("ficheiro"))
+    return lote
+
+
+def _alerta(lote, indice, motivo=None):
+    # alerta da leitura 'indice' do lote (sem motivo: base de uma leitura
+    # com regras com estado, ainda por avaliar)
+    codigo = int(lote.codigos()[indice])
+    estufa_id, sensor_id = lote.chaves[indice]
+    leitura_id, ficheiro_xml = lote.metadados[indice]
+    alerta = {
+        "estufa_id": estufa_id,
+        "leitura_id": leitura_id,
+        "sensor_id": sensor_id,
+        "tipo": lote.tipos[codigo],
+        "valor_lido": float(lote.valores()[indice]),
+        "faixa_ideal": faixa_ideal(lote.regras[codigo]),
+        "dataHora": lote.datas_hora[indice],
+        "ficheiro_origem": ficheiro_xml
+    }
+    if motivo is not None:
+        alerta["motivo"] = motivo
+    return alerta
+
+
+def avaliar_documentos(documentos, tabela_regras, avaliador):
+    # avalia um lote de documentos extraídos e devolve os alertas
+    lote = _montar_lote(documentos, tabela_regras)
+    # Se estiver FORA da faixa, adiciona ao alerta
+    return [_alerta(lote, indice, motivo) for indice, motivo in lote.avaliar_com_estado(avaliador)]
+
+
+def separar_documentos(documentos, tabela_regras):
+    # para a reavaliação: alertas das regras sem estado (já definitivos) e
+    # leituras das regras com estado como [instante, alerta base, regra];
+    # estas só são avaliadas no fim, todas juntas (ver avaliar_pendentes)
+    lote = _montar_lote(documentos, tabela_regras)
+    estaticos = [_alerta(lote, int(indice), "faixa") for indice in lote.avaliar()]
+    codigos = lote.codigos()
+    pendentes = [[data_hora_para_epoch(lote.datas_hora[indice]), _alerta(lote, int(indice)),
+                  lote.regras[codigos[indice]]]
+                 for indice in lote.indices_incrementais()]
+    return estaticos, pendentes
+
+
+def avaliar_pendentes(pendentes):
+    # avalia as leituras com estado de todo o histórico por ordem temporal
+    # de cada sensor (empates pela ordem de chegada), por isso o resultado
+    # não depende da ordem dos ficheiros nem do tamanho dos lotes
+    # devolve (alertas, avaliador com o estado final de cada sensor)
+    avaliador = AvaliadorIncremental()
+    alertas = []
+    ordem = sorted(pendentes, key=lambda p: (p[1]["estufa_id"], p[1]["sensor_id"], p[0]))
+    for instante, base, regra in ordem:
+        chave = (base["estufa_id"], base["sensor_id"])
+        for motivo in avaliador.avaliar(chave, regra, instante, base["valor_lido"]):
+            alertas.append(dict(base, motivo=motivo))
+    return alertas, avaliador
+
+
+class ConjuntoAlertas(VistaMemoria):
+    # todos os alertas do histórico avaliados com UMA versão das regras
+    # novas leituras são acrescentadas com essas mesmas regras
+    #
+    # índices secundários para as consultas (filtros, ordem, paginação):
+    # por estufa, por tipo e global, cada um com a lista de entradas
+    # (instante, posição) ordenada no tempo; uma consulta faz bisect no
+    # índice mais seletivo e só percorre as entradas do intervalo pedido
+
+    def __init__(self, versao, tabela_regras, alertas=None, avaliador=None,
+                 assinatura=None, ficheiros=()):
+        self.versao = versao
+        self.tabela_regras = tabela_regras
+        super().__init__()
+        for alerta in alertas or []:
+            self._acrescentar(alerta)
+        self.avaliador = avaliador or AvaliadorIncremental()
+        self.assinatura = assinatura
+        self._ficheiros.update(ficheiros)
+
+    def _limpar(self):
+        self.alertas = []
+        self.avaliador = AvaliadorIncremental()
+        self.geracao = next(_GERACOES)
+        self._global = []
+        self._por_estufa = {}
+        self._por_tipo = {}
+
+    def _acrescentar(self, alerta):
+        entrada = (data_hora_para_epoch(alerta["dataHora"]), len(self.alertas))
+        self.alertas.append(alerta)
+        for entradas in (self._global,
+                         self._por_estufa.setdefault(alerta["estufa_id"], []),
+                         self._por_tipo.setdefault(alerta["tipo"], [])):
+            # quase sempre chega em ordem: append; senão, insere no sítio
+            if not entradas or entradas[-1] <= entrada:
+                entradas.append(entrada)
+            else:
+                insort(entradas, entrada)
+
+    def _adicionar_documento(self, documento):
+        for alerta in avaliar_documentos([documento], self.tabela_regras, self.avaliador):
+            self._acrescentar(alerta)
+
+    def sem_ficheiros(self, ficheiros):
+        # cópia sem os alertas dos ficheiros indicados (excluídos), para
+        # continuar a servir enquanto o histórico é reavaliado; fica
+        # desatualizada (sem assinatura) e com o estado das regras tal como estava
+        excluir = set(ficheiros)
+        with self._lock:
+            return ConjuntoAlertas(self.versao, self.tabela_regras,
+                                   [a for a in self.alertas if a["ficheiro_origem"] not in excluir],
+                                   self.avaliador, None, self._ficheiros - excluir)
+
+    def listar(self):
+        with self._lock:
+            return list(self.alertas)
+
+    def sensores_em_alerta(self):
+        # (estufa_id, sensor_id) -> em alerta pela faixa com estado
+        # (histerese/duração), tal como o avaliador destes alertas o deixou
+        with self._lock:
+            return {chave: estado.em_alerta for chave, estado in self.avaliador.estados.items()}
+
+    def _intervalo(self, estufa_id, tipo, desde, ate):
+        # escolhe o índice e devolve (entradas, início, fim) do intervalo
+        if estufa_id is not None:
+            entradas = self._por_estufa.get(estufa_id, [])
+        elif tipo is not None:
+            entradas = self._por_tipo.get(tipo, [])
+        else:
+            entradas = self._global
+        return (entradas, *_limites(entradas, desde, ate))
+
+    def _filtra(self, alerta, estufa_id, tipo, sensor_id, ficheiros=None):
+        # filtros que o índice escolhido não cobre
+        return ((estufa_id is None or alerta["estufa_id"] == estufa_id)
+                and (tipo is None or alerta["tipo"] == tipo)
+                and (sensor_id is None or alerta["sensor_id"] == sensor_id)
+                and (ficheiros is None or alerta["ficheiro_origem"] in ficheiros))
+
+    def consultar(self, estufa_id=None, tipo=None, sensor_id=None, desde=None, ate=None,
+                  ordem="asc", limite=None, cursor=None, ficheiros=None):
+        # alertas ordenados por dataHora (instantes em segundos epoch)
+        # 'ficheiros' limita aos alertas desses ficheiros (snapshot antigo)
+        # devolve (alertas, cursor da página seguinte ou None)
+        with self._lock:
+            entradas, inicio, fim = self._intervalo(estufa_id, tipo, desde, ate)
+            if cursor is not None:
+                geracao, ultima = _ler_cursor(cursor)
+                if geracao != self.geracao:
+                    raise CursorInvalido("cursor expirado (os alertas foram recalculados)")
+                if ordem == "asc":
+                    inicio = max(inicio, bisect_right(entradas, ultima))
+                else:
+                    fim = min(fim, bisect_left(entradas, ultima))
+
+            indices = range(inicio, fim) if ordem == "asc" else range(fim - 1, inicio - 1, -1)
+            resultado, ultima = [], None
+            for indice in indices:
+                alerta = self.alertas[entradas[indice][1]]
+                if not self._filtra(alerta, estufa_id, tipo, sensor_id, ficheiros):
+                    continue
+                resultado.append(alerta)
+                if limite is not None and len(resultado) == limite:
+                    ultima = entradas[indice]
+                    break
+
+            proximo = f"{self.geracao}:{ultima[0]!r}:{ultima[1]}" if ultima else None
+            return resultado, proximo
+
+    def contar(self, agrupar=None, estufa_id=None, tipo=None, sensor_id=None, desde=None, ate=None,
+               ficheiros=None):
+        # contagem (total e, opcionalmente, por "tipo" ou "estufa")
+        # sempre que o índice basta, cada grupo custa só um bisect
+        with self._lock:
+            outro_filtro = estufa_id if agrupar == "tipo" else tipo
+            so_indices = sensor_id is None and ficheiros is None
+            if agrupar in ("tipo", "estufa") and so_indices and outro_filtro is None:
+                indice = self._por_tipo if agrupar == "tipo" else self._por_estufa
+                filtro = tipo if agrupar == "tipo" else estufa_id
+                contagem = {}
+                for chave, entradas in indice.items():
+                    if filtro is None or chave == filtro:
+                        inicio, fim = _limites(entradas, desde, ate)
+                        if fim > inicio:
+                            contagem[chave] = fim - inicio
+
+            elif agrupar is None and so_indices and (estufa_id is None or tipo is None):
+                _, inicio, fim = self._intervalo(estufa_id, tipo, desde, ate)
+                return {"total": fim - inicio}
+
+            else:
+                # filtros combinados: percorre só o intervalo do índice escolhido
+                campo = {"tipo": "tipo", "estufa": "estufa_id"}.get(agrupar)
+                entradas, inicio, fim = self._intervalo(estufa_id, tipo, desde, ate)
+                contagem = Counter()
+                for _, posicao in entradas[inicio:fim]:
+                    alerta = self.alertas[posicao]
+                    if self._filtra(alerta, estufa_id, tipo, sensor_id, ficheiros):
+                        contagem[alerta[campo] if campo else None] += 1
+
+            total = sum(contagem.values())
+            if agrupar is None:
+                return {"total": total}
+            return {"total": total, f"por_{agrupar}": dict(sorted(contagem.items()))}
+
+
+def _limites(entradas, desde, ate):
+    # posições [início, fim) das entradas com desde <= instante <= ate
+    inicio = bisect_left(entradas, (desde, -1)) if desde is not None else 0
+    fim = bisect_right(entradas, (ate, math.inf)) if ate is not None else len(entradas)
+    return inicio, fim
+
+
+def _ler_cursor(cursor):
+    # "geração:instante:posição" (emitido pelo ConjuntoAlertas.consultar)
+    try:
+        geracao, instante, posicao = cursor.split(":")
+        return int(geracao), (float(instante), int(posicao))
+    except ValueError:
+        raise CursorInvalido("cursor inválido")
+
+
+class TrabalhoReavaliacao:
+    # reavalia todos os ficheiros com uma versão das regras, em lotes
+    # carregar_documento(nome) devolve o documento extraído (ou None)
+    # ao_concluir(trabalho) é chamado quando não há mais ficheiros e
+    # devolve False se entretanto chegaram ficheiros novos
+
+    def __init__(self, versao, tabela_regras, ficheiros, assinatura, carregar_documento,
+                 caminho_checkpoint=None, tamanho_lote=200):
+        self.versao = versao
+        self.tabela_regras = tabela_regras
+        self.ficheiros = list(ficheiros)
+        self.assinatura = assinatura
+        self.carregar_documento = carregar_documento
+        self.caminho_checkpoint = caminho_checkpoint
+        self.tamanho_lote = tamanho_lote
+        self.processados = 0
+        self._ficheiros_gravados = 0  # quantos nomes já estão no checkpoint
+        self.alertas = []    # alertas das regras sem estado
+        self.pendentes = []  # leituras das regras com estado (ver separar_documentos)
+        self.alertas_com_estado = []
+        self.avaliador = AvaliadorIncremental()
+        self.estado = "pendente"
+        self.erro = None
+        self.iniciado_em = None
+        self.concluido_em = None
+        self.ao_concluir = None
+        self.retomado = False
+        self._cancelado = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    # --- checkpoint (JSON lines: cabeçalho + uma linha por lote) ---
+
+    def _iniciar_checkpoint(self):
+        if not self.caminho_checkpoint:
+            return
+        with self._lock:
+            cabecalho = {"versao": self.versao, "ficheiros": list(self.ficheiros)}
+            self._ficheiros_gravados = len(self.ficheiros)
+        with open(self.caminho_checkpoint, "w", encoding="utf-8") as f:
+            f.write(json.dumps(cabecalho) + "\n")
+
+    def _gravar_checkpoint(self, alertas_do_lote, pendentes_do_lote=()):
+        # cada linha só leva o que mudou: ficheiros novos na fila, alertas
+        # e leituras com estado do lote
+        if not self.caminho_checkpoint or self._cancelado.is_set():
+            return
+        with self._lock:
+            novos = self.ficheiros[self._ficheiros_gravados:]
+            self._ficheiros_gravados = len(self.ficheiros)
+        linha = {"processados": self.processados, "ficheiros_novos": novos,
+                 "alertas": alertas_do_lote, "pendentes": list(pendentes_do_lote)}
+        with open(self.caminho_checkpoint, "a", encoding="utf-8") as f:
+            f.write(json.dumps(linha) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def retomar_de_checkpoint(self, ficheiros_existentes=None):
+        # continua um trabalho interrompido com a mesma versão das regras
+        # (por omissão os ficheiros existentes são os da fila do trabalho)
+        # devolve False se não houver checkpoint compatível
+        try:
+            with open(self.caminho_checkpoint, "r", encoding="utf-8") as f:
+                linhas = f.read().splitlines()
+            cabecalho = json.loads(linhas[0])
+        except (OSError, ValueError, IndexError, TypeError):
+            return False
+        if cabecalho.get("versao") != self.versao:
+            return False
+
+        ficheiros, processados, alertas, pendentes = cabecalho["ficheiros"], 0, [], []
+        for linha in linhas[1:]:
+            try:
+                lote = json.loads(linha)
+            except ValueError:
+                break  # última linha incompleta (processo parou a meio da escrita)
+            ficheiros = ficheiros + lote["ficheiros_novos"]
+            processados = lote["processados"]
+            alertas.extend(lote["alertas"])
+            pendentes.extend(lote.get("pendentes", []))
+
+        # ficheiros apagados entretanto saem; ficheiros novos entram no fim
+        with self._lock:
+            if ficheiros_existentes is None:
+                ficheiros_existentes = self.ficheiros
+            existentes = set(ficheiros_existentes)
+            ja_vistos = set(ficheiros)
+            self.ficheiros = ficheiros + [f for f in ficheiros_existentes if f not in ja_vistos]
+            self._ficheiros_gravados = len(ficheiros)
+            self.processados = processados
+            self.alertas = [a for a in alertas if a["ficheiro_origem"] in existentes]
+            self.pendentes = [p for p in pendentes if p[1]["ficheiro_origem"] in existentes]
+            self.retomado = True
+        print(f"Log: Reavaliação retomada do checkpoint ({processados}/{len(self.ficheiros)} ficheiros).")
+        return True
+
+    # --- execução ---
+
+    def adicionar_ficheiro(self, ficheiro, assinatura_antes, assinatura_depois):
+        # ficheiro persistido enquanto o trabalho corre: entra na fila
+        with self._lock:
+            self.ficheiros.append(ficheiro)
+            self.assinatura = assinatura_depois if self.assinatura == assinatura_antes else None
+
+    def alcancar(self, ficheiros, assinatura_antes, assinatura):
+        # ficheiros gravados (por este ou outro processo) desde assinatura_antes
+        with self._lock:
+            if self.assinatura is None or self.assinatura != assinatura_antes:
+                return False
+            self.ficheiros.extend(ficheiros)
+            self.assinatura = assinatura
+            return True
+
+    def ativo(self):
+        return self.estado in ("pendente", "em_curso")
+
+    def cancelar(self):
+        self._cancelado.set()
+
+    def executar(self):
+        # corre o trabalho até ao fim (na thread atual)
+        self.estado = "em_curso"
+        self.iniciado_em = self.iniciado_em or time.time()
+        try:
+            # o checkpoint é lido aqui, na thread do trabalho, e não por quem o cria
+            if not self.retomado and not self.retomar_de_checkpoint():
+                self._iniciar_checkpoint()
+            while True:
+                if self._cancelado.is_set():
+                    # o checkpoint fica: quem cancelou decide se o apaga
+                    # (um trabalho novo com a mesma versão retoma-o)
+                    self.estado = "cancelado"
+                    return False
+
+                with self._lock:
+                    lote = self.ficheiros[self.processados:self.processados + self.tamanho_lote]
+                if not lote:
+                    # fila vazia: as regras com estado são avaliadas agora,
+                    # com todas as leituras; se chegarem ficheiros novos
+                    # entretanto (ao_concluir devolve False) repete-se
+                    alertas_com_estado, avaliador = avaliar_pendentes(self.pendentes)
+                    with self._lock:
+                        self.alertas_com_estado, self.avaliador = alertas_com_estado, avaliador
+                    if self.ao_concluir is None or self.ao_concluir(self):
+                        break
+                    continue
+
+                documentos = [d for d in map(self.carregar_documento, lote) if d]
+                novos, pendentes = separar_documentos(documentos, self.tabela_regras)
+                with self._lock:
+                    self.alertas.extend(novos)
+                    self.pendentes.extend(pendentes)
+                    self.processados += len(lote)
+                self._gravar_checkpoint(novos, pendentes)
+
+            self.estado = "concluido"
+            self.concluido_em = time.time()
+            self.remover_checkpoint()
+            return True
+
+        except Exception as e:
+            # o checkpoint fica, para o trabalho poder ser retomado
+            print(f"Erro na reavaliação das regras: {e}")
+            self.estado = "erro"
+            self.erro = str(e)
+            return False
+
+    def iniciar(self):
+        # corre o trabalho numa thread em segundo plano
+        self._thread = threading.Thread(target=self.executar, name=f"reavaliacao-{self.versao}", daemon=True)
+        self._thread.start()
+        return self
+
+    def aguardar(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def remover_checkpoint(self):
+        if self.caminho_checkpoint:
+            try:
+                os.remove(self.caminho_checkpoint)
+            except FileNotFoundError:
+                pass
+
+    def resultado(self):
+        return ConjuntoAlertas(self.versao, self.tabela_regras, self.alertas + self.alertas_com_estado,
+                               self.avaliador, self.assinatura,
+                               self.ficheiros[:self.processados])
+
+    def progresso(self):
+        with self._lock:
+            total = len(self.ficheiros)
+            return {
+                "estado": self.estado,
+                "versao_regras": self.versao,
+                "ficheiros_total": total,
+                "ficheiros_processados": self.processados,
+                "percentagem": round(100 * self.processados / total, 1) if total else 100.0,
+                "iniciado_em": self.iniciado_em,
+                "concluido_em": self.concluido_em,
+                "erro": self.erro
+            }
@@ -0,0 +1,131 @@
+# cache em memória das leituras recentes (últimas N horas de cada sensor)
+# cada sensor tem um "anel" com arrays numpy (instante int64, valor float64)
+# os ids de sensor e de tipo são internados (guardados uma só vez), por isso
+# cada leitura custa ~16 bytes + o id e a dataHora original, em vez de um
+# dict python inteiro
+
+import time
+import numpy as np
+from .motor_regras import data_hora_para_epoch
+from .vista_memoria import VistaMemoria
+from backend.config.settings import CACHE_JANELA_HORAS, CACHE_CAPACIDADE_SENSOR
+
+
+class AnelSensor:
+    # buffer circular das leituras de um sensor
+    # cresce por duplicação até à capacidade máxima e depois
+    # passa a escrever por cima das leituras mais antigas
+    # "descartado" é o instante mais recente que já foi escrito por cima:
+    # consultas que comecem antes dele já não têm tudo na memória
+    __slots__ = ("tipo", "instantes", "valores", "ids", "datas_hora", "proximo", "tamanho",
+                 "capacidade", "descartado")
+
+    def __init__(self, tipo, capacidade):
+        inicial = min(64, capacidade)
+        self.tipo = tipo  # código do tipo internado
+        self.instantes = np.zeros(inicial, dtype=np.int64)
+        self.valores = np.zeros(inicial, dtype=np.float64)
+        self.ids = [None] * inicial
+        self.datas_hora = [None] * inicial
+        self.proximo = 0
+        self.tamanho = 0
+        self.capacidade = capacidade
+        self.descartado = None
+
+    def adicionar(self, instante, valor, leitura_id, data_hora):
+        atual = len(self.valores)
+        if self.tamanho == atual and atual < self.capacidade:
+            # ainda não deu a volta, por isso os dados estão em ordem
+            novo = min(atual * 2, self.capacidade)
+            self.instantes = np.resize(self.instantes, novo)
+            self.valores = np.resize(self.valores, novo)
+            self.ids.extend([None] * (novo - atual))
+            self.datas_hora.extend([None] * (novo - atual))
+            # o anel cheio já tinha voltado ao índice 0: continua no fim
+            self.proximo = atual
+            atual = novo
+
+        i = self.proximo
+        if self.tamanho == atual:
+            # cheio: a leitura na posição i sai do anel
+            saida = int(self.instantes[i])
+            self.descartado = saida if self.descartado is None else max(self.descartado, saida)
+        self.instantes[i] = instante
+        self.valores[i] = valor
+        self.ids[i] = leitura_id
+        self.datas_hora[i] = data_hora
+        self.proximo = (i + 1) % atual
+        self.tamanho = min(self.tamanho + 1, atual)
+
+    def desde(self, corte):
+        # índices das leituras com instante >= corte
+        return np.flatnonzero(self.instantes[:self.tamanho] >= corte)
+
+
+class CacheLeituras(VistaMemoria):
+    # guarda só o que entra na janela; consultas mais longas vão ao disco
+
+    def __init__(self, janela_horas=CACHE_JANELA_HORAS, capacidade=CACHE_CAPACIDADE_SENSOR):
+        self.janela = janela_horas * 3600
+        self.capacidade = capacidade
+        super().__init__()
+
+    def nova(self):
+        return CacheLeituras(self.janela / 3600, self.capacidade)
+
+    def _limpar(self):
+        self._aneis = {}  # (estufa_id, sensor_id) -> AnelSensor
+        self._tipos = []  # código -> tipo
+        self._codigo_tipo = {}
+
+    def cobre(self, horas, estufa_id=None, sensor_id=None, tipo=None):
+        # a consulta pode sair só da memória? tem de caber na janela e
+        # nenhum anel consultado pode ter perdido (por estar cheio)
+        # leituras a partir do início pedido
+        if horas * 3600 > self.janela:
+            return False
+        corte = time.time() - horas * 3600
+        with self._lock:
+            return all(anel.descartado is None or anel.descartado < corte
+                       for _, _, _, anel in self._aneis_filtrados(estufa_id, sensor_id, tipo))
+
+    def _adicionar_documento(self, documento):
+        corte = time.time() - self.janela
+        estufa_id = documento["estufa_id"]
+        sensores = documento["sensores"]
+        for leitura_id, data_hora, sensor_id, valor in documento["leituras"]:
+            instante = int(data_hora_para_epoch(data_hora))
+            if instante < corte:
+                continue
+
+            chave = (estufa_id, sensor_id)
+            anel = self._aneis.get(chave)
+            if anel is None:
+                tipo = sensores.get(sensor_id, "tipo_desconhecido")
+                codigo = self._codigo_tipo.get(tipo)
+                if codigo is None:
+                    codigo = self._codigo_tipo[tipo] = len(self._tipos)
+                    self._tipos.append(tipo)
+                anel = self._aneis[chave] = AnelSensor(codigo, self.capacidade)
+            anel.adicionar(instante, valor, leitura_id, data_hora)
+
+    def _aneis_filtrados(self, estufa_id=None, sensor_id=None, tipo=None):
+        # (estufa_id, sensor_id, tipo, anel) dos anéis que passam nos filtros
+        for (estufa, sensor), anel in self._aneis.items():
+            tipo_anel = self._tipos[anel.tipo]
+            if ((estufa_id and estufa != estufa_id) or (sensor_id and sensor != sensor_id)
+                    or (tipo and tipo_anel != tipo)):
+                continue
+            yield estufa, sensor, tipo_anel, anel
+
+    def consultar(self, horas, estufa_id=None, sensor_id=None, tipo=None):
+        # devolve as linhas (estufa_id, leitura_id, instante, dataHora, sensor_id, tipo, valor)
+        # das leituras das últimas 'horas', com filtros opcionais
+        corte = time.time() - horas * 3600
+        linhas = []
+        with self._lock:
+            for estufa, sensor, tipo_anel, anel in self._aneis_filtrados(estufa_id, sensor_id, tipo):
+                for i in anel.desde(corte):
+                    linhas.append((estufa, anel.ids[i], int(anel.instantes[i]), anel.datas_hora[i],
+                                   sensor, tipo_anel, float(anel.valores[i])))
+        return linhas
@@ -0,0 +1,160 @@
+# compressão das respostas, negociada pelo cabeçalho Accept-Encoding
+# gzip vem da biblioteca padrão; br (brotli) e zstd só ficam disponíveis
+# se os pacotes opcionais 'brotli' / 'zstandard' estiverem instalados
+
+import itertools
+import zlib
+from flask import request
+from backend.config.settings import COMPRESSAO_TAMANHO_MINIMO, COMPRESSAO_NIVEIS
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# tipos de conteúdo que valem a pena comprimir (texto repetitivo)
+TIPOS_COMPRIMIVEIS = ("application/json", "application/xml", "text/csv", "text/plain", "text/html")
+
+
+class _CompressorGzip:
+    def __init__(self, nivel):
+        # wbits=31 -> formato gzip (cabeçalho + crc)
+        self._obj = zlib.compressobj(nivel, zlib.DEFLATED, 31)
+
+    def comprimir(self, dados):
+        return self._obj.compress(dados)
+
+    def terminar(self):
+        return self._obj.flush()
+
+
+class _CompressorBrotli:
+    def __init__(self, nivel):
+        self._obj = brotli.Compressor(quality=nivel)
+
+    def comprimir(self, dados):
+        return self._obj.process(dados)
+
+    def terminar(self):
+        return self._obj.finish()
+
+
+class _CompressorZstd:
+    def __init__(self, nivel):
+        self._obj = zstandard.ZstdCompressor(level=nivel).compressobj()
+
+    def comprimir(self, dados):
+        return self._obj.compress(dados)
+
+    def terminar(self):
+        return self._obj.flush()
+
+
+def codificacoes_disponiveis():
+    # por ordem de preferência do servidor (em caso de empate de q=)
+    disponiveis = {}
+    if zstandard is not None:
+        disponiveis["zstd"] = _CompressorZstd
+    if brotli is not None:
+        disponiveis["br"] = _CompressorBrotli
+    disponiveis["gzip"] = _CompressorGzip
+    return disponiveis
+
+
+def escolher_codificacao(accept_encodings, disponiveis):
+    # respeita os pesos (q=) do cliente, incluindo q=0 e o curinga "*"
+    return accept_encodings.best_match(list(disponiveis))
+
+
+def _deve_comprimir(response, tamanho_minimo):
+    if request.method == "HEAD" or response.status_code != 200:
+        return False
+    if response.direct_passthrough or "Content-Encoding" in response.headers:
+        return False
+    if response.mimetype not in TIPOS_COMPRIMIVEIS:
+        return False
+    # respostas em stream não têm tamanho conhecido: decide-se depois de
+    # ler o início (ver _inicio_do_stream)
+    return response.is_streamed or response.calculate_content_length() >= tamanho_minimo
+
+
+def _em_bytes(bloco):
+    return bloco.encode("utf-8") if isinstance(bloco, str) else bloco
+
+
+def _inicio_do_stream(iterador, tamanho_minimo):
+    # lê blocos até juntar tamanho_minimo bytes ou o stream acabar
+    # devolve (blocos lidos, True se o stream acabou)
+    blocos, tamanho = [], 0
+    for bloco in iterador:
+        blocos.append(_em_bytes(bloco))
+        tamanho += len(blocos[-1])
+        if tamanho >= tamanho_minimo:
+            return blocos, False
+    return blocos, True
+
+
+def _fechar(corpo):
+    if hasattr(corpo, "close"):
+        corpo.close()
+
+
+def _comprimir_stream(blocos, corpo, compressor):
+    # comprime bloco a bloco, sem juntar a resposta inteira
+    # (blocos: o stream já com o início lido; corpo: o original, para o fechar)
+    try:
+        for bloco in blocos:
+            saida = compressor.comprimir(_em_bytes(bloco))
+            if saida:
+                yield saida
+        yield compressor.terminar()
+    finally:
+        _fechar(corpo)
+
+
+def comprimir_resposta(response, niveis, tamanho_minimo):
+    # aplica a compressão negociada a uma resposta (usado no after_request)
+    response.vary.add("Accept-Encoding")
+    if not _deve_comprimir(response, tamanho_minimo):
+        return response
+
+    disponiveis = codificacoes_disponiveis()
+    codificacao = escolher_codificacao(request.accept_encodings, disponiveis)
+    if not codificacao:
+        return response
+
+    compressor = disponiveis[codificacao](niveis.get(codificacao, COMPRESSAO_NIVEIS[codificacao]))
+    if response.is_streamed:
+        corpo = response.response
+        iterador = iter(corpo)
+        inicio, terminou = _inicio_do_stream(iterador, tamanho_minimo)
+        if terminou and sum(map(len, inicio)) < tamanho_minimo:
+            # stream pequeno (ex: "[]" ou uma página curta): vai como está,
+            # a compressão só o tornaria maior
+            _fechar(corpo)
+            response.set_data(b"".join(inicio))
+            return response
+        response.response = _comprimir_stream(itertools.chain(inicio, iterador), corpo, compressor)
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(compressor.comprimir(response.get_data()) + compressor.terminar())
+
+    response.headers["Content-Encoding"] = codificacao
+    return response
+
+
+def registar(app):
+    # nível e tamanho mínimo podem ser mudados no app.config
+    app.config.setdefault("COMPRESSAO_NIVEIS", COMPRESSAO_NIVEIS)
+    app.config.setdefault("COMPRESSAO_TAMANHO_MINIMO", COMPRESSAO_TAMANHO_MINIMO)
+
+    @app.after_request
+    def aplicar_compressao(response):
+        return comprimir_resposta(response,
+                                  app.config["COMPRESSAO_NIVEIS"],
+                                  app.config["COMPRESSAO_TAMANHO_MINIMO"])
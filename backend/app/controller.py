@@ -1,11 +1,19 @@
 # cordena o fluxo da operação, recebe o request e envia para validação
 
-from flask import request, jsonify, make_response
-from . import service_xml
+import time
+from flask import request, jsonify, make_response, abort
+from . import service_xml, formato_binario
+from .motor_regras import data_hora_para_epoch
+from .json_rapido import resposta_array_json
+from .replicacao import CABECALHO_SEGREDO
 
 
 def receber_leitura():
     # controlador para o recebimento de novas leituras XML
+    # (ou no formato binário compacto, escolhido pelo Content-Type)
+    if request.mimetype == formato_binario.CONTENT_TYPE:
+        return receber_leitura_binaria()
+
     xml_data_string = request.data.decode('utf-8')
 
     if not xml_data_string:
@@ -18,23 +26,147 @@ def receber_leitura():
     service_xml.validar_regras_negocio(xml_doc)
     # serviço de persistência
     service_xml.persistir_xml(xml_data_string, xml_doc)
+    # métricas derivadas (VPD, ponto de orvalho, DLI)
+    service_xml.processar_metricas_derivadas(xml_doc)
 
     # se tudo passou, retorna sucesso
     return make_response(jsonify(message="Leitura recebida e validada (XSD) com sucesso."), 201)
 
 
+def receber_leitura_binaria():
+    # mesmo fluxo do XML, mas a validação não passa pelo lxml
+    dados = request.get_data()
+
+    if not dados:
+        return make_response(jsonify(error="Corpo da requisição está vazio."), 400)
+
+    # validação do binário (mesmas restrições do xsd)
+    documento = service_xml.validar_binario(dados)
+    # validação de regras
+    service_xml.validar_regras_negocio(documento)
+    # persiste no mesmo formato (XML) das outras leituras
+    service_xml.persistir_xml(service_xml.documento_para_xml(documento), documento)
+    # métricas derivadas (VPD, ponto de orvalho, DLI)
+    service_xml.processar_metricas_derivadas(documento)
+
+    return make_response(jsonify(message="Leitura recebida e validada (binário) com sucesso."), 201)
+
+
 def listar_leituras():
     # listar todas as leituras persistidas
-    dados = service_xml.ler_dados_persistidos()
+    # com ?horas=N lista só as leituras recentes (servidas da memória),
+    # com filtros opcionais ?estufa=, ?sensor= e ?tipo= (para os gráficos)
+    # ?snapshot=G.S repete a leitura sobre o mesmo snapshot (ver X-Snapshot)
+    snapshot_id = request.args.get('snapshot')
+    horas = request.args.get('horas')
+    if horas is not None:
+        try:
+            horas = float(horas)
+            if horas <= 0:
+                raise ValueError
+        except ValueError:
+            return make_response(jsonify(error="Parâmetro 'horas' deve ser um número positivo."), 400)
+
+        dados, snapshot_lido = service_xml.ler_leituras_recentes(horas,
+                                                                 request.args.get('estufa'),
+                                                                 request.args.get('sensor'),
+                                                                 request.args.get('tipo'),
+                                                                 snapshot_id)
+        resposta = resposta_array_json(dados, 200)
+        resposta.headers["X-Snapshot"] = snapshot_lido
+        return resposta
+
+    # os ficheiros são lidos e serializados à medida que a resposta é enviada
+    snapshot = service_xml.abrir_snapshot(snapshot_id)
+    dados = service_xml.iterar_dados_persistidos(snapshot)
     # retorna dados com status 200 (ok)
-    return make_response(jsonify(dados), 200)
+    resposta = resposta_array_json(dados, 200)
+    resposta.headers["X-Snapshot"] = snapshot.id
+    return resposta
 
 
 def listar_alertas():
-    # chama os alertas
-    dados_alertas = service_xml.ler_dados_de_alerta()
-    # retorna dados com status 200 (ok)
-    return make_response(jsonify(dados_alertas), 200)
+    # chama os alertas, ordenados por dataHora
+    # filtros: ?estufa= ?tipo= ?sensor= ?desde= ?ate= (xs:dateTime) ou ?horas=N
+    # ?ordem=asc|desc, ?limite=N e ?cursor= (página seguinte, ver X-Proximo-Cursor)
+    # ?contagem=total|tipo|estufa devolve só as contagens
+    # ?snapshot=G.S fixa o snapshot (para paginar sem ver alertas novos)
+    snapshot_id = request.args.get('snapshot')
+    try:
+        filtros = _filtros_alertas()
+        ordem = request.args.get('ordem', 'asc')
+        if ordem not in ('asc', 'desc'):
+            raise ValueError("Parâmetro 'ordem' deve ser 'asc' ou 'desc'.")
+        limite = request.args.get('limite')
+        if limite is not None:
+            limite = _inteiro_positivo(limite, 'limite')
+        contagem = request.args.get('contagem')
+        if contagem not in (None, 'total', 'tipo', 'estufa'):
+            raise ValueError("Parâmetro 'contagem' deve ser 'total', 'tipo' ou 'estufa'.")
+    except ValueError as e:
+        return make_response(jsonify(error=str(e)), 400)
+
+    if contagem is not None:
+        dados, versao_regras, snapshot_lido = service_xml.contar_alertas(
+            None if contagem == 'total' else contagem, snapshot_id, **filtros)
+        resposta = make_response(jsonify(dados), 200)
+    else:
+        dados_alertas, proximo, versao_regras, snapshot_lido = service_xml.consultar_alertas(
+            ordem, limite, request.args.get('cursor'), snapshot_id, **filtros)
+        # retorna dados com status 200 (ok), serializados em stream
+        resposta = resposta_array_json(dados_alertas, 200)
+        if proximo:
+            resposta.headers["X-Proximo-Cursor"] = proximo
+
+    # versão das regras que gerou estes alertas (muda quando a
+    # reavaliação em segundo plano termina)
+    if versao_regras:
+        resposta.headers["X-Versao-Regras"] = versao_regras
+    if snapshot_lido:
+        resposta.headers["X-Snapshot"] = snapshot_lido
+    return resposta
+
+
+def _filtros_alertas():
+    # lê os filtros do GET /api/alertas (instantes em segundos epoch)
+    filtros = {"estufa_id": request.args.get('estufa'),
+               "tipo": request.args.get('tipo'),
+               "sensor_id": request.args.get('sensor')}
+    for parametro in ('desde', 'ate'):
+        valor = request.args.get(parametro)
+        if valor is not None:
+            try:
+                filtros[parametro] = data_hora_para_epoch(valor)
+            except ValueError:
+                raise ValueError(f"Parâmetro '{parametro}' deve ser uma data/hora ISO (ex: 2025-11-10T14:30:00).")
+
+    horas = request.args.get('horas')
+    if horas is not None:
+        try:
+            horas = float(horas)
+            if horas <= 0:
+                raise ValueError
+        except ValueError:
+            raise ValueError("Parâmetro 'horas' deve ser um número positivo.")
+        corte = time.time() - horas * 3600
+        filtros["desde"] = max(filtros.get("desde", corte), corte)
+    return filtros
+
+
+def _inteiro_positivo(valor, nome):
+    try:
+        numero = int(valor)
+        if numero <= 0:
+            raise ValueError
+        return numero
+    except ValueError:
+        raise ValueError(f"Parâmetro '{nome}' deve ser um inteiro positivo.")
+
+
+def listar_estado_atual():
+    # última leitura, status (regras atuais) e estatísticas de cada sensor
+    dados = service_xml.ler_estado_atual()
+    return make_response(jsonify(dados), 200)
 
 
 def listar_configuracoes():
@@ -59,15 +191,31 @@ def atualizar_configuracoes():
         return make_response(jsonify(error=f"JSON mal formado: {e}"), 400)
 
     service_xml.atualizar_configuracoes_regras(novas_regras)
+    # os alertas do histórico são reavaliados em segundo plano
+    reavaliacao = service_xml.iniciar_reavaliacao()
 
     # retorna sucesso se tudo ok
-    return make_response(jsonify(message="Configurações atualizadas com sucesso."), 200)
+    return make_response(jsonify(message="Configurações atualizadas com sucesso.",
+                                 reavaliacao=reavaliacao), 200)
 
 
 def resetar_configuracoes():
     # controlador para restaurar as regras para o padrão.
     service_xml.resetar_regras_para_default()
-    return make_response(jsonify(message="Configurações restauradas para o padrão."), 200)
+    reavaliacao = service_xml.iniciar_reavaliacao()
+    return make_response(jsonify(message="Configurações restauradas para o padrão.",
+                                 reavaliacao=reavaliacao), 200)
+
+
+def consultar_reavaliacao():
+    # progresso da reavaliação dos alertas com as regras atuais
+    return make_response(jsonify(service_xml.consultar_reavaliacao()), 200)
+
+
+def iniciar_reavaliacao():
+    # (re)inicia a reavaliação, retomando o checkpoint se existir
+    # (ex: depois de um erro ou de o servidor ter sido reiniciado)
+    return make_response(jsonify(service_xml.iniciar_reavaliacao()), 202)
 
 
 # backend/app/controller.py
@@ -84,11 +232,15 @@ def exportar_dados():
     if formato.lower() != 'csv':
         return make_response(jsonify(error="Formato de exportação não suportado. Use ?formato=csv"), 400)
 
-    # chamar o serviço para gerar a string CSV
-    csv_data = service_xml.exportar_dados_para_csv()
+    # chamar o serviço para gerar a string CSV (de um único snapshot,
+    # mesmo com gravações e exclusões a decorrer)
+    snapshot = service_xml.abrir_snapshot(request.args.get('snapshot'))
+    csv_data = service_xml.exportar_dados_para_csv(snapshot)
 
     if not csv_data:
-        return make_response(jsonify(message="Sem dados para exportar."), 200)
+        response = make_response(jsonify(message="Sem dados para exportar."), 200)
+        response.headers["X-Snapshot"] = snapshot.id
+        return response
 
     # cria a Resposta de Ficheiro (Download)
     # 'Response' manual
@@ -97,6 +249,7 @@ def exportar_dados():
     response.headers["Content-Disposition"] = "attachment; filename=leituras.csv"
     # 'MIME type' para que o navegador saiba que é um CSV
     response.headers["Content-Type"] = "text/csv; charset=utf-8"
+    response.headers["X-Snapshot"] = snapshot.id
 
     return response
 
@@ -105,3 +258,40 @@ def excluir_leituras():
     # Controlador para o pedido de exclusão de todas as leituras.
     resultado = service_xml.excluir_todas_as_leituras()
     return make_response(jsonify(resultado), 200)
+
+
+def _exigir_par():
+    # as rotas de replicação só existem num cluster (404 como uma rota
+    # desconhecida) e só respondem aos pares, com o segredo do cluster
+    if not service_xml.CLUSTER.ativo:
+        abort(404)
+    if not service_xml.CLUSTER.autorizado(request.headers.get(CABECALHO_SEGREDO)):
+        abort(403, description="Pedido de replicação sem o segredo do cluster.")
+
+
+def listar_alteracoes():
+    # registo de alterações deste nó, lido pelos outros nós (replicação)
+    _exigir_par()
+    try:
+        desde = int(request.args.get('desde', 0))
+        limite = _inteiro_positivo(request.args.get('limite', 500), 'limite')
+        if desde < 0:
+            raise ValueError("Parâmetro 'desde' deve ser >= 0.")
+    except ValueError as e:
+        return make_response(jsonify(error=str(e)), 400)
+    return make_response(jsonify(service_xml.ler_alteracoes(desde, limite)), 200)
+
+
+def reservar_leitura(leitura_id):
+    # reserva de um ID de leitura pedida por outro nó (409 se já existe)
+    _exigir_par()
+    if not service_xml.reservar_leitura(leitura_id, request.args.get('dono', '')):
+        return make_response(jsonify(error=f"Conflito: A leitura com ID {leitura_id} já existe."), 409)
+    return make_response(jsonify(message="ID reservado."), 201)
+
+
+def desfazer_reserva(leitura_id):
+    # o outro nó não gravou a leitura: liberta o ID (só se a reserva for dele)
+    _exigir_par()
+    service_xml.desfazer_reserva(leitura_id, request.args.get('dono', ''))
+    return make_response(jsonify(message="Reserva desfeita."), 200)
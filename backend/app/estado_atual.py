@@ -0,0 +1,97 @@
+# estado atual de cada sensor (GET /api/estado-atual)
+# guarda, por (estufa, sensor), a leitura mais recente e as últimas N
+# leituras para as estatísticas; é atualizado a cada persistir_xml, por
+# isso a consulta custa O(nº de sensores) e não lê o histórico
+
+import heapq
+from .motor_regras import data_hora_para_epoch, faixa_ideal, faixa_com_estado
+from .vista_memoria import VistaMemoria
+from backend.config.settings import ESTADO_JANELA_ESTATISTICAS
+
+
+class EstadoSensorAtual:
+    __slots__ = ("tipo", "limites", "ultima", "janela", "total")
+
+    def __init__(self, tipo):
+        self.tipo = tipo
+        self.limites = None  # <configuracoes> do documento da última leitura
+        self.ultima = None   # (instante, leitura_id, dataHora, valor)
+        self.janela = []     # heap das N leituras mais recentes: (instante, valor)
+        self.total = 0
+
+
+class EstadoAtual(VistaMemoria):
+
+    def __init__(self, tamanho_janela=ESTADO_JANELA_ESTATISTICAS):
+        self.tamanho_janela = tamanho_janela
+        super().__init__()
+
+    def nova(self):
+        return EstadoAtual(self.tamanho_janela)
+
+    def _limpar(self):
+        self._sensores = {}  # (estufa_id, sensor_id) -> EstadoSensorAtual
+
+    def _adicionar_documento(self, documento):
+        estufa_id = documento["estufa_id"]
+        for leitura_id, data_hora, sensor_id, valor in documento["leituras"]:
+            chave = (estufa_id, sensor_id)
+            estado = self._sensores.get(chave)
+            if estado is None:
+                tipo = documento["sensores"].get(sensor_id, "tipo_desconhecido")
+                estado = self._sensores[chave] = EstadoSensorAtual(tipo)
+
+            instante = data_hora_para_epoch(data_hora)
+            estado.total += 1
+            if estado.ultima is None or instante >= estado.ultima[0]:
+                estado.ultima = (instante, leitura_id, data_hora, valor)
+                estado.limites = documento.get("limites")
+
+            # janela das N mais recentes (por dataHora), O(log N) por leitura
+            if len(estado.janela) < self.tamanho_janela:
+                heapq.heappush(estado.janela, (instante, valor))
+            elif instante > estado.janela[0][0]:
+                heapq.heapreplace(estado.janela, (instante, valor))
+
+    def consultar(self, tabela_regras, em_alerta=None):
+        # devolve o estado de cada sensor, agrupado por estufa
+        # o status usa as regras ATUAIS (tabela_regras), não as da ingestão
+        # nas regras com histerese/duração o status vem de 'em_alerta'
+        # (ConjuntoAlertas.sensores_em_alerta), para bater com o /api/alertas
+        em_alerta = em_alerta or {}
+        por_estufa = {}
+        with self._lock:
+            for (estufa_id, sensor_id), estado in sorted(self._sensores.items()):
+                _, leitura_id, data_hora, valor = estado.ultima
+                regra = tabela_regras.regra(estufa_id, sensor_id, estado.tipo, estado.limites)
+                valores = [v for _, v in estado.janela]
+
+                if not regra:
+                    status, faixa = "sem_regra", None
+                else:
+                    minimo = regra.get('min', float('-inf'))
+                    maximo = regra.get('max', float('inf'))
+                    if faixa_com_estado(regra) and (estufa_id, sensor_id) in em_alerta:
+                        fora = em_alerta[(estufa_id, sensor_id)]
+                    else:
+                        fora = not minimo <= valor <= maximo
+                    status = "alerta" if fora else "ok"
+                    faixa = faixa_ideal(regra)
+
+                por_estufa.setdefault(estufa_id, []).append({
+                    "sensor_id": sensor_id,
+                    "tipo": estado.tipo,
+                    "ultima_leitura": {"id": leitura_id, "dataHora": data_hora, "valor": valor},
+                    "status": status,
+                    "faixa_ideal": faixa,
+                    "estatisticas": {
+                        "total_leituras": estado.total,
+                        "janela": len(valores),
+                        "media": sum(valores) / len(valores),
+                        "minimo": min(valores),
+                        "maximo": max(valores)
+                    }
+                })
+
+        return [{"estufa_id": estufa_id, "sensores": sensores}
+                for estufa_id, sensores in por_estufa.items()]
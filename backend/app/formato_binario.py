@@ -0,0 +1,181 @@
+# formato binário compacto para o POST /api/leituras (gateways limitados)
+# carrega os mesmos dados do schema.xsd, mas sem o custo do parse XML
+#
+# Content-Type: application/x-estufa-leituras
+# todos os inteiros/reais em little-endian; "texto" = uint16 tamanho + UTF-8
+#
+#   4s       magia b"EST1"
+#   texto    id da estufa
+#   uint16   nº de sensores, cada um: texto id, texto tipo, texto unidade
+#   uint32   nº de leituras, cada uma:
+#              texto id, uint16 índice do sensor (na lista acima),
+#              int64 dataHora em microssegundos desde 1970-01-01,
+#              int16 fuso em minutos (-32768 = sem fuso), float64 valor
+#   uint16   nº de limites (<configuracoes>), cada um:
+#              texto tipo, float64 min, float64 max
+
+import math
+import re
+import struct
+from datetime import datetime, timedelta, timezone
+
+CONTENT_TYPE = "application/x-estufa-leituras"
+MAGIA = b"EST1"
+SEM_FUSO = -32768
+FUSO_MAXIMO = 14 * 60  # o xs:dateTime só aceita fusos entre -14:00 e +14:00
+
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_LEITURA = struct.Struct("<Hqhd")
+_LIMITE = struct.Struct("<dd")
+
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_UTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICRO = timedelta(microseconds=1)
+
+# caracteres que não podem aparecer num documento XML 1.0 (controlo,
+# exceto tab/LF/CR, e os não-caracteres U+FFFE/U+FFFF)
+_CARACTERES_PROIBIDOS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+
+class FormatoInvalido(ValueError):
+    # o binário não respeita o layout ou as restrições do schema.xsd
+    pass
+
+
+class _Leitor:
+    def __init__(self, dados):
+        self.dados = memoryview(dados)
+        self.pos = 0
+
+    def ler(self, estrutura):
+        try:
+            valores = estrutura.unpack_from(self.dados, self.pos)
+        except struct.error:
+            raise FormatoInvalido(f"dados truncados na posição {self.pos}")
+        self.pos += estrutura.size
+        return valores
+
+    def texto(self):
+        (tamanho,) = self.ler(_U16)
+        fim = self.pos + tamanho
+        if fim > len(self.dados):
+            raise FormatoInvalido(f"texto truncado na posição {self.pos}")
+        try:
+            valor = str(self.dados[self.pos:fim], "utf-8")
+        except UnicodeDecodeError:
+            raise FormatoInvalido(f"texto com UTF-8 inválido na posição {self.pos}")
+        if _CARACTERES_PROIBIDOS.search(valor):
+            # o XML gerado a partir do binário não seria bem formado
+            raise FormatoInvalido(f"texto com caracteres não permitidos em XML na posição {self.pos}")
+        self.pos = fim
+        return valor
+
+
+def _decimal(valor, campo):
+    # xs:decimal não aceita NaN nem infinito
+    if not math.isfinite(valor):
+        raise FormatoInvalido(f"{campo} não é um decimal válido: {valor}")
+    return valor
+
+
+def _data_hora_para_texto(micros, fuso):
+    # reconstrói o xs:dateTime (ex: "2025-11-10T14:30:00" ou "...+01:00")
+    if fuso != SEM_FUSO and abs(fuso) > FUSO_MAXIMO:
+        raise FormatoInvalido(f"fuso fora do intervalo do xs:dateTime (-14:00 a +14:00): {fuso} minutos")
+    try:
+        if fuso == SEM_FUSO:
+            return (_EPOCH + micros * _MICRO).isoformat()
+        tz = timezone(timedelta(minutes=fuso))
+        return (_EPOCH_UTC + micros * _MICRO).astimezone(tz).isoformat()
+    except (OverflowError, ValueError):
+        raise FormatoInvalido(f"dataHora fora do intervalo suportado: {micros}")
+
+
+def _texto_para_data_hora(data_hora):
+    instante = datetime.fromisoformat(data_hora)
+    if instante.tzinfo is None:
+        return (instante - _EPOCH) // _MICRO, SEM_FUSO
+    fuso = instante.utcoffset() // timedelta(minutes=1)
+    return (instante - _EPOCH_UTC) // _MICRO, fuso
+
+
+def decodificar(dados):
+    # devolve o mesmo "documento" que o service_xml extrai de um XML
+    # (estufa_id, sensores, unidades, leituras, limites)
+    leitor = _Leitor(dados)
+    if bytes(leitor.dados[:4]) != MAGIA:
+        raise FormatoInvalido("cabeçalho (magia) inválido")
+    leitor.pos = 4
+
+    estufa_id = leitor.texto()
+
+    (n_sensores,) = leitor.ler(_U16)
+    if n_sensores == 0:
+        raise FormatoInvalido("é preciso pelo menos um <sensor>")
+    ids_sensores, sensores, unidades = [], {}, {}
+    for _ in range(n_sensores):
+        sensor_id, tipo, unidade = leitor.texto(), leitor.texto(), leitor.texto()
+        ids_sensores.append(sensor_id)
+        sensores[sensor_id] = tipo
+        unidades[sensor_id] = unidade
+
+    (n_leituras,) = leitor.ler(_U32)
+    if n_leituras == 0:
+        raise FormatoInvalido("é preciso pelo menos uma <leitura>")
+    leituras = []
+    for _ in range(n_leituras):
+        leitura_id = leitor.texto()
+        indice, micros, fuso, valor = leitor.ler(_LEITURA)
+        if indice >= n_sensores:
+            raise FormatoInvalido(f"leitura {leitura_id} aponta para um sensor inexistente ({indice})")
+        leituras.append((leitura_id, _data_hora_para_texto(micros, fuso),
+                         ids_sensores[indice], _decimal(valor, f"valor da leitura {leitura_id}")))
+
+    (n_limites,) = leitor.ler(_U16)
+    limites = {}
+    for _ in range(n_limites):
+        tipo = leitor.texto()
+        minimo, maximo = leitor.ler(_LIMITE)
+        limites[tipo] = {"min": _decimal(minimo, f"min de {tipo}"),
+                         "max": _decimal(maximo, f"max de {tipo}")}
+
+    if leitor.pos != len(leitor.dados):
+        raise FormatoInvalido(f"{len(leitor.dados) - leitor.pos} bytes a mais no fim")
+
+    return {
+        "estufa_id": estufa_id,
+        "sensores": sensores,
+        "unidades": unidades,
+        "leituras": leituras,
+        "limites": limites
+    }
+
+
+def _texto(valor):
+    dados = valor.encode("utf-8")
+    return _U16.pack(len(dados)) + dados
+
+
+def codificar(documento):
+    # operação inversa (usada pelos gateways e pelos testes)
+    ids_sensores = list(documento["sensores"])
+    indice_sensor = {sensor_id: i for i, sensor_id in enumerate(ids_sensores)}
+    unidades = documento.get("unidades", {})
+
+    partes = [MAGIA, _texto(documento["estufa_id"]), _U16.pack(len(ids_sensores))]
+    for sensor_id in ids_sensores:
+        partes += [_texto(sensor_id), _texto(documento["sensores"][sensor_id]),
+                   _texto(unidades.get(sensor_id, ""))]
+
+    partes.append(_U32.pack(len(documento["leituras"])))
+    for leitura_id, data_hora, sensor_id, valor in documento["leituras"]:
+        micros, fuso = _texto_para_data_hora(data_hora)
+        partes += [_texto(leitura_id), _LEITURA.pack(indice_sensor[sensor_id], micros, fuso, valor)]
+
+    limites = documento.get("limites", {})
+    partes.append(_U16.pack(len(limites)))
+    for tipo, limite in limites.items():
+        partes += [_texto(tipo), _LIMITE.pack(limite["min"], limite["max"])]
+
+    return b"".join(partes)
@@ -0,0 +1,339 @@
+# gerações do DATA_DIR e snapshots de leitura
+#
+# os XMLs ficam em DATA_DIR/gNNNNNN/ e o ficheiro DATA_DIR/ATUAL tem o nome
+# da geração ativa. excluir tudo é criar uma geração vazia e trocar o
+# ponteiro (os.replace é atómico), por isso o DELETE responde logo; a
+# geração antiga é apagada numa thread, depois de terminarem as leituras
+# que ainda a estão a percorrer
+#
+# dentro de uma geração os ficheiros só são acrescentados: cada geração tem
+# um MANIFESTO (append-only, um nome de ficheiro por linha, escrito depois
+# do ficheiro). um snapshot "G.S" é a geração G com as primeiras S linhas
+# do manifesto, por isso uma leitura longa vê sempre o mesmo conjunto de
+# ficheiros sem impedir as escritas, e pode ser repetida mais tarde com o
+# mesmo id (enquanto G for a geração ativa)
+#
+# cada processo com leituras em curso numa geração deixa um marcador em
+# gNNNNNN/LEITORES/<pid> (numa subpasta, para não mudar o mtime da
+# geração, que faz parte da versão), por isso a recolha feita por outro processo espera por
+# elas. os marcadores de processos que já terminaram são ignorados; como
+# isto usa o pid, só vale para processos na mesma máquina (um DATA_DIR
+# partilhado por rede entre máquinas não é suportado). se mesmo assim uma
+# geração desaparecer a meio de uma leitura, a leitura dá erro
+# (SnapshotExpirado) em vez de devolver dados parciais
+#
+# um DATA_DIR sem ATUAL (versões anteriores, XMLs soltos) é migrado para a
+# primeira geração ao arrancar
+
+import os
+import re
+import shutil
+import threading
+import time
+from collections import Counter
+
+PONTEIRO = "ATUAL"
+MANIFESTO = "MANIFESTO"
+LEITORES = "LEITORES"
+
+# o manifesto tem um nome por linha: nomes com quebras de linha (ou outros
+# caracteres de controlo) ou com separadores de pasta não podem ser ficheiros
+_NOME_INVALIDO = re.compile(r"[\x00-\x1f\x7f/\\]")
+NOME_TAMANHO_MAXIMO = 200  # bytes (o limite habitual de um nome é 255)
+
+
+def nome_valido(nome):
+    return (bool(nome) and not _NOME_INVALIDO.search(nome) and nome not in (".", "..")
+            and len(nome.encode("utf-8")) <= NOME_TAMANHO_MAXIMO)
+
+
+class SnapshotInvalido(ValueError):
+    pass
+
+
+class SnapshotExpirado(Exception):
+    pass
+
+
+def _e_geracao(nome):
+    return len(nome) == 7 and nome[0] == "g" and nome[1:].isdigit()
+
+
+def processo_vivo(pid):
+    # o processo 'pid' (nesta máquina) ainda existe?
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # existe, mas é de outro utilizador
+    return True
+
+
+class Snapshot:
+    # geração fixada para uma leitura; libertar() quando a leitura termina
+
+    def __init__(self, geracoes, diretorio, ficheiros, assinatura):
+        self._geracoes = geracoes
+        self.diretorio = diretorio
+        self.ficheiros = ficheiros
+        self.id = f"{int(os.path.basename(diretorio)[1:])}.{len(ficheiros)}"
+        self.assinatura = assinatura  # ver GeracoesDados.versao()
+        self._libertado = False
+
+    def libertar(self):
+        if not self._libertado:
+            self._libertado = True
+            self._geracoes._libertar(self.diretorio)
+
+
+class GeracoesDados:
+
+    def __init__(self, base, espera_recolha=0.0):
+        self.base = base
+        # segundos entre a troca e a recolha de uma geração (além de
+        # esperar pelos leitores, deste e de outros processos)
+        self.espera_recolha = espera_recolha
+        self._lock = threading.Lock()
+        self._livre = threading.Condition(self._lock)
+        self._leitores = Counter()  # diretório -> leituras em curso neste processo
+        self._manifestos = {}  # diretório -> (bytes lidos, [ficheiros], {ficheiros})
+        self._recolhas = []
+
+    # --- geração ativa e manifesto ---
+
+    def atual(self):
+        # diretório da geração ativa (o ponteiro pode ser trocado por outro processo)
+        # lido sempre: o inode e o mtime do ponteiro podem repetir-se entre
+        # duas trocas seguidas, por isso não servem de chave de cache
+        with open(os.path.join(self.base, PONTEIRO), "r", encoding="utf-8") as f:
+            return os.path.join(self.base, f.read().strip())
+
+    def _ficheiros(self, diretorio):
+        # ficheiros do manifesto, pela ordem em que foram gravados
+        # só lê o que foi acrescentado desde a última vez (inclusive por
+        # outro processo); uma linha incompleta fica para a próxima
+        lidos, ficheiros, conhecidos = self._manifestos.get(diretorio, (0, [], set()))
+        caminho = os.path.join(diretorio, MANIFESTO)
+        try:
+            if os.stat(caminho).st_size > lidos:
+                with open(caminho, "rb") as f:
+                    f.seek(lidos)
+                    dados = f.read()
+                completo = dados[:dados.rfind(b"\n") + 1]
+                # só '\n' separa entradas (splitlines também parte em \x85, \u2028...)
+                for nome in completo.decode("utf-8").split("\n")[:-1]:
+                    if nome not in conhecidos:
+                        conhecidos.add(nome)
+                        ficheiros.append(nome)
+                lidos += len(completo)
+        except FileNotFoundError:
+            pass
+        self._manifestos[diretorio] = (lidos, ficheiros, conhecidos)
+        return ficheiros
+
+    def ficheiros(self, diretorio):
+        # ficheiros registados numa geração (ex: a que acabou de ser trocada)
+        with self._lock:
+            return list(self._ficheiros(diretorio))
+
+    def registar(self, diretorio, ficheiro):
+        # acrescenta ao manifesto um ficheiro já gravado por inteiro
+        # (O_APPEND: escritas de vários processos não se misturam)
+        if not nome_valido(ficheiro):
+            raise ValueError(f"nome de ficheiro inválido para o manifesto: {ficheiro!r}")
+        fd = os.open(os.path.join(diretorio, MANIFESTO), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        try:
+            os.write(fd, (ficheiro + "\n").encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    def versao(self):
+        # (geração, nº de ficheiros, mtime da pasta) da geração ativa: muda a
+        # cada ficheiro gravado, a cada troca de geração e também se alguém
+        # apagar ficheiros à mão
+        with self._lock:
+            while True:
+                diretorio = self.atual()
+                try:
+                    return self._versao(diretorio)
+                except FileNotFoundError:
+                    # geração recolhida entre a leitura do ponteiro e a da pasta
+                    if self.atual() == diretorio:
+                        raise
+
+    def _versao(self, diretorio):
+        return (os.path.basename(diretorio), len(self._ficheiros(diretorio)),
+                os.stat(diretorio).st_mtime_ns)
+
+    # --- snapshots ---
+
+    def fixar(self, snapshot_id=None):
+        # snapshot da geração ativa (o atual, ou o "G.S" pedido)
+        with self._lock:
+            while True:
+                diretorio = self.atual()
+                ficheiros = self._ficheiros(diretorio)
+                quantidade = len(ficheiros)
+                if snapshot_id is not None:
+                    try:
+                        geracao, quantidade = (int(parte) for parte in snapshot_id.split("."))
+                    except ValueError:
+                        raise SnapshotInvalido(f"snapshot '{snapshot_id}' inválido (formato G.S)")
+                    if geracao != int(os.path.basename(diretorio)[1:]):
+                        raise SnapshotExpirado(f"snapshot '{snapshot_id}' expirou (os dados foram excluídos)")
+                    if not 0 <= quantidade <= len(ficheiros):
+                        raise SnapshotInvalido(f"snapshot '{snapshot_id}' ainda não existe")
+                try:
+                    assinatura = self._versao(diretorio) if quantidade == len(ficheiros) else None
+                    if not self._leitores[diretorio]:
+                        self._marcar_leitor(diretorio)
+                except FileNotFoundError:
+                    if self.atual() == diretorio:
+                        raise
+                    continue
+                # o marcador só protege se a geração ainda era a ativa depois
+                # de ele existir (a recolha vê o marcador ou nós vemos a troca)
+                if self.atual() != diretorio:
+                    if not self._leitores[diretorio]:
+                        self._desmarcar_leitor(diretorio)
+                    continue
+                break
+            self._leitores[diretorio] += 1
+            return Snapshot(self, diretorio, ficheiros[:quantidade], assinatura)
+
+    def _libertar(self, diretorio):
+        with self._lock:
+            self._leitores[diretorio] -= 1
+            if not self._leitores[diretorio]:
+                del self._leitores[diretorio]
+                self._desmarcar_leitor(diretorio)
+                self._livre.notify_all()
+
+    def _marcar_leitor(self, diretorio):
+        # 1a leitura deste processo nesta geração
+        # (a subpasta já vem do trocar; gerações antigas ganham-na aqui)
+        pasta = os.path.join(diretorio, LEITORES)
+        if not os.path.isdir(pasta):
+            os.makedirs(pasta, exist_ok=True)
+        os.close(os.open(os.path.join(pasta, str(os.getpid())), os.O_CREAT | os.O_WRONLY))
+
+    def _desmarcar_leitor(self, diretorio):
+        try:
+            os.remove(os.path.join(diretorio, LEITORES, str(os.getpid())))
+        except FileNotFoundError:
+            pass
+
+    def _leitores_externos(self, diretorio):
+        # outros processos (ainda vivos) com leituras em curso na geração
+        try:
+            pids = [int(nome) for nome in os.listdir(os.path.join(diretorio, LEITORES)) if nome.isdigit()]
+        except FileNotFoundError:
+            return []
+        return [pid for pid in pids if pid != os.getpid() and processo_vivo(pid)]
+
+    # --- troca e recolha de gerações ---
+
+    def trocar(self, manter=(), inicial=False):
+        # cria uma geração nova (vazia, ou só com os ficheiros de 'manter',
+        # ligados com hard links) e passa a apontar para ela
+        # devolve o diretório da geração anterior
+        # 'inicial': só cria o ponteiro se ainda não existir (vários processos
+        # a arrancar ao mesmo tempo); quem perde desfaz a sua geração e
+        # recebe None
+        with self._lock:
+            try:
+                antiga = self.atual()
+            except FileNotFoundError:
+                antiga = self.base
+            numero = max([int(nome[1:]) for nome in os.listdir(self.base) if _e_geracao(nome)], default=0)
+            while True:
+                numero += 1
+                nova = os.path.join(self.base, f"g{numero:06d}")
+                try:
+                    os.mkdir(nova)
+                    break
+                except FileExistsError:
+                    continue  # outro processo criou a mesma geração
+            os.mkdir(os.path.join(nova, LEITORES))
+
+            for ficheiro in manter:
+                try:
+                    os.link(os.path.join(antiga, ficheiro), os.path.join(nova, ficheiro))
+                except OSError:
+                    shutil.copy2(os.path.join(antiga, ficheiro), os.path.join(nova, ficheiro))
+            with open(os.path.join(nova, MANIFESTO), "w", encoding="utf-8") as f:
+                f.writelines(ficheiro + "\n" for ficheiro in manter)
+
+            temporario = os.path.join(self.base, f"{PONTEIRO}.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(temporario, "w", encoding="utf-8") as f:
+                f.write(os.path.basename(nova))
+                f.flush()
+                os.fsync(f.fileno())
+            if inicial:
+                try:
+                    os.link(temporario, os.path.join(self.base, PONTEIRO))
+                except FileExistsError:
+                    shutil.rmtree(nova, ignore_errors=True)
+                    return None
+                finally:
+                    os.remove(temporario)
+            else:
+                os.replace(temporario, os.path.join(self.base, PONTEIRO))
+            print(f"Log: Geração de dados {os.path.basename(nova)} ativada.")
+            return antiga
+
+    def recolher(self, diretorio, depois=None):
+        # apaga uma geração antiga numa thread, quando ninguém a estiver a ler
+        # 'depois' (opcional) corre na mesma thread, já com a geração apagada
+        def apagar():
+            time.sleep(self.espera_recolha)
+            with self._lock:
+                while self._leitores[diretorio]:
+                    self._livre.wait()
+            while diretorio != self.base and self._leitores_externos(diretorio):
+                time.sleep(0.1)
+            with self._lock:
+                self._manifestos.pop(diretorio, None)
+            if diretorio == self.base:
+                # XMLs soltos do layout antigo (as gerações ficam)
+                for nome in os.listdir(diretorio):
+                    if nome.endswith(".xml"):
+                        os.remove(os.path.join(diretorio, nome))
+            else:
+                shutil.rmtree(diretorio, ignore_errors=True)
+            print(f"Log: Geração de dados {os.path.basename(diretorio)} recolhida.")
+            if depois is not None:
+                depois()
+
+        thread = threading.Thread(target=apagar, name="recolha-geracao", daemon=True)
+        self._recolhas.append(thread)
+        thread.start()
+        return thread
+
+    def preparar(self):
+        # ao arrancar: migra o layout antigo, completa o manifesto (ficheiros
+        # gravados mesmo antes de o processo parar) e recolhe gerações órfãs
+        os.makedirs(self.base, exist_ok=True)
+        if not os.path.exists(os.path.join(self.base, PONTEIRO)):
+            soltos = [e for e in os.scandir(self.base) if e.name.endswith(".xml")]
+            soltos.sort(key=lambda e: (e.stat().st_mtime_ns, e.name))
+            self.trocar(manter=[e.name for e in soltos], inicial=True)
+
+        atual = self.atual()
+        registados = set(self._ficheiros(atual))
+        for nome in sorted(os.listdir(atual)):
+            if nome.endswith(".xml") and nome not in registados:
+                self.registar(atual, nome)
+
+        numero_atual = int(os.path.basename(atual)[1:])
+        for nome in os.listdir(self.base):
+            if _e_geracao(nome) and int(nome[1:]) < numero_atual:
+                self.recolher(os.path.join(self.base, nome))
+        if any(nome.endswith(".xml") for nome in os.listdir(self.base)):
+            self.recolher(self.base)
+
+    def aguardar_recolhas(self, timeout=None):
+        for thread in list(self._recolhas):
+            thread.join(timeout)
+        self._recolhas = [t for t in self._recolhas if t.is_alive()]
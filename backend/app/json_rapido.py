@@ -0,0 +1,76 @@
+# serialização JSON rápida para as respostas grandes
+# usa o orjson quando estiver instalado (dependência opcional);
+# sem ele, fica o json da biblioteca padrão
+
+import json
+from flask import Response
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# tamanho (bytes) de cada bloco enviado pelo gerador de arrays JSON
+TAMANHO_BLOCO = 64 * 1024
+
+
+def para_bytes(obj, default=None):
+    # serializa um objeto em JSON compacto (bytes, UTF-8)
+    if orjson is not None:
+        return orjson.dumps(obj, default=default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=default, ensure_ascii=False,
+                      separators=(",", ":")).encode("utf-8")
+
+
+class ProvedorJSONRapido(DefaultJSONProvider):
+    # provider do Flask que troca o json.dumps pelo orjson
+    # (sem indentação nem ordenação de chaves, mesmo em debug)
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            # pedidos com opções do json padrão (ex: indent) seguem o caminho antigo
+            return super().dumps(obj, **kwargs)
+        return para_bytes(obj, default=self.default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(para_bytes(obj, default=self.default),
+                                        mimetype=self.mimetype)
+
+
+def registar(app):
+    # instala o provider rápido na app, se o orjson estiver disponível
+    if orjson is None:
+        print("Log: orjson não instalado, a usar o JSON padrão do Flask.")
+        return False
+    app.json = ProvedorJSONRapido(app)
+    return True
+
+
+def gerar_array_json(itens, tamanho_bloco=TAMANHO_BLOCO):
+    # escreve um array JSON item a item, em blocos de ~tamanho_bloco bytes
+    # a resposta nunca existe inteira em memória como uma única string
+    bloco = bytearray(b"[")
+    primeiro = True
+    for item in itens:
+        if not primeiro:
+            bloco += b","
+        bloco += para_bytes(item, default=DefaultJSONProvider.default)
+        primeiro = False
+        if len(bloco) >= tamanho_bloco:
+            yield bytes(bloco)
+            bloco.clear()
+    bloco += b"]"
+    yield bytes(bloco)
+
+
+def resposta_array_json(itens, status=200):
+    # Response "chunked" com o array JSON gerado aos poucos
+    return Response(gerar_array_json(itens), status=status, mimetype="application/json")
@@ -0,0 +1,228 @@
+# métricas derivadas (VPD, ponto de orvalho, DLI)
+#
+# etapa da ingestão que corre depois das regras de negócio: junta, por
+# estufa, as leituras mais recentes de temperatura, umidadear e
+# luminosidade e calcula as séries derivadas. estas são gravadas como
+# leituras normais (tipos "vpd", "pontoorvalho" e "dli"), por isso
+# aparecem no GET /api/leituras, no estado atual, no CSV e nos alertas, e
+# as regras de cada tipo aplicam-se como a qualquer outro
+#
+# o estado é uma vista em memória sobre os ficheiros do DATA_DIR (ver
+# vista_memoria.py): acompanha cada gravação (inclusive as replicadas de
+# outros nós) e é reconstruído do disco ao arrancar, depois de excluir os
+# dados ou se o DATA_DIR mudar por outra via
+#
+# os IDs derivados começam por PREFIXO_ID ("@<id original>.<tipo>"), um
+# prefixo que os clientes não podem usar (ver validar_regras_negocio)
+#
+# outras métricas: subclasse de MetricaDerivada + registar_metrica()
+
+import math
+from abc import ABC, abstractmethod
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from .motor_regras import data_hora_para_epoch
+from .vista_memoria import VistaMemoria
+from backend.config.settings import (DERIVADAS_JANELA_SEGUNDOS, DERIVADAS_LUX_PARA_PPFD,
+                                     DERIVADAS_DLI_INTERVALO_MAX, DERIVADAS_DLI_FUSO)
+
+PREFIXO_ID = "@"
+
+
+def id_derivado(leitura_id, tipo):
+    return f"{PREFIXO_ID}{leitura_id}.{tipo}"
+
+
+def pressao_saturacao(temperatura):
+    # pressão de saturação do vapor (kPa) a uma temperatura em °C (Magnus-Tetens)
+    return 0.6108 * math.exp(17.27 * temperatura / (temperatura + 237.3))
+
+
+class EstadoEstufa:
+    __slots__ = ("ultimas", "extras")
+
+    def __init__(self):
+        self.ultimas = {}  # tipo -> (instante, valor) da leitura mais recente
+        self.extras = {}   # estado próprio de cada métrica (ex: DLI do dia)
+
+
+class MetricaDerivada(ABC):
+    # tipo e unidade da série derivada e tipos de leitura de que depende
+    tipo = None
+    unidade = ""
+    entradas = ()
+
+    def observar(self, estado, tipo, instante, valor):
+        # chamada (em ordem temporal) para cada leitura nova de uma entrada
+        pass
+
+    @abstractmethod
+    def valor(self, estado, janela):
+        # valor atual da métrica na estufa, ou None se faltarem leituras
+        ...
+
+
+class _MetricaDoAr(MetricaDerivada):
+    entradas = ("temperatura", "umidadear")
+
+    def _ar(self, estado, janela):
+        # temperatura e umidade "co-localizadas": as mais recentes da estufa,
+        # desde que não estejam separadas por mais de 'janela' segundos
+        temperatura = estado.ultimas.get("temperatura")
+        umidade = estado.ultimas.get("umidadear")
+        if temperatura is None or umidade is None or abs(temperatura[0] - umidade[0]) > janela:
+            return None
+        return temperatura[1], min(max(umidade[1], 0.0), 100.0)
+
+
+class DeficitPressaoVapor(_MetricaDoAr):
+    # VPD (kPa) = es(T) * (1 - UR/100)
+    tipo, unidade = "vpd", "kPa"
+
+    def valor(self, estado, janela):
+        ar = self._ar(estado, janela)
+        if ar is None:
+            return None
+        temperatura, umidade = ar
+        return pressao_saturacao(temperatura) * (1 - umidade / 100)
+
+
+class PontoOrvalho(_MetricaDoAr):
+    # fórmula de Magnus invertida (°C)
+    tipo, unidade = "pontoorvalho", "°C"
+
+    def valor(self, estado, janela):
+        ar = self._ar(estado, janela)
+        if ar is None or ar[1] <= 0:
+            return None
+        temperatura, umidade = ar
+        gama = math.log(umidade / 100) + 17.27 * temperatura / (temperatura + 237.3)
+        return 237.3 * gama / (17.27 - gama)
+
+
+class IntegralLuzDiaria(MetricaDerivada):
+    # DLI (mol/m²/dia): a luminosidade (lux) é convertida em PPFD
+    # (µmol/m²/s) e integrada pela regra dos trapézios entre leituras
+    # consecutivas do mesmo dia (no fuso 'fuso', por omissão UTC); um
+    # intervalo maior do que 'intervalo_max' (sensor parado) não entra na soma
+    # o valor é o acumulado do dia até à última leitura
+    tipo, unidade = "dli", "mol/m²/d"
+    entradas = ("luminosidade",)
+
+    def __init__(self, lux_para_ppfd=DERIVADAS_LUX_PARA_PPFD, intervalo_max=DERIVADAS_DLI_INTERVALO_MAX,
+                 fuso=DERIVADAS_DLI_FUSO):
+        self.lux_para_ppfd = lux_para_ppfd
+        self.intervalo_max = intervalo_max
+        self.fuso = ZoneInfo(fuso)
+
+    def dia(self, instante):
+        return datetime.fromtimestamp(instante, self.fuso).date().toordinal()
+
+    def observar(self, estado, tipo, instante, valor):
+        dia = self.dia(instante)
+        ppfd = valor * self.lux_para_ppfd
+        acumulado = 0.0
+        anterior = estado.extras.get(self.tipo)  # (dia, acumulado, instante, ppfd)
+        if anterior is not None and anterior[0] == dia:
+            _, acumulado, instante_anterior, ppfd_anterior = anterior
+            if instante - instante_anterior <= self.intervalo_max:
+                acumulado += (ppfd_anterior + ppfd) / 2 * (instante - instante_anterior) / 1e6
+        estado.extras[self.tipo] = (dia, acumulado, instante, ppfd)
+
+    def valor(self, estado, janela):
+        dli = estado.extras.get(self.tipo)
+        return dli[1] if dli is not None else None
+
+
+# métricas calculadas na ingestão, por tipo
+METRICAS = {}
+
+
+def registar_metrica(metrica):
+    METRICAS[metrica.tipo] = metrica
+    return metrica
+
+
+for _metrica in (DeficitPressaoVapor(), PontoOrvalho(), IntegralLuzDiaria()):
+    registar_metrica(_metrica)
+
+
+class MetricasDerivadas(VistaMemoria):
+
+    def __init__(self, metricas=None, janela=DERIVADAS_JANELA_SEGUNDOS):
+        self.metricas = METRICAS if metricas is None else metricas
+        self.janela = janela
+        super().__init__()
+
+    def _limpar(self):
+        self._estufas = {}  # estufa_id -> EstadoEstufa
+
+    def registar(self, documento, assinatura_antes, assinatura_depois):
+        # ao contrário das outras vistas, o documento entra sempre: o estado
+        # de cada estufa só avança com leituras mais recentes, por isso a
+        # ingestão pode continuar a derivar de uma vista desatualizada
+        # enquanto esta é recarregada em segundo plano (ver service_xml)
+        with self._lock:
+            sincronizada = self.sincronizado(assinatura_antes)
+            self._incluir(documento)
+            self.assinatura = assinatura_depois if sincronizada else None
+
+    def nova(self):
+        return MetricasDerivadas(self.metricas, self.janela)
+
+    def _adicionar_documento(self, documento):
+        estado = self._estufas.get(documento["estufa_id"])
+        if estado is None:
+            estado = self._estufas[documento["estufa_id"]] = EstadoEstufa()
+
+        leituras = sorted(((data_hora_para_epoch(data_hora), documento["sensores"].get(sensor_id), valor)
+                           for _, data_hora, sensor_id, valor in documento["leituras"]),
+                          key=lambda leitura: leitura[0])
+        for instante, tipo, valor in leituras:
+            metricas = [m for m in self.metricas.values() if tipo in m.entradas]
+            if not metricas:
+                continue
+            ultima = estado.ultimas.get(tipo)
+            if ultima is not None and instante <= ultima[0]:
+                continue  # chegou fora de ordem (ou repetida)
+            estado.ultimas[tipo] = (instante, valor)
+            for metrica in metricas:
+                metrica.observar(estado, tipo, instante, valor)
+
+    def derivar(self, documento):
+        # documento com as leituras derivadas de um documento já incluído na
+        # vista (mesmo formato do _extrair_documento), ou None
+        # cada métrica afetada dá uma leitura, na dataHora da leitura de
+        # entrada mais recente do documento; um documento que só traz
+        # leituras mais antigas do que as já vistas não gera nada
+        base = documento["leituras"][0][0]
+        sensores, unidades, leituras = {}, {}, []
+        with self._lock:
+            estado = self._estufas.get(documento["estufa_id"])
+            if estado is None:
+                return None
+
+            recentes = {}  # tipo -> dataHora, se a leitura do documento é a última da estufa
+            for _, data_hora, sensor_id, _ in documento["leituras"]:
+                tipo = documento["sensores"].get(sensor_id)
+                ultima = estado.ultimas.get(tipo)
+                if ultima is not None and data_hora_para_epoch(data_hora) == ultima[0]:
+                    recentes[tipo] = data_hora
+
+            for metrica in self.metricas.values():
+                datas_hora = [recentes[tipo] for tipo in metrica.entradas if tipo in recentes]
+                if not datas_hora:
+                    continue
+                valor = metrica.valor(estado, self.janela)
+                if valor is None:
+                    continue
+                sensor_id = f"derivado-{metrica.tipo}"
+                sensores[sensor_id] = metrica.tipo
+                unidades[sensor_id] = metrica.unidade
+                leituras.append((id_derivado(base, metrica.tipo), max(datas_hora, key=data_hora_para_epoch),
+                                 sensor_id, round(valor, 4)))
+
+        if not leituras:
+            return None
+        return {"estufa_id": documento["estufa_id"], "sensores": sensores, "unidades": unidades,
+                "leituras": leituras, "limites": {}}
@@ -0,0 +1,373 @@
+# motor de regras de negócio
+# avalia as leituras em lote (vetorizado com numpy) em vez de
+# fazer um lookup + comparação num loop python para cada leitura
+#
+# além do "min"/"max", cada tipo pode ter regras com estado:
+#   "histerese":   largura da banda para sair do alerta (evita alertas
+#                  a piscar quando o sensor oscila em cima do limite)
+#   "taxa_max":    variação máxima permitida por minuto
+#   "duracao_min": minutos fora da faixa antes de gerar o alerta
+# estas são avaliadas leitura a leitura com um pequeno estado por sensor
+
+import re
+from array import array
+from datetime import datetime, timezone
+import numpy as np
+
+CHAVES_INCREMENTAIS = ("histerese", "taxa_max", "duracao_min")
+
+
+class LoteLeituras:
+    # lote colunar de leituras: código da regra (int32) e valor (float64)
+    # cada código é uma combinação (tipo, regra resolvida) - ver TabelaRegras
+    # os restantes campos (sensor, dataHora, ids...) ficam em listas
+    # paralelas e só são usados pelas regras com estado e para montar
+    # a resposta das leituras em alerta
+
+    def __init__(self):
+        self.tipos = []   # código -> tipo (ex: 0 -> "temperatura")
+        self.regras = []  # código -> regra resolvida (ou None)
+        self._codigo_por_chave = {}
+        self._codigos = array('i')
+        self._valores = array('d')
+        self.chaves = []  # (estufa_id, sensor_id) de cada leitura
+        self.datas_hora = []
+        self.metadados = []
+
+    def __len__(self):
+        return len(self._valores)
+
+    def codigo(self, tipo, regra):
+        # devolve o código de (tipo, regra), criando-o se for novo
+        # chamado uma vez por sensor de cada documento, não por leitura
+        chave = (tipo, _congelar(regra))
+        codigo = self._codigo_por_chave.get(chave)
+        if codigo is None:
+            codigo = len(self.tipos)
+            self._codigo_por_chave[chave] = codigo
+            self.tipos.append(tipo)
+            self.regras.append(regra)
+        return codigo
+
+    def adicionar(self, codigo, valor, chave=None, data_hora=None, metadado=None):
+        self._codigos.append(codigo)
+        self._valores.append(valor)
+        self.chaves.append(chave)
+        self.datas_hora.append(data_hora)
+        self.metadados.append(metadado)
+
+    def adicionar_documento(self, documento, tabela_regras, ficheiro=None):
+        # acrescenta ao lote todas as leituras de um documento extraído
+        # a regra de cada sensor é resolvida uma vez (global -> estufa -> sensor)
+        # e cada leitura só precisa de um lookup pelo sensorRef
+        estufa_id = documento["estufa_id"]
+        sensor_map = documento["sensores"]
+        regras_documento = tabela_regras.compilar_documento(
+            estufa_id, sensor_map, documento.get("limites"))
+        codigos = {sensor_id: self.codigo(sensor_map[sensor_id], regra)
+                   for sensor_id, regra in regras_documento.items()}
+
+        for leitura_id, data_hora, sensor_ref_id, valor in documento["leituras"]:
+            codigo = codigos.get(sensor_ref_id)
+            if codigo is None:
+                # sensorRef sem <sensor> declarado: sem tipo, sem regra
+                codigo = self.codigo(None, None)
+            self.adicionar(codigo, valor,
+                           chave=(estufa_id, sensor_ref_id),
+                           data_hora=data_hora,
+                           metadado=(leitura_id, ficheiro))
+
+    def codigos(self):
+        return np.frombuffer(self._codigos, dtype=np.int32)
+
+    def valores(self):
+        return np.frombuffer(self._valores, dtype=np.float64)
+
+    def avaliar(self):
+        # devolve os índices (em ordem) das leituras fora da faixa
+        # considera só as regras estáticas (sem histerese/taxa/duração)
+        if not len(self):
+            return np.empty(0, dtype=np.intp)
+        minimos, maximos = limites_por_codigo(self.regras)
+        mascara = mascara_fora_da_faixa(self.codigos(), self.valores(), minimos, maximos)
+        return np.flatnonzero(mascara)
+
+    def avaliar_com_estado(self, avaliador):
+        # avalia o lote inteiro: regras estáticas de forma vetorizada e
+        # regras com estado leitura a leitura, em ordem temporal por sensor
+        # devolve uma lista de (indice, motivo) ordenada pelo índice
+        resultados = [(int(indice), "faixa") for indice in self.avaliar()]
+        incrementais = self.avaliar_incrementais(avaliador)
+        if incrementais:
+            resultados.extend(incrementais)
+            resultados.sort(key=lambda resultado: resultado[0])
+        return resultados
+
+    def indices_incrementais(self):
+        # índices das leituras cujas regras têm estado
+        codigos_incrementais = [codigo for codigo, regra in enumerate(self.regras)
+                                if regra and regra_incremental(regra)]
+        if not codigos_incrementais:
+            return np.empty(0, dtype=np.intp)
+        return np.flatnonzero(np.isin(self.codigos(), codigos_incrementais))
+
+    def avaliar_incrementais(self, avaliador):
+        # só as regras com estado (avança o estado do avaliador)
+        # devolve uma lista de (indice, motivo) em ordem temporal por sensor
+        resultados = []
+        codigos, valores = self.codigos(), self.valores()
+        instantes = {int(i): data_hora_para_epoch(self.datas_hora[i]) for i in self.indices_incrementais()}
+        for indice in sorted(instantes, key=lambda i: (self.chaves[i], instantes[i], i)):
+            regra = self.regras[codigos[indice]]
+            for motivo in avaliador.avaliar(self.chaves[indice], regra,
+                                            instantes[indice], float(valores[indice])):
+                resultados.append((indice, motivo))
+        return resultados
+
+
+def limites_por_codigo(regras):
+    # vetores de min/max alinhados com os códigos do lote
+    # códigos sem regra (ou com regra com estado) ficam com (-inf, +inf)
+    # e nunca geram alerta na avaliação vetorizada
+    minimos = np.full(len(regras), -np.inf)
+    maximos = np.full(len(regras), np.inf)
+    for codigo, regra in enumerate(regras):
+        if regra and not regra_incremental(regra):
+            minimos[codigo] = regra.get('min', -np.inf)
+            maximos[codigo] = regra.get('max', np.inf)
+    return minimos, maximos
+
+
+def mascara_fora_da_faixa(codigos, valores, minimos, maximos):
+    # "broadcast" dos limites de cada código sobre as suas leituras
+    # (equivalente a: not (min <= valor <= max) para cada leitura)
+    return (valores < minimos[codigos]) | (valores > maximos[codigos])
+
+
+def _congelar(regra):
+    # versão "hashable" de uma regra, para usar como chave de dicionário
+    # (os valores também podem ser dicts ou listas, por isso é recursiva)
+    return _congelar_valor(regra) if regra else None
+
+
+def _congelar_valor(valor):
+    if isinstance(valor, dict):
+        return tuple(sorted((chave, _congelar_valor(v)) for chave, v in valor.items()))
+    if isinstance(valor, (list, tuple)):
+        return tuple(_congelar_valor(v) for v in valor)
+    return valor
+
+
+def faixa_ideal(regra):
+    # texto da faixa de uma regra, ex: "4.0 - 6.0", ">= 4.0" ou "<= 6.0"
+    minimo, maximo = regra.get('min'), regra.get('max')
+    if minimo is None:
+        return None if maximo is None else f"<= {maximo}"
+    if maximo is None:
+        return f">= {minimo}"
+    return f"{minimo} - {maximo}"
+
+
+def validar_regras(regras):
+    # verifica a forma das regras antes de serem gravadas (ou usadas):
+    #   {tipo: regra, ..., "estufas": {estufa_id: {"tipos": {tipo: regra},
+    #                                              "sensores": {sensor_id: regra}}}}
+    # cada regra é um objeto com valores numéricos em "min", "max" e nas
+    # CHAVES_INCREMENTAIS; levanta ValueError a dizer onde está o problema
+    _exigir_objeto(regras, "as regras")
+    for tipo, regra in regras.items():
+        if tipo == "estufas":
+            continue
+        _validar_regra(regra, f"'{tipo}'")
+    estufas = regras.get("estufas")
+    if estufas is None:
+        return
+    _exigir_objeto(estufas, "'estufas'")
+    for estufa_id, estufa in estufas.items():
+        _exigir_objeto(estufa, f"'estufas/{estufa_id}'")
+        for camada in ("tipos", "sensores"):
+            if estufa.get(camada) is None:
+                continue
+            _exigir_objeto(estufa[camada], f"'estufas/{estufa_id}/{camada}'")
+            for chave, regra in estufa[camada].items():
+                _validar_regra(regra, f"'estufas/{estufa_id}/{camada}/{chave}'")
+
+
+def _validar_regra(regra, onde):
+    _exigir_objeto(regra, onde)
+    for chave in ("min", "max") + CHAVES_INCREMENTAIS:
+        valor = regra.get(chave)
+        if valor is None:
+            continue
+        if isinstance(valor, bool) or not isinstance(valor, (int, float)) or valor != valor:
+            raise ValueError(f"{onde}: '{chave}' tem de ser um número.")
+        if chave in CHAVES_INCREMENTAIS and valor < 0:
+            raise ValueError(f"{onde}: '{chave}' não pode ser negativo.")
+    if regra.get("min") is not None and regra.get("max") is not None and regra["min"] > regra["max"]:
+        raise ValueError(f"{onde}: 'min' é maior do que 'max'.")
+
+
+def _exigir_objeto(valor, onde):
+    if not isinstance(valor, dict):
+        raise ValueError(f"{onde} tem de ser um objeto JSON.")
+
+
+class TabelaRegras:
+    # regras em camadas, da mais geral para a mais específica:
+    #   global (por tipo) -> <configuracoes> do próprio documento
+    #   -> "estufas"/<id>/"tipos" -> "estufas"/<id>/"sensores"/<id>
+    # cada camada só precisa de indicar as chaves que muda (ex: só "max")
+    # as combinações já resolvidas ficam numa tabela plana, por isso cada
+    # sensor de um documento custa um único lookup depois da 1a vez
+
+    def __init__(self, regras):
+        self.globais = {tipo: regra for tipo, regra in regras.items() if tipo != "estufas"}
+        self.estufas = regras.get("estufas") or {}
+        self._tabela = {}
+
+    def regra(self, estufa_id, sensor_id, tipo, limites_documento=None):
+        limite_documento = (limites_documento or {}).get(tipo)
+        chave = (estufa_id, sensor_id, tipo, _congelar(limite_documento))
+        try:
+            return self._tabela[chave]
+        except KeyError:
+            pass
+
+        estufa = self.estufas.get(estufa_id) or {}
+        camadas = [self.globais.get(tipo),
+                   limite_documento,
+                   (estufa.get("tipos") or {}).get(tipo),
+                   (estufa.get("sensores") or {}).get(sensor_id)]
+
+        regra = None
+        for camada in camadas:
+            if camada:
+                regra = {**(regra or {}), **camada}
+
+        self._tabela[chave] = regra
+        return regra
+
+    def compilar_documento(self, estufa_id, sensor_map, limites_documento=None):
+        # devolve {sensor_id: regra} para todos os sensores de um documento
+        return {sensor_id: self.regra(estufa_id, sensor_id, tipo, limites_documento)
+                for sensor_id, tipo in sensor_map.items()}
+
+
+def regra_incremental(regra):
+    # a regra precisa de estado por sensor?
+    return any(regra.get(chave) for chave in CHAVES_INCREMENTAIS)
+
+
+def faixa_com_estado(regra):
+    # a faixa (min/max) da regra depende das leituras anteriores?
+    return bool(regra.get('histerese') or regra.get('duracao_min'))
+
+
+_XS_DATE_TIME = re.compile(
+    r"(-?\d{4,}-\d{2}-\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?(Z|[+-]\d{2}:\d{2})?")
+
+
+def data_hora_para_epoch(data_hora):
+    # converte um xs:dateTime (ex: "2025-11-10T14:30:00") em segundos
+    # datas sem fuso horário são tratadas como UTC
+    # o fromisoformat não aceita tudo o que o XSD aceita: "24:00:00" (fim
+    # do dia) e mais de 6 casas decimais nos segundos, por isso estes
+    # casos são normalizados antes; anos fora de 0001-9999 (válidos no
+    # XSD) não têm conversão e dão ValueError
+    encontrado = _XS_DATE_TIME.fullmatch(data_hora.strip())
+    if encontrado is None:
+        raise ValueError(f"dataHora inválida: '{data_hora}'")
+    data, horas, minutos, segundos, fracao, fuso = encontrado.groups()
+    if not 1 <= int(data[:-6]) <= 9999:
+        raise ValueError(f"dataHora fora do intervalo suportado (anos 0001 a 9999): '{data_hora}'")
+    fim_do_dia = horas == "24"
+    if fim_do_dia:
+        horas = "00"
+    texto = f"{data}T{horas}:{minutos}:{segundos}"
+    if fracao:
+        texto += "." + fracao[:6].ljust(6, "0")
+    if fuso and fuso != "Z":
+        texto += fuso
+    instante = datetime.fromisoformat(texto)
+    if instante.tzinfo is None:
+        instante = instante.replace(tzinfo=timezone.utc)
+    return instante.timestamp() + (86400 if fim_do_dia else 0)
+
+
+class EstadoSensor:
+    # estado mínimo guardado por sensor para as regras incrementais
+    __slots__ = ("em_alerta", "inicio_fora", "ultimo_instante", "ultimo_valor")
+
+    def __init__(self):
+        self.em_alerta = False
+        self.inicio_fora = None
+        self.ultimo_instante = None
+        self.ultimo_valor = None
+
+
+class AvaliadorIncremental:
+    # avalia as regras com estado em O(1) por leitura, sem reler o histórico
+    # o estado fica em memória, indexado por (estufa_id, sensor_id)
+
+    def __init__(self):
+        self.estados = {}
+
+    def exportar(self):
+        # estado serializável em JSON (checkpoint da reavaliação)
+        return [[estufa_id, sensor_id, e.em_alerta, e.inicio_fora, e.ultimo_instante, e.ultimo_valor]
+                for (estufa_id, sensor_id), e in self.estados.items()]
+
+    def importar(self, dados):
+        for estufa_id, sensor_id, em_alerta, inicio_fora, ultimo_instante, ultimo_valor in dados:
+            estado = self.estados[(estufa_id, sensor_id)] = EstadoSensor()
+            estado.em_alerta = em_alerta
+            estado.inicio_fora = inicio_fora
+            estado.ultimo_instante = ultimo_instante
+            estado.ultimo_valor = ultimo_valor
+
+    def avaliar(self, chave, regra, instante, valor):
+        # devolve os motivos dos alertas disparados por ESTA leitura
+        # ("faixa", "duracao" ou "taxa"); leituras mais antigas do que a
+        # última vista para o sensor não mexem no estado (chegaram fora de
+        # ordem) e só contam para a faixa, se esta não tiver estado
+        minimo, maximo = regra.get('min', float('-inf')), regra.get('max', float('inf'))
+        histerese = regra.get('histerese') or 0
+        duracao = (regra.get('duracao_min') or 0) * 60
+        # sem histerese nem duração a faixa não tem estado: como nas regras
+        # estáticas, cada leitura fora dela gera o seu alerta
+        faixa_sem_estado = not faixa_com_estado(regra)
+        motivos = ["faixa"] if faixa_sem_estado and not minimo <= valor <= maximo else []
+
+        estado = self.estados.get(chave)
+        if estado is None:
+            estado = self.estados[chave] = EstadoSensor()
+        elif instante <= estado.ultimo_instante:
+            return motivos
+
+        # 1. faixa com histerese e duração mínima
+        if faixa_sem_estado:
+            pass  # já avaliada acima
+        elif estado.em_alerta:
+            # só sai do alerta quando voltar para dentro da banda
+            if minimo + histerese <= valor <= maximo - histerese:
+                estado.em_alerta = False
+        elif minimo <= valor <= maximo:
+            estado.inicio_fora = None
+        else:
+            if estado.inicio_fora is None:
+                estado.inicio_fora = instante
+            if instante - estado.inicio_fora >= duracao:
+                estado.em_alerta = True
+                estado.inicio_fora = None
+                motivos.append("duracao" if duracao else "faixa")
+
+        # 2. taxa de variação (por minuto) desde a leitura anterior
+        taxa_max = regra.get('taxa_max')
+        if taxa_max and estado.ultimo_instante is not None:
+            minutos = (instante - estado.ultimo_instante) / 60
+            if abs(valor - estado.ultimo_valor) / minutos > taxa_max:
+                motivos.append("taxa")
+
+        estado.ultimo_instante = instante
+        estado.ultimo_valor = valor
+        return motivos
@@ -0,0 +1,325 @@
+# replicação das leituras entre vários nós (instâncias do backend)
+#
+# cada nó grava no seu próprio DATA_DIR e acrescenta cada alteração local
+# (leitura criada, leituras excluídas) a um registo "append-only". os
+# outros nós leem esse registo por HTTP (GET /api/replicacao/alteracoes)
+# a partir da última posição aplicada e repetem as alterações localmente,
+# por isso todos acabam com os mesmos ficheiros (consistência eventual) e
+# qualquer nó pode responder às leituras.
+#
+# o 409 (ID duplicado) vale para o cluster inteiro: cada ID de leitura tem
+# um nó responsável (hash do ID sobre a lista de nós) que reserva o ID de
+# forma atómica antes de o ficheiro ser gravado em qualquer nó.
+# cada reserva leva o dono (o pedido que a fez) e a hora: se a gravação
+# falhar o dono desfaz a reserva, e uma reserva que ficou para trás (o
+# processo morreu a meio) é recuperada ao fim de 'validade' segundos se a
+# leitura não tiver chegado entretanto (a validade tem de ser bem maior do
+# que o atraso da replicação).
+
+import hmac
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import zlib
+from array import array
+
+
+# cabeçalho com o segredo do cluster, enviado em todos os pedidos entre nós
+CABECALHO_SEGREDO = "X-Estufa-Cluster"
+
+
+class NoIndisponivel(Exception):
+    pass
+
+
+class RegistoAlteracoes:
+    # ficheiro JSON lines: uma alteração por linha, com "seq" crescente
+    # os offsets de cada linha ficam em memória para ler a partir de um seq
+    # sem percorrer o ficheiro desde o início
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._lock = threading.Lock()
+        self._offsets = array('q')  # seq n começa no byte _offsets[n - 1]
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        tamanho = 0
+        try:
+            with open(caminho, "rb") as f:
+                for linha in f:
+                    if not linha.endswith(b"\n"):
+                        break  # última linha incompleta (processo parou a meio)
+                    self._offsets.append(tamanho)
+                    tamanho += len(linha)
+        except FileNotFoundError:
+            pass
+        self._tamanho = tamanho
+        with open(caminho, "ab") as f:
+            f.truncate(tamanho)
+
+    @property
+    def ultimo_seq(self):
+        return len(self._offsets)
+
+    def acrescentar(self, alteracao):
+        # grava a alteração (com fsync) e devolve o seu seq
+        with self._lock:
+            seq = len(self._offsets) + 1
+            linha = json.dumps(dict(alteracao, seq=seq)).encode("utf-8") + b"\n"
+            with open(self.caminho, "ab") as f:
+                f.write(linha)
+                f.flush()
+                os.fsync(f.fileno())
+            self._offsets.append(self._tamanho)
+            self._tamanho += len(linha)
+            return seq
+
+    def ler(self, desde=0, limite=500):
+        # alterações com seq > desde (no máximo 'limite')
+        with self._lock:
+            if desde >= len(self._offsets):
+                return []
+            inicio = self._offsets[desde]
+            fim = self._offsets[desde + limite] if desde + limite < len(self._offsets) else self._tamanho
+        with open(self.caminho, "rb") as f:
+            f.seek(inicio)
+            dados = f.read(fim - inicio)
+        return [json.loads(linha) for linha in dados.splitlines()]
+
+
+class Cluster:
+    # configuração do cluster: este nó e os outros {id: url}
+    # sem pares configurados, o nó funciona sozinho (como antes)
+
+    def __init__(self, no_id, pares, diretorio, timeout=2.0, validade=300.0, segredo=""):
+        self.no_id = no_id
+        self.pares = dict(pares)
+        self.segredo = segredo
+        self.nos = sorted([no_id, *self.pares])
+        self.diretorio = diretorio
+        self.timeout = timeout
+        self.validade = validade
+        self.registo = RegistoAlteracoes(os.path.join(diretorio, "alteracoes.jsonl"))
+        self._reservas = os.path.join(diretorio, "reservas")
+        self._posicoes_path = os.path.join(diretorio, "posicoes.json")
+        self._replicacao = None  # thread que segue os pares (ver iniciar)
+        self._lock = threading.Lock()
+        os.makedirs(self._reservas, exist_ok=True)
+
+    @property
+    def ativo(self):
+        return bool(self.pares)
+
+    def autorizado(self, segredo):
+        # só os pares (com o mesmo segredo) usam as rotas de replicação;
+        # sem segredo configurado nenhum pedido é aceite
+        return bool(self.segredo) and segredo is not None and hmac.compare_digest(
+            segredo.encode("utf-8"), self.segredo.encode("utf-8"))
+
+    def _pedido(self, url, metodo="GET"):
+        return urllib.request.Request(url, method=metodo, headers={CABECALHO_SEGREDO: self.segredo})
+
+    def no_responsavel(self, leitura_id):
+        # hash estável (igual em todos os nós e processos)
+        return self.nos[zlib.crc32(leitura_id.encode("utf-8")) % len(self.nos)]
+
+    # --- reservas de IDs (409 no cluster) ---
+
+    def novo_dono(self):
+        # identifica um pedido de reserva (único no cluster)
+        return f"{self.no_id}-{uuid.uuid4().hex}"
+
+    def _url_reserva(self, responsavel, leitura_id, dono):
+        return (f"{self.pares[responsavel]}/api/replicacao/reservas/{urllib.parse.quote(leitura_id)}"
+                f"?{urllib.parse.urlencode({'dono': dono})}")
+
+    def _caminho_reserva(self, leitura_id):
+        return os.path.join(self._reservas, urllib.parse.quote(leitura_id, safe=""))
+
+    def reservar(self, leitura_id, dono):
+        # True se o ID ficou reservado para este pedido, False se já existe
+        # no cluster; NoIndisponivel se o nó responsável não responder
+        if not self.ativo:
+            return True
+        responsavel = self.no_responsavel(leitura_id)
+        if responsavel == self.no_id:
+            return self.reservar_local(leitura_id, dono)
+        url = self._url_reserva(responsavel, leitura_id, dono)
+        try:
+            with urllib.request.urlopen(self._pedido(url, "POST"), timeout=self.timeout):
+                return True
+        except urllib.error.HTTPError as e:
+            if e.code == 409:
+                return False
+            raise NoIndisponivel(f"nó {responsavel} respondeu {e.code}")
+        except (urllib.error.URLError, OSError) as e:
+            raise NoIndisponivel(f"nó {responsavel} indisponível: {e}")
+
+    def desfazer_reserva(self, leitura_id, dono):
+        # a gravação falhou: o ID volta a ficar livre no cluster
+        # se o nó responsável não responder, a reserva expira sozinha
+        if not self.ativo:
+            return
+        responsavel = self.no_responsavel(leitura_id)
+        if responsavel == self.no_id:
+            self.desfazer_reserva_local(leitura_id, dono)
+            return
+        url = self._url_reserva(responsavel, leitura_id, dono)
+        try:
+            with urllib.request.urlopen(self._pedido(url, "DELETE"), timeout=self.timeout):
+                pass
+        except (urllib.error.URLError, OSError) as e:
+            print(f"Log: Reserva de {leitura_id} não desfeita no nó {responsavel} (expira sozinha): {e}")
+
+    def reservar_local(self, leitura_id, dono, existe=False):
+        # criação exclusiva do ficheiro de reserva: só um pedido ganha,
+        # mesmo com vários processos; 'existe' indica que o ficheiro já
+        # está no DATA_DIR deste nó (ex: gravado antes da replicação)
+        caminho = self._caminho_reserva(leitura_id)
+        while True:
+            try:
+                descritor = os.open(caminho, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if existe or not self._recuperar_expirada(caminho):
+                    return False
+                continue  # volta a concorrer pela criação exclusiva
+            with os.fdopen(descritor, "w", encoding="utf-8") as f:
+                json.dump({"dono": dono, "em": time.time()}, f)
+            return not existe
+
+    def desfazer_reserva_local(self, leitura_id, dono):
+        # só o dono desfaz a sua reserva (não a de quem a recuperou depois)
+        caminho = self._caminho_reserva(leitura_id)
+        reserva = self._ler_reserva(caminho)
+        if reserva is not None and reserva.get("dono") == dono:
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+
+    def _ler_reserva(self, caminho):
+        # {"dono", "em"}; None se não existir, {} se estiver vazia/incompleta
+        # (acabada de criar, ou de uma versão sem donos)
+        try:
+            with open(caminho, "r", encoding="utf-8") as f:
+                return json.loads(f.read() or "{}")
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            return {}
+
+    def _recuperar_expirada(self, caminho):
+        # tira do caminho uma reserva expirada; devolve True se o fez
+        # a reserva é primeiro mudada de nome (só um pedido consegue) e só
+        # depois verificada: se entretanto foi trocada por uma nova, volta
+        # para o sítio
+        reserva = self._ler_reserva(caminho)
+        if reserva is None:
+            return True  # já foi libertada
+        if not self._expirada(reserva, caminho):
+            return False
+        recuperada = f"{caminho}.{uuid.uuid4().hex}.expirada"
+        try:
+            os.rename(caminho, recuperada)
+        except FileNotFoundError:
+            return True
+        try:
+            if self._expirada(self._ler_reserva(recuperada) or {}, recuperada):
+                return True
+            try:
+                os.link(recuperada, caminho)
+            except FileExistsError:
+                pass
+            return False
+        finally:
+            os.remove(recuperada)
+
+    def _expirada(self, reserva, caminho):
+        # reservas sem hora (vazias) contam pela data do ficheiro
+        em = reserva.get("em")
+        try:
+            if em is None:
+                em = os.path.getmtime(caminho)
+        except OSError:
+            return False
+        return time.time() - em > self.validade
+
+    def libertar(self, leituras_ids, antes_de=None):
+        # IDs excluídos podem voltar a ser usados; com 'antes_de' só saem as
+        # reservas feitas antes desse instante (a exclusão), não as de
+        # leituras com o mesmo ID enviadas depois
+        # devolve quantas reservas foram libertadas
+        libertadas = 0
+        for leitura_id in leituras_ids:
+            caminho = self._caminho_reserva(leitura_id)
+            if antes_de is not None:
+                reserva = self._ler_reserva(caminho)
+                if reserva is None or reserva.get("em", 0) >= antes_de:
+                    continue
+            try:
+                os.remove(caminho)
+                libertadas += 1
+            except FileNotFoundError:
+                pass
+        return libertadas
+
+    # --- replicação ---
+
+    def posicoes(self):
+        # último seq aplicado de cada par
+        try:
+            with open(self._posicoes_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _gravar_posicoes(self, posicoes):
+        # temporário próprio: outro processo do mesmo nó pode estar a gravar
+        temporario = f"{self._posicoes_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporario, "w", encoding="utf-8") as f:
+            json.dump(posicoes, f)
+        os.replace(temporario, self._posicoes_path)
+
+    def sincronizar(self, aplicar, limite=500):
+        # aplica as alterações novas de cada par; devolve quantas aplicou
+        # um par indisponível é ignorado até à próxima volta
+        posicoes = self.posicoes()
+        aplicadas = 0
+        for par, url in self.pares.items():
+            while True:
+                desde = posicoes.get(par, 0)
+                pedido = self._pedido(f"{url}/api/replicacao/alteracoes?desde={desde}&limite={limite}")
+                try:
+                    with urllib.request.urlopen(pedido, timeout=self.timeout) as resposta:
+                        alteracoes = json.load(resposta)["alteracoes"]
+                except (urllib.error.URLError, OSError, ValueError, KeyError) as e:
+                    print(f"Log: Replicação de {par} adiada: {e}")
+                    break
+                for alteracao in alteracoes:
+                    aplicar(alteracao)
+                    posicoes[par] = alteracao["seq"]
+                    aplicadas += 1
+                self._gravar_posicoes(posicoes)
+                if len(alteracoes) < limite:
+                    break
+        return aplicadas
+
+    def iniciar(self, aplicar, intervalo):
+        # segue os registos dos pares numa thread em segundo plano
+        # só uma por processo, mesmo que a app seja criada várias vezes
+        def ciclo():
+            while True:
+                try:
+                    self.sincronizar(aplicar)
+                except Exception as e:
+                    print(f"Erro na replicação: {e}")
+                time.sleep(intervalo)
+
+        with self._lock:
+            if self.ativo and self._replicacao is None:
+                self._replicacao = threading.Thread(target=ciclo, name=f"replicacao-{self.no_id}", daemon=True)
+                self._replicacao.start()
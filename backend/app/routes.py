@@ -3,12 +3,21 @@
 from flask import Flask, jsonify
 import flask_cors
 from werkzeug.exceptions import HTTPException
-from . import controller
+from . import controller, json_rapido, compressao, service_xml, admissao
 
 
 def create_app():
     app = Flask(__name__)
-    flask_cors.CORS(app)
+    # os headers próprios da API ficam visíveis ao JavaScript do frontend
+    flask_cors.CORS(app, expose_headers=["X-Snapshot", "X-Proximo-Cursor", "X-Versao-Regras", "Retry-After"])
+    # JSON rápido (orjson) para o jsonify, se estiver instalado
+    json_rapido.registar(app)
+    # limite por gateway e classes de prioridade, antes de ler o corpo
+    admissao.registar(app)
+    # compressão gzip/br/zstd conforme o Accept-Encoding do cliente
+    compressao.registar(app)
+    # réplicas: segue os registos de alterações dos outros nós
+    service_xml.iniciar_replicacao()
 
     # --- Rotas POST ---
     @app.route('/api/leituras', methods=['POST'])
@@ -19,6 +28,14 @@ def create_app():
     def rota_resetar_configuracoes():
         return controller.resetar_configuracoes()
 
+    @app.route('/api/replicacao/reservas/<leitura_id>', methods=['POST'])
+    def rota_reservar_leitura(leitura_id):
+        return controller.reservar_leitura(leitura_id)
+
+    @app.route('/api/configuracoes/reavaliacao', methods=['POST'])
+    def rota_iniciar_reavaliacao():
+        return controller.iniciar_reavaliacao()
+
     # -- Rotas GET --
     @app.route('/api/leituras', methods=['GET'])
     def rota_listar_leituras():
@@ -28,10 +45,22 @@ def create_app():
     def rota_listar_alertas():
         return controller.listar_alertas()
 
+    @app.route('/api/estado-atual', methods=['GET'])
+    def rota_listar_estado_atual():
+        return controller.listar_estado_atual()
+
+    @app.route('/api/replicacao/alteracoes', methods=['GET'])
+    def rota_listar_alteracoes():
+        return controller.listar_alteracoes()
+
     @app.route('/api/configuracoes', methods=['GET'])
     def rota_listar_configurcoes():
         return controller.listar_configuracoes()
 
+    @app.route('/api/configuracoes/reavaliacao', methods=['GET'])
+    def rota_consultar_reavaliacao():
+        return controller.consultar_reavaliacao()
+
     @app.route('/api/exportar', methods=['GET'])
     def rota_exportar_dados():
         return controller.exportar_dados()
@@ -46,6 +75,10 @@ def create_app():
     def rota_excluir_leituras():
         return controller.excluir_leituras()
 
+    @app.route('/api/replicacao/reservas/<leitura_id>', methods=['DELETE'])
+    def rota_desfazer_reserva(leitura_id):
+        return controller.desfazer_reserva(leitura_id)
+
     # --- MANIPULADOR DE ERROS ---.
     @app.errorhandler(HTTPException)
     def handle_exception(e):
@@ -56,6 +89,10 @@ def create_app():
             "description": e.description,
         })
         response.status_code = e.code
+        # o Retry-After do 429/503 (controlo de admissão) vai na resposta
+        for nome, valor in e.get_headers():
+            if nome == "Retry-After":
+                response.headers[nome] = valor
         return response
 
     return app
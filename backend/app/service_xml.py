@@ -2,13 +2,33 @@
 # aprova ou não baseado no xsd definido na T2
 
 import os
+import glob
 import json
+import hashlib
 import shutil
+import threading
+import time
+from decimal import Decimal
+from xml.sax.saxutils import escape, quoteattr
 import pandas as pd
 from lxml import etree
 from flask import abort
 from werkzeug.exceptions import HTTPException
-from backend.config.settings import XSD_PATH, REGRAS_VALIDACAO, DATA_DIR, REGRAS_DEFAULT_PATH
+from . import formato_binario
+from .motor_regras import LoteLeituras, AvaliadorIncremental, TabelaRegras, data_hora_para_epoch, validar_regras
+from .cache_leituras import CacheLeituras
+from .estado_atual import EstadoAtual
+from .metricas_derivadas import MetricasDerivadas, PREFIXO_ID
+from .alertas import ConjuntoAlertas, TrabalhoReavaliacao, CursorInvalido
+from .replicacao import Cluster, NoIndisponivel
+from .geracoes import (GeracoesDados, SnapshotInvalido, SnapshotExpirado, processo_vivo,
+                       nome_valido, NOME_TAMANHO_MAXIMO)
+from backend.config.settings import (XSD_PATH, REGRAS_VALIDACAO, DATA_DIR, REGRAS_DEFAULT_PATH,
+                                     REAVALIACAO_CHECKPOINT, REAVALIACAO_TAMANHO_LOTE,
+                                     NO_ID, PARES, REPLICACAO_DIR, REPLICACAO_INTERVALO,
+                                     REPLICACAO_TIMEOUT, REPLICACAO_VALIDADE_RESERVA, REPLICACAO_SEGREDO,
+                                     GERACOES_ESPERA_RECOLHA,
+                                     ALERTAS_ESPERA_INICIAL, ALERTAS_RETRY_AVALIACAO)
 
 # --- Carregamento do Schema ---
 try:
@@ -20,6 +40,63 @@ except Exception as e:
     print(f"Erro crítico ao carregar XSD: {e}")
     XSD_SCHEMA = None
 
+# estado por sensor das regras incrementais (histerese, taxa, duração)
+# partilhado entre os pedidos de ingestão
+_AVALIADOR = AvaliadorIncremental()
+_AVALIADOR_LOCK = threading.Lock()
+
+# regras compiladas: (assinatura (mtime, tamanho) do ficheiro que as gerou,
+# TabelaRegras, versão); "versao" identifica o conteúdo das regras (marca os
+# conjuntos de alertas). O tuplo é trocado inteiro, sob o lock, para a tabela
+# e a versão lidas por uma thread virem sempre do mesmo ficheiro
+_TABELA_REGRAS = {"regras": (None, None, None)}
+_TABELA_REGRAS_LOCK = threading.Lock()
+
+# alertas servidos pelo GET /api/alertas e reavaliação em curso (ver alertas.py)
+# o lock torna atómica a troca do conjunto servido
+_ALERTAS = {"conjunto": None, "trabalho": None}
+_ALERTAS_LOCK = threading.RLock()
+
+# este nó, os seus pares e o registo de alterações (ver replicacao.py)
+CLUSTER = Cluster(NO_ID, PARES, REPLICACAO_DIR, REPLICACAO_TIMEOUT, REPLICACAO_VALIDADE_RESERVA,
+                  REPLICACAO_SEGREDO)
+
+# os XMLs ficam na geração ativa do DATA_DIR (ver geracoes.py)
+GERACOES = GeracoesDados(DATA_DIR, GERACOES_ESPERA_RECOLHA)
+GERACOES.preparar()
+
+# checkpoints da reavaliação deste DATA_DIR (ver _checkpoint_reavaliacao)
+_PREFIXO_CHECKPOINT = (f"{REAVALIACAO_CHECKPOINT}-"
+                       f"{hashlib.sha1(os.path.realpath(DATA_DIR).encode('utf-8')).hexdigest()[:8]}")
+
+
+def diretorio_dados():
+    # pasta da geração ativa, onde estão os XMLs persistidos
+    return GERACOES.atual()
+
+
+def abrir_snapshot(snapshot_id=None):
+    # fixa um snapshot de leitura: o atual ou o pedido (?snapshot=G.S)
+    # quem o abre tem de chamar snapshot.libertar() no fim
+    try:
+        return GERACOES.fixar(snapshot_id)
+    except SnapshotInvalido as e:
+        abort(400, description=f"Parâmetro 'snapshot' inválido: {e}")
+    except SnapshotExpirado as e:
+        abort(410, description=str(e))
+    except OSError as e:
+        # Erro grave (ex: não consegue ler a pasta 'data/')
+        print(f"Erro crítico ao ler dados persistidos: {e}")
+        abort(500, description="Erro interno ao aceder à base de dados de XMLs.")
+
+
+# vistas em memória alimentadas pelo persistir_xml:
+# leituras recentes (GET /api/leituras?horas=) e estado atual dos sensores
+CACHE_LEITURAS = CacheLeituras()
+ESTADO_ATUAL = EstadoAtual()
+METRICAS_DERIVADAS = MetricasDerivadas()
+_VISTAS = (CACHE_LEITURAS, ESTADO_ATUAL, METRICAS_DERIVADAS)
+
 
 def validar_xsd(xml_string: str):
     # valida o xml usando o xsd
@@ -52,36 +129,94 @@ def validar_xsd(xml_string: str):
         abort(500, description=f"Erro interno no processamento do XML: {e}")
 
 
+def validar_binario(dados: bytes):
+    # valida o formato binário compacto (ver formato_binario.py) contra as
+    # mesmas restrições do schema.xsd, sem construir uma árvore lxml
+    # devolve o documento já extraído (mesmo formato do _extrair_documento)
+    try:
+        documento = formato_binario.decodificar(dados)
+        print("Log: Validação do formato binário bem-sucedida.")
+        return documento
+    except formato_binario.FormatoInvalido as e:
+        print(f"Erro de validação do formato binário: {e}")
+        abort(400, description=f"Binário falhou na validação do esquema: {e}")
+
+
+def documento_para_xml(documento):
+    # gera o XML (conforme o schema.xsd) de um documento extraído,
+    # para que as leituras binárias sejam guardadas no mesmo formato
+    unidades = documento.get("unidades", {})
+    linhas = [f'<estufa id={quoteattr(documento["estufa_id"])}>', '    <sensores>']
+    for sensor_id, tipo in documento["sensores"].items():
+        linhas.append(f'        <sensor id={quoteattr(sensor_id)} tipo={quoteattr(tipo)}>'
+                      f'<unidade>{escape(unidades.get(sensor_id, ""))}</unidade></sensor>')
+    linhas += ['    </sensores>', '    <leituras>']
+    for leitura_id, data_hora, sensor_id, valor in documento["leituras"]:
+        linhas += [f'        <leitura id={quoteattr(leitura_id)}>',
+                   f'            <dataHora>{escape(data_hora)}</dataHora>',
+                   f'            <sensorRef ref={quoteattr(sensor_id)}/>',
+                   f'            <valor>{_decimal_xsd(valor)}</valor>',
+                   '        </leitura>']
+    linhas.append('    </leituras>')
+    if documento.get("limites"):
+        linhas.append('    <configuracoes>')
+        for tipo, limite in documento["limites"].items():
+            linhas.append(f'        <limiteSensor tipo={quoteattr(tipo)}><min>{_decimal_xsd(limite["min"])}</min>'
+                          f'<max>{_decimal_xsd(limite["max"])}</max></limiteSensor>')
+        linhas.append('    </configuracoes>')
+    linhas.append('</estufa>')
+    return "\n".join(linhas) + "\n"
+
+
+def _decimal_xsd(valor):
+    # xs:decimal não aceita notação científica (ex: 1e-05 -> 0.00001)
+    return format(Decimal(repr(float(valor))), 'f')
+
+
+def _como_documento(doc):
+    # aceita um documento lxml (caminho XML) ou um já extraído (binário)
+    return doc if isinstance(doc, dict) else _extrair_documento(doc)
+
+
 def validar_regras_negocio(xml_doc):
     # valida as regras de negócio (faixas de valores) do xml
-    # recebe um documento lxml (retornado pelo validar_xsd).
+    # recebe um documento lxml (retornado pelo validar_xsd)
+    # ou um documento já extraído (retornado pelo validar_binario).
 
-    REGRAS_VALIDACAO = _get_regras_validacao()
+    tabela_regras = _get_tabela_regras()
     print("Log: Iniciando validação de regras de negócio...")
+    documento = _como_documento(xml_doc)
+
+    # os IDs começados por '@' são das métricas derivadas
+    reservados = [l[0] for l in documento["leituras"] if l[0].startswith(PREFIXO_ID)]
+    if reservados:
+        abort(400, description=f"ID de leitura inválido: '{reservados[0]}' "
+                               f"(o prefixo '{PREFIXO_ID}' é reservado às métricas derivadas).")
+
+    # o ID da leitura dá o nome ao ficheiro (e ao das derivadas) e entra no
+    # manifesto, um nome por linha: o XSD aceita quebras de linha e '/'
+    invalidos = [l[0] for l in documento["leituras"] if not nome_valido(l[0])]
+    if invalidos:
+        abort(400, description=f"ID de leitura inválido: {invalidos[0]!r} (sem caracteres de controlo, "
+                               f"sem '/' ou '\\' e com até {NOME_TAMANHO_MAXIMO} bytes).")
+
+    # antes de gravar: uma dataHora que passou no XSD mas não se converte
+    # faria falhar tudo o que lê o ficheiro depois (vistas, alertas)
+    try:
+        _verificar_datas(documento)
+    except ValueError as e:
+        print(f"Erro de validação: {e}")
+        abort(400, description=str(e))
 
     try:
-        # 1. Criar o mapa de sensores (ex: "S04" -> "pH")
-        sensor_map = {}
-        for sensor_node in xml_doc.xpath("/estufa/sensores/sensor"):
-            sensor_id = sensor_node.get("id")
-            sensor_tipo = sensor_node.get("tipo")  # Sem .lower()
-            sensor_map[sensor_id] = sensor_tipo
-
-        # 2. Validar cada leitura
-        for leitura_node in xml_doc.xpath("/estufa/leituras/leitura"):
-            sensor_ref_id = leitura_node.xpath("./sensorRef/@ref")[0]
-            valor = float(leitura_node.xpath("./valor/text()")[0])
-
-            # Obtém o tipo (ex: "pH") sem .lower()
-            tipo_sensor = sensor_map.get(sensor_ref_id)
-
-            # Compara o tipo (ex: "pH") com as chaves (ex: "pH")
-            if tipo_sensor in REGRAS_VALIDACAO:
-                regras = REGRAS_VALIDACAO[tipo_sensor]
-                if not (regras['min'] <= valor <= regras['max']):
-                    leitura_id = leitura_node.get("id")
-                    print(f"ALERTA (POST): Leitura ID {leitura_id} ({tipo_sensor}) está fora da faixa. Valor: {valor}")
-                    # (Nota: O T3 não rejeita, apenas regista o alerta para o T4)
+        # 1. Montar o lote colunar com as leituras do documento
+        lote = LoteLeituras()
+        lote.adicionar_documento(documento, tabela_regras)
+
+        # 2. Validar todas as leituras de uma vez (vetorizado); as regras
+        # com estado (histerese, taxa, duração) só são avaliadas depois de
+        # a leitura ser gravada (ver _avaliar_regras_com_estado)
+        _log_alertas(lote, [(int(indice), "faixa") for indice in lote.avaliar()])
 
         print("Log: Validação de regras de negócio concluída.")
         return True
@@ -93,29 +228,110 @@ def validar_regras_negocio(xml_doc):
         abort(400, description=f"Erro ao processar regras de negócio: {e}")
 
 
+def _verificar_datas(documento):
+    # levanta ValueError se alguma dataHora do documento não se converte
+    # (ex: anos 12025 ou -0005, que o xs:dateTime aceita)
+    for _, data_hora, _, _ in documento["leituras"]:
+        data_hora_para_epoch(data_hora)
+
+
+def _avaliar_regras_com_estado(documento):
+    # regras com estado de um documento acabado de gravar: só aqui o estado
+    # em memória avança, para um documento rejeitado (ex: 409) não contar
+    # como leitura vista; a leitura já foi aceite, por isso erros só são registados
+    try:
+        lote = LoteLeituras()
+        lote.adicionar_documento(documento, _get_tabela_regras())
+        with _AVALIADOR_LOCK:
+            resultados = lote.avaliar_incrementais(_AVALIADOR)
+        _log_alertas(lote, resultados)
+    except Exception as e:
+        print(f"Erro durante a avaliação das regras com estado: {e}")
+
+
+def _log_alertas(lote, resultados):
+    codigos, valores = lote.codigos(), lote.valores()
+    for indice, motivo in resultados:
+        leitura_id = lote.metadados[indice][0]
+        tipo_sensor = lote.tipos[codigos[indice]]
+        print(f"ALERTA (POST): Leitura ID {leitura_id} ({tipo_sensor}) disparou alerta de {motivo}. Valor: {valores[indice]}")
+        # (Nota: O T3 não rejeita, apenas regista o alerta para o T4)
+
+
+def _limites_documento(xml_doc):
+    # lê o bloco opcional <configuracoes>/<limiteSensor> do próprio documento
+    # (ex: {"ph": {"min": 5.0, "max": 6.0}})
+    limites = {}
+    for limite_node in xml_doc.xpath("/estufa/configuracoes/limiteSensor"):
+        limites[limite_node.get("tipo")] = {
+            "min": float(limite_node.findtext("min")),
+            "max": float(limite_node.findtext("max"))
+        }
+    return limites
+
+
+def _extrair_documento(xml_doc):
+    # extrai os dados de um documento lxml para estruturas python simples
+    # cada leitura fica como (id, dataHora, sensorRef, valor)
+    sensores, unidades = {}, {}
+    for sensor_node in xml_doc.xpath("/estufa/sensores/sensor"):
+        sensores[sensor_node.get("id")] = sensor_node.get("tipo")  # Sem .lower()
+        unidades[sensor_node.get("id")] = sensor_node.findtext("unidade")
+
+    leituras = []
+    for leitura_node in xml_doc.xpath("/estufa/leituras/leitura"):
+        leituras.append((leitura_node.get("id"),
+                         leitura_node.findtext("dataHora"),
+                         leitura_node.find("sensorRef").get("ref"),
+                         float(leitura_node.findtext("valor"))))
+    return {
+        "estufa_id": xml_doc.xpath("/estufa/@id")[0],
+        "sensores": sensores,
+        "unidades": unidades,
+        "leituras": leituras,
+        "limites": _limites_documento(xml_doc)
+    }
+
+
 def persistir_xml(xml_data_string: str, xml_doc):
     # salva a string xml original na pasta backend/data/
     # usa o id da primeira leitura como nome
     # verifica duplicidade
+    # (xml_doc pode ser o documento lxml ou um já extraído, como no binário)
     print("Log: Iniciando persistência do XML...")
     try:
+        documento = dict(_como_documento(xml_doc))
         # usa o id da primeira leitura no XML como nome
         # o id é necessário para verificar a duplicidade
-        leitura_id = xml_doc.xpath("/estufa/leituras/leitura[1]/@id")[0]
+        leitura_id = documento["leituras"][0][0]
         filename = f"{leitura_id}.xml"
-        filepath = os.path.join(DATA_DIR, filename)
+        filepath = os.path.join(diretorio_dados(), filename)
+        documento["ficheiro"] = filename
 
         # verifica duplicidade (requisito T3: 409 Conflict)
-        if os.path.exists(filepath):
+        # neste nó e, havendo réplicas, no nó responsável pelo ID; a
+        # gravação volta a verificar de forma atómica (pedidos simultâneos)
+        dono = CLUSTER.novo_dono()
+        try:
+            duplicado = os.path.exists(filepath) or not CLUSTER.reservar(leitura_id, dono)
+        except NoIndisponivel as e:
+            print(f"Log: {e}")
+            abort(503, description=f"Não foi possível confirmar o ID {leitura_id} no cluster: {e}")
+        # salva a 'xml_data_string' (texto original)
+        try:
+            gravado = not duplicado and _gravar_ficheiro(filename, xml_data_string, documento)
+        except Exception:
+            # a gravação falhou: o ID reservado volta a ficar livre
+            CLUSTER.desfazer_reserva(leitura_id, dono)
+            raise
+        if not gravado:
             msg_erro = f"Conflito: A leitura com ID {leitura_id} já existe."
             print(f"Log: {msg_erro}")
             abort(409, description=msg_erro)  # 409 Conflict
 
-        # salva a 'xml_data_string' (texto original)
-        with open(filepath, "w", encoding="utf-8") as f:
-            f.write(xml_data_string)
-
-        print(f"Log: Ficheiro salvo com sucesso em {filepath}")
+        _avaliar_regras_com_estado(documento)
+        # e publica-a para os outros nós
+        CLUSTER.registo.acrescentar({"no": NO_ID, "op": "criar", "ficheiro": filename})
         return True
 
     except HTTPException as e:
@@ -134,38 +350,194 @@ def persistir_xml(xml_data_string: str, xml_doc):
         abort(500, description=f"Erro interno ao salvar o ficheiro: {e}")
 
 
+def _gravar_ficheiro(ficheiro, xml_data_string, documento):
+    # grava um XML novo na geração ativa; devolve False se já existir
+    # o conteúdo vai primeiro para um temporário e o nome final é criado
+    # com os.link, que falha se o ficheiro já existir: só um pedido ganha
+    # (mesmo entre processos) e nunca há um XML gravado pela metade
+    # sob o lock dos alertas: um snapshot nunca vê um ficheiro cujos alertas
+    # ainda não foram registados, e as gravações deste processo não se
+    # cruzam (cada uma atualiza as vistas sem as invalidar)
+    # o temporário fica fora da geração: só o link final muda o mtime da
+    # pasta (que faz parte da versão), mesmo quando o ID já existe
+    with _ALERTAS_LOCK:
+        while True:
+            assinatura_antes = _assinatura_dados()
+            diretorio = diretorio_dados()
+            filepath = os.path.join(diretorio, ficheiro)
+            temporario = os.path.join(GERACOES.base, f"{ficheiro}.{os.getpid()}.{threading.get_ident()}.tmp")
+            try:
+                with open(temporario, "w", encoding="utf-8") as f:
+                    f.write(xml_data_string)
+                try:
+                    os.link(temporario, filepath)
+                finally:
+                    os.remove(temporario)
+                # o ficheiro só fica visível às leituras quando entra no manifesto
+                GERACOES.registar(diretorio, ficheiro)
+            except FileExistsError:
+                return False
+            except FileNotFoundError:
+                if diretorio_dados() == diretorio:
+                    raise
+                # geração antiga já recolhida (ver abaixo)
+            if diretorio_dados() == diretorio:
+                break
+            # outro processo excluiu tudo (trocou de geração) durante a
+            # gravação: grava de novo na geração nova, para não se perder
+            print(f"Log: Geração trocada durante a gravação de {ficheiro}, a gravar de novo.")
+
+        print(f"Log: Ficheiro salvo com sucesso em {filepath}")
+        assinatura_depois = _assinatura_dados()
+
+        # mantém as vistas em memória em dia (sem voltar ao disco): pelo
+        # manifesto, que também traz o que outros processos gravaram entretanto
+        # a leitura já está gravada: uma falha aqui só é registada e a
+        # vista volta a ser montada a partir do disco
+        for vista in _VISTAS:
+            try:
+                if _alcancar(vista, {ficheiro: documento}) is None:
+                    vista.registar(documento, assinatura_antes, assinatura_depois)
+            except Exception as e:
+                print(f"Erro ao registar {ficheiro} em {type(vista).__name__}: {e}")
+                vista.invalidar()
+        try:
+            _registar_alertas(documento, assinatura_antes, assinatura_depois)
+        except Exception as e:
+            print(f"Erro ao registar os alertas de {ficheiro}: {e}")
+            if _ALERTAS["conjunto"] is not None:
+                _ALERTAS["conjunto"].desatualizar()  # a reavaliação reconstrói-o
+        return True
+
+
+def processar_metricas_derivadas(xml_doc):
+    # etapa das métricas derivadas (VPD, ponto de orvalho, DLI) de um
+    # documento acabado de gravar: as leituras derivadas passam pelas
+    # regras e são persistidas (e replicadas) como qualquer outra leitura
+    # a vista já inclui o documento (persistir_xml); nunca é recarregada
+    # aqui: se estiver desatualizada, recarrega em segundo plano e entretanto
+    # as derivadas saem do estado que já tem
+    documento = _como_documento(xml_doc)
+    if not METRICAS_DERIVADAS.sincronizado(_assinatura_dados()):
+        _recarregar_metricas_derivadas()
+    try:
+        derivado = METRICAS_DERIVADAS.derivar(documento)
+        if derivado is None:
+            return None
+        _log_alertas_derivados(derivado)
+        persistir_xml(documento_para_xml(derivado), derivado)
+    except HTTPException as e:
+        # a leitura original já foi gravada (e confirmada): uma derivada que
+        # não pôde ser gravada (ex: ID já existente) não faz falhar o pedido
+        print(f"Log: Métricas derivadas de {documento['leituras'][0][0]} não gravadas: {e.description}")
+        return None
+    except Exception as e:
+        print(f"Erro nas métricas derivadas de {documento['leituras'][0][0]}: {e}")
+        return None
+    return derivado
+
+
+def _log_alertas_derivados(derivado):
+    # como o validar_regras_negocio (só regista os alertas), sem abort
+    lote = LoteLeituras()
+    lote.adicionar_documento(derivado, _get_tabela_regras())
+    _log_alertas(lote, [(int(indice), "faixa") for indice in lote.avaliar()])
+
+
+_RECARGA_METRICAS = {"thread": None}
+
+
+def _recarregar_metricas_derivadas():
+    # reconstrói a vista das métricas derivadas numa thread (ver _sincronizar)
+    with _ALERTAS_LOCK:
+        thread = _RECARGA_METRICAS["thread"]
+        if thread is not None and thread.is_alive():
+            return
+        thread = _RECARGA_METRICAS["thread"] = threading.Thread(
+            target=_executar_recarga_metricas, name="recarga-metricas", daemon=True)
+        thread.start()
+
+
+def _executar_recarga_metricas():
+    try:
+        _sincronizar(METRICAS_DERIVADAS)
+    except Exception as e:
+        print(f"Erro ao recarregar as métricas derivadas: {e}")
+
+
+def reservar_leitura(leitura_id, dono):
+    # pedido do nó que recebeu a leitura ao nó responsável pelo ID
+    # devolve False se o ID já existe no cluster
+    existe = os.path.exists(os.path.join(diretorio_dados(), f"{leitura_id}.xml"))
+    return CLUSTER.reservar_local(leitura_id, dono, existe)
+
+
+def desfazer_reserva(leitura_id, dono):
+    # o nó que reservou o ID não conseguiu gravar a leitura
+    CLUSTER.desfazer_reserva_local(leitura_id, dono)
+
+
+def ler_alteracoes(desde, limite):
+    # alterações deste nó com seq > desde, para os pares as aplicarem
+    # o XML de cada leitura criada vai junto (None se já foi excluída)
+    alteracoes = CLUSTER.registo.ler(desde, limite)
+    for alteracao in alteracoes:
+        if alteracao["op"] == "criar":
+            try:
+                with open(os.path.join(diretorio_dados(), alteracao["ficheiro"]), "r", encoding="utf-8") as f:
+                    alteracao["xml"] = f.read()
+            except FileNotFoundError:
+                alteracao["xml"] = None
+    return {"no": NO_ID, "ultimo_seq": CLUSTER.registo.ultimo_seq, "alteracoes": alteracoes}
+
+
+def aplicar_alteracao(alteracao):
+    # repete neste nó uma alteração feita noutro (sem a voltar a publicar)
+    if alteracao["op"] == "criar":
+        filepath = os.path.join(diretorio_dados(), alteracao["ficheiro"])
+        if alteracao.get("xml") is None or os.path.exists(filepath):
+            return  # já excluída na origem, ou já aplicada
+        documento = _extrair_documento(etree.fromstring(alteracao["xml"].encode('utf-8')))
+        _verificar_datas(documento)
+        documento["ficheiro"] = alteracao["ficheiro"]
+        _gravar_ficheiro(alteracao["ficheiro"], alteracao["xml"], documento)
+    elif alteracao["op"] == "excluir":
+        _excluir_ficheiros(alteracao["ficheiros"])
+        print(f"Log: {len(alteracao['ficheiros'])} ficheiros excluídos pelo nó {alteracao['no']}.")
+
+
+def iniciar_replicacao():
+    # segue os registos de alterações dos pares (se houver pares)
+    if CLUSTER.ativo:
+        print(f"Log: Nó {NO_ID} a replicar de {', '.join(CLUSTER.pares)}.")
+        if not CLUSTER.segredo:
+            print("Log: ESTUFA_SEGREDO_CLUSTER não definido, os pares não vão conseguir replicar.")
+    CLUSTER.iniciar(aplicar_alteracao, REPLICACAO_INTERVALO)
+
+
 def _xml_doc_para_dict(xml_doc):
     # converter um XML Doc (lxml) num dicionario
     # python limpo e legível (pronto para JSON).
     # ATUALIZADO para incluir o tipo do sensor
 
     try:
-        # Extrai o ID da estufa
-        estufa_id = xml_doc.xpath("/estufa/@id")[0]
-
-        sensor_map = {}
-        for sensor_node in xml_doc.xpath("/estufa/sensores/sensor"):
-            sensor_id = sensor_node.get("id")
-            sensor_tipo = sensor_node.get("tipo")
-            sensor_map[sensor_id] = sensor_tipo
+        documento = _extrair_documento(xml_doc)
+        sensor_map = documento["sensores"]
 
         leituras_lista = []
-        # Itera sobre cada nó <leitura>
-        for leitura_node in xml_doc.xpath("/estufa/leituras/leitura"):
-            sensor_ref_id = leitura_node.xpath("./sensorRef/@ref")[0]
-            tipo_sensor = sensor_map.get(sensor_ref_id, "tipo_desconhecido")
+        for leitura_id, data_hora, sensor_ref_id, valor in documento["leituras"]:
             leitura_dict = {
-                "id": leitura_node.get("id"),
-                "dataHora": leitura_node.xpath("./dataHora/text()")[0],
-                "sensorRef": leitura_node.xpath("./sensorRef/@ref")[0],
-                "tipo": tipo_sensor,
-                "valor": float(leitura_node.xpath("./valor/text()")[0])
+                "id": leitura_id,
+                "dataHora": data_hora,
+                "sensorRef": sensor_ref_id,
+                "tipo": sensor_map.get(sensor_ref_id, "tipo_desconhecido"),
+                "valor": valor
             }
             leituras_lista.append(leitura_dict)
 
         # Retorna um dicionário estruturado
         return {
-            "estufa_id": estufa_id,
+            "estufa_id": documento["estufa_id"],
             "leituras": leituras_lista
         }
     except Exception as e:
@@ -174,107 +546,488 @@ def _xml_doc_para_dict(xml_doc):
         return None
 
 
-def ler_dados_persistidos():
+def ler_dados_persistidos(snapshot=None):
     # lê todos os ficheiros XML da pasta 'data/', converte-os
     # para dicionários e retorna uma lista de todos os dados.
-    print("Log: Iniciando leitura de dados persistidos...")
-    todos_os_dados = []
+    todos_os_dados = list(iterar_dados_persistidos(snapshot))
+    print("Log: Leitura e conversão de dados concluída.")
+    return todos_os_dados
 
-    try:
-        # lista todos os ficheiros no diretório de dados
-        ficheiros = os.listdir(DATA_DIR)
 
-        # filtra apenas os que são .xml
-        xml_ficheiros = [f for f in ficheiros if f.endswith('.xml')]
+def iterar_dados_persistidos(snapshot=None):
+    # versão "preguiçosa" do ler_dados_persistidos: cada ficheiro só é lido
+    # e convertido quando o item for pedido - usado para enviar a resposta
+    # em stream. lê sempre um snapshot (o atual, se não for indicado), que
+    # é libertado no fim, mesmo se o stream for abandonado
+    print("Log: Iniciando leitura de dados persistidos...")
+    gerador = _gerar_dados_persistidos(snapshot or abrir_snapshot())
+    next(gerador)  # entra no try/finally do gerador
+    return gerador
 
-        # itera, lê e converte cada ficheiro
-        for ficheiro in xml_ficheiros:
-            filepath = os.path.join(DATA_DIR, ficheiro)
 
-            try:
-                # Abre e lê o ficheiro XML
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    xml_string = f.read()
+def _gerar_dados_persistidos(snapshot):
+    try:
+        yield None  # (ver iterar_dados_persistidos)
+        yield from _converter_ficheiros(snapshot.diretorio, snapshot.ficheiros)
+    finally:
+        snapshot.libertar()
+
+
+def _converter_ficheiros(diretorio, xml_ficheiros):
+    # itera, lê e converte cada ficheiro
+    for ficheiro in xml_ficheiros:
+        filepath = os.path.join(diretorio, ficheiro)
+
+        try:
+            # Abre e lê o ficheiro XML
+            with open(filepath, 'r', encoding='utf-8') as f:
+                xml_string = f.read()
+
+            # Faz o parse
+            xml_doc = etree.fromstring(xml_string.encode('utf-8'))
+
+            # Converte para dicionário usando a nossa helper
+            dados_convertidos = _xml_doc_para_dict(xml_doc)
+
+            if dados_convertidos:
+                yield dados_convertidos
+
+        except FileNotFoundError:
+            _verificar_geracao(diretorio)
+            print(f"Erro ao processar o ficheiro {ficheiro}: não encontrado")
+
+        except Exception as e:
+            # Loga um erro se um ficheiro específico falhar, mas continua
+            print(f"Erro ao processar o ficheiro {ficheiro}: {e}")
+
+
+def _verificar_geracao(diretorio):
+    # um ficheiro do snapshot desapareceu: se foi a geração inteira (recolhida
+    # a meio da leitura, ver geracoes.py), a leitura falha em vez de devolver
+    # dados parciais
+    if not os.path.isdir(diretorio):
+        raise SnapshotExpirado(f"a geração {os.path.basename(diretorio)} foi recolhida durante a leitura")
+
+
+def ler_leituras_recentes(horas, estufa_id=None, sensor_id=None, tipo=None, snapshot_id=None):
+    # leituras das últimas 'horas', agrupadas por estufa e ordenadas no tempo
+    # dentro da janela do cache responde só da memória (sem disco nem lxml)
+    # devolve (leituras, id do snapshot lido)
+    print(f"Log: A ler leituras das últimas {horas} horas...")
+
+    # a recarga (se for precisa) é feita antes, fora do lock das gravações;
+    # sob o lock, o cache e o snapshot refletem o mesmo estado
+    _sincronizar(CACHE_LEITURAS)
+    with _ALERTAS_LOCK:
+        snapshot = abrir_snapshot(snapshot_id)
+        linhas = None
+        if (CACHE_LEITURAS.sincronizado(snapshot.assinatura)
+                and CACHE_LEITURAS.cobre(horas, estufa_id, sensor_id, tipo)):
+            linhas = CACHE_LEITURAS.consultar(horas, estufa_id, sensor_id, tipo)
+    try:
+        if linhas is None:
+            # janela maior do que a do cache, anel que já perdeu leituras
+            # dessa janela (ou snapshot antigo): lê do disco
+            linhas = _linhas_recentes_do_disco(horas, estufa_id, sensor_id, tipo, snapshot)
+    finally:
+        snapshot.libertar()
+
+    linhas.sort(key=lambda linha: (linha[0], linha[2], linha[1]))
+    por_estufa = {}
+    for estufa, leitura_id, _, data_hora, sensor, tipo_sensor, valor in linhas:
+        por_estufa.setdefault(estufa, []).append({
+            "id": leitura_id,
+            "dataHora": data_hora,
+            "sensorRef": sensor,
+            "tipo": tipo_sensor,
+            "valor": valor
+        })
+    return [{"estufa_id": estufa, "leituras": leituras} for estufa, leituras in por_estufa.items()], snapshot.id
+
+
+def _linhas_recentes_do_disco(horas, estufa_id=None, sensor_id=None, tipo=None, snapshot=None):
+    # mesmo formato de linhas que o CacheLeituras.consultar()
+    corte = time.time() - horas * 3600
+    linhas = []
+    for documento in _iterar_documentos(snapshot):
+        estufa = documento["estufa_id"]
+        if estufa_id and estufa != estufa_id:
+            continue
+        for leitura_id, data_hora, sensor, valor in documento["leituras"]:
+            tipo_sensor = documento["sensores"].get(sensor, "tipo_desconhecido")
+            if (sensor_id and sensor != sensor_id) or (tipo and tipo_sensor != tipo):
+                continue
+            instante = int(data_hora_para_epoch(data_hora))
+            if instante >= corte:
+                linhas.append((estufa, leitura_id, instante, data_hora, sensor, tipo_sensor, valor))
+    return linhas
+
+
+def ler_estado_atual():
+    # última leitura, status e estatísticas de cada sensor, por estufa
+    print("Log: A ler o estado atual dos sensores...")
+    tabela_regras, versao = _regras_compiladas()
+    # estado das regras com histerese/duração: o dos alertas servidos, se
+    # estes já usarem as regras atuais (senão fica só a faixa min/max)
+    with _ALERTAS_LOCK:
+        conjunto = _conjunto_alertas()
+        em_alerta = (conjunto.sensores_em_alerta()
+                     if conjunto is not None and conjunto.versao == versao else None)
+    return _sincronizar(ESTADO_ATUAL).consultar(tabela_regras, em_alerta)
+
+
+# uma recarga de cada vez: quem chega durante uma recarga espera por ela
+# em vez de ler o histórico outra vez
+_RECARGA_LOCK = threading.Lock()
+
+
+def _sincronizar(vista):
+    # garante que a vista em memória reflete o DATA_DIR atual
+    # gravações de outros processos só acrescentam ao manifesto: a vista
+    # inclui as entradas novas; só é recarregada do disco se isso não bastar
+    if vista.sincronizado(_assinatura_dados()):
+        return vista
+    with _ALERTAS_LOCK:
+        if _alcancar(vista) is not None:
+            return vista
+    with _RECARGA_LOCK:
+        # outra thread pode tê-la recarregado enquanto esta esperava
+        if not vista.sincronizado(_assinatura_dados()):
+            print(f"Log: {type(vista).__name__} desatualizado, a recarregar do disco...")
+            while not _recarregar_vista(vista):
+                pass  # dados excluídos a meio: recarrega da geração nova
+    return vista
+
+
+def _ficheiros_novos(assinatura):
+    # (ficheiros gravados desde 'assinatura', diretório, assinatura atual)
+    # lidos do fim do manifesto da geração ativa; None se não se pode
+    # partir de 'assinatura' (outra geração, ou a pasta mudou sem ficheiros
+    # novos, ex: ficheiros apagados à mão)
+    if assinatura is None:
+        return None
+    snapshot = abrir_snapshot()
+    snapshot.libertar()
+    atual = snapshot.assinatura
+    if atual is None or assinatura[0] != atual[0]:
+        return None
+    if atual[1] < assinatura[1] or (atual[1] == assinatura[1] and atual != assinatura):
+        return None
+    return snapshot.ficheiros[assinatura[1]:], snapshot.diretorio, atual
 
-                # Faz o parse
-                xml_doc = etree.fromstring(xml_string.encode('utf-8'))
 
-                # Converte para dicionário usando a nossa helper
-                dados_convertidos = _xml_doc_para_dict(xml_doc)
+def _alcancar(vista, documentos=None):
+    # inclui na vista os ficheiros novos do manifesto (chamado com o
+    # _ALERTAS_LOCK, por isso nenhuma gravação deste processo fica a meio)
+    # 'documentos': {ficheiro: documento} já extraídos (ex: o acabado de gravar)
+    # devolve os ficheiros incluídos, ou None se a vista tem de ser recarregada
+    anterior = vista.assinatura
+    novos = _ficheiros_novos(anterior)
+    if novos is None:
+        return None
+    ficheiros, diretorio, atual = novos
+    documentos = documentos or {}
+    carregados = (documentos.get(f) or _carregar_documento(f, diretorio) for f in ficheiros)
+    if not vista.alcancar([d for d in carregados if d], anterior, atual):
+        return None
+    return ficheiros
 
-                if dados_convertidos:
-                    todos_os_dados.append(dados_convertidos)
 
-            except Exception as e:
-                # Loga um erro se um ficheiro específico falhar, mas continua
-                print(f"Erro ao processar o ficheiro {ficheiro}: {e}")
+def _recarregar_vista(vista):
+    # a vista nova é montada a partir de um snapshot fora do _ALERTAS_LOCK
+    # (as gravações não esperam pela leitura do histórico) e só no fim
+    # substitui a atual, com os ficheiros gravados entretanto
+    # devolve False se os dados foram excluídos (nova geração) a meio
+    nova = vista.nova()
+    snapshot = abrir_snapshot()
+    try:
+        nova.recarregar(_iterar_documentos(snapshot), None)
+    finally:
+        snapshot.libertar()
+    with _ALERTAS_LOCK:
+        atual = abrir_snapshot()
+        atual.libertar()
+        if atual.diretorio != snapshot.diretorio:
+            return False
+        for ficheiro in atual.ficheiros[len(snapshot.ficheiros):]:
+            documento = _carregar_documento(ficheiro, atual.diretorio)
+            if documento:
+                nova.incluir(documento)
+        nova.assinatura = atual.assinatura
+        vista.adotar(nova)
+    return True
+
+
+def _iterar_documentos(snapshot=None):
+    # percorre os XMLs persistidos (de um snapshot), devolvendo cada um já
+    # extraído; ficheiros corrompidos são ignorados (com log)
+    proprio = snapshot is None
+    snapshot = snapshot or abrir_snapshot()
+    try:
+        for ficheiro in snapshot.ficheiros:
+            documento = _carregar_documento(ficheiro, snapshot.diretorio)
+            if documento:
+                yield documento
+    finally:
+        if proprio:
+            snapshot.libertar()
+
+
+def _carregar_documento(ficheiro, diretorio=None):
+    # lê e extrai um XML persistido; devolve None se não existir ou
+    # estiver corrompido (com log), inclusive com uma dataHora que não se
+    # converte (gravado antes de essa validação existir)
+    diretorio = diretorio or diretorio_dados()
+    try:
+        xml_doc = etree.parse(os.path.join(diretorio, ficheiro))
+        documento = _extrair_documento(xml_doc)
+        _verificar_datas(documento)
+        documento["ficheiro"] = ficheiro
+        return documento
+    except OSError as e:
+        _verificar_geracao(diretorio)
+        print(f"Erro ao processar o ficheiro {ficheiro}: {e}")
+        return None
+    except Exception as e:
+        print(f"Erro ao processar o ficheiro {ficheiro}: {e}")
+        return None
 
-        print("Log: Leitura e conversão de dados concluída.")
-        return todos_os_dados
 
-    except Exception as e:
-        # Erro grave (ex: não consegue ler a pasta 'data/')
-        print(f"Erro crítico ao ler dados persistidos: {e}")
-        abort(500, description="Erro interno ao aceder à base de dados de XMLs.")
+def _assinatura_dados():
+    # identifica o estado atual do DATA_DIR (ver GeracoesDados.versao),
+    # inclusive alterações feitas por outro processo, para invalidar caches
+    try:
+        return GERACOES.versao()
+    except OSError:
+        return None
 
 
 def ler_dados_de_alerta():
-    # lê todos os XMLs persistidos, aplica as regras de negócio
+    # aplica as regras de negócio a todos os XMLs persistidos
     # retorna uma lista das leituras que estão fora dos limites.
+    alertas, _, _ = consultar_alertas()
+    return alertas
 
-    REGRAS_VALIDACAO = _get_regras_validacao()
-    print("Log: Iniciando verificação de alertas...")
-    alertas = []
 
+def consultar_alertas(ordem="asc", limite=None, cursor=None, snapshot_id=None, **filtros):
+    # alertas ordenados por dataHora, com filtros opcionais
+    # (estufa_id, tipo, sensor_id, desde, ate) e paginação por cursor
+    # devolve (alertas, cursor da página seguinte, versão das regras, id do snapshot)
+    # enquanto uma reavaliação corre, continua a servir o conjunto anterior
+    print("Log: Iniciando verificação de alertas...")
     try:
-        for ficheiro_xml in os.listdir(DATA_DIR):
-            if not ficheiro_xml.endswith('.xml'):
-                continue
+        _aguardar_conjunto_alertas()
+        with _ALERTAS_LOCK:
+            conjunto, snapshot, ficheiros = _alertas_do_snapshot(snapshot_id)
+            alertas, proximo = conjunto.consultar(ordem=ordem, limite=limite, cursor=cursor,
+                                                  ficheiros=ficheiros, **filtros)
+        print("Log: Verificação de alertas concluída.")
+        return alertas, proximo, conjunto.versao, snapshot.id
 
-            caminho_ficheiro = os.path.join(DATA_DIR, ficheiro_xml)
-            xml_doc = etree.parse(caminho_ficheiro)
-
-            estufa_id = xml_doc.xpath("/estufa/@id")[0]
-
-            # 1. Criar o mapa de sensores (ex: "S04" -> "pH")
-            sensor_map = {}
-            for sensor_node in xml_doc.xpath("/estufa/sensores/sensor"):
-                sensor_id = sensor_node.get("id")
-                sensor_tipo = sensor_node.get("tipo")  # Sem .lower()
-                sensor_map[sensor_id] = sensor_tipo
-
-            # 2. Validar cada leitura contra as regras ATUAIS
-            for leitura_node in xml_doc.xpath("/estufa/leituras/leitura"):
-                sensor_ref_id = leitura_node.xpath("./sensorRef/@ref")[0]
-                valor = float(leitura_node.xpath("./valor/text()")[0])
-
-                # Obtém o tipo (ex: "pH") sem .lower()
-                tipo_sensor = sensor_map.get(sensor_ref_id)
-
-                # Compara o tipo (ex: "pH") com as chaves (ex: "pH")
-                if tipo_sensor in REGRAS_VALIDACAO:
-                    regras = REGRAS_VALIDACAO[tipo_sensor]
-
-                    if not (regras['min'] <= valor <= regras['max']):
-                        # Se estiver FORA da faixa, adiciona ao alerta
-                        alerta_info = {
-                            "estufa_id": estufa_id,
-                            "leitura_id": leitura_node.get("id"),
-                            "sensor_id": sensor_ref_id,
-                            "tipo": tipo_sensor,
-                            "valor_lido": valor,
-                            "faixa_ideal": f"{regras['min']} - {regras['max']}",
-                            "dataHora": leitura_node.xpath("./dataHora/text()")[0],
-                            "ficheiro_origem": ficheiro_xml
-                        }
-                        alertas.append(alerta_info)
+    except CursorInvalido as e:
+        abort(400, description=f"Parâmetro 'cursor' inválido: {e}")
 
-        print("Log: Verificação de alertas concluída.")
-        return alertas
+    except HTTPException:
+        raise
 
     except Exception as e:
         print(f"Erro ao ler dados de alerta: {e}")
-        return []
+        return [], None, None, None
+
+
+def contar_alertas(agrupar=None, snapshot_id=None, **filtros):
+    # contagem dos alertas (total e por "tipo" ou "estufa"), só com os índices
+    # devolve (contagem, versão das regras, id do snapshot)
+    try:
+        _aguardar_conjunto_alertas()
+        with _ALERTAS_LOCK:
+            conjunto, snapshot, ficheiros = _alertas_do_snapshot(snapshot_id)
+            return conjunto.contar(agrupar, ficheiros=ficheiros, **filtros), conjunto.versao, snapshot.id
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        print(f"Erro ao contar alertas: {e}")
+        return {"total": 0}, None, None
+
+
+def _alertas_do_snapshot(snapshot_id):
+    # (conjunto, snapshot, ficheiros do snapshot ou None se forem os mesmos
+    # do conjunto); chamado com o _ALERTAS_LOCK, sem gravações a meio
+    conjunto = _conjunto_alertas()
+    if conjunto is None:
+        abort(503, description="Os alertas ainda estão a ser avaliados, tente novamente.",
+              retry_after=ALERTAS_RETRY_AVALIACAO)
+    snapshot = abrir_snapshot(snapshot_id)
+    snapshot.libertar()  # os alertas estão em memória
+    ficheiros = None if conjunto.sincronizado(snapshot.assinatura) else set(snapshot.ficheiros)
+    return conjunto, snapshot, ficheiros
+
+
+def _conjunto_alertas():
+    # o último conjunto completo (None se ainda não houver nenhum); nunca
+    # avalia aqui: se estiver desatualizado (1a leitura, regras editadas à
+    # mão, ficheiros alterados por outro processo) o trabalho em segundo
+    # plano reconstrói-o e troca-o quando terminar
+    with _ALERTAS_LOCK:
+        conjunto = _ALERTAS["conjunto"]
+        versao = _regras_compiladas()[1]
+        if (conjunto is not None and conjunto.versao == versao
+                and not conjunto.sincronizado(_assinatura_dados())):
+            # ficheiros novos de outro processo: só esses são avaliados
+            _alcancar(conjunto)
+        if (conjunto is None or conjunto.versao != versao
+                or not conjunto.sincronizado(_assinatura_dados())):
+            iniciar_reavaliacao()
+        return conjunto
+
+
+def _aguardar_conjunto_alertas():
+    # ainda não há conjunto nenhum (arranque): espera um pouco pela
+    # avaliação em segundo plano, fora do lock, antes de responder 503
+    with _ALERTAS_LOCK:
+        conjunto, trabalho = _conjunto_alertas(), _ALERTAS["trabalho"]
+    if conjunto is None and trabalho is not None:
+        trabalho.aguardar(ALERTAS_ESPERA_INICIAL)
+
+
+def _novo_trabalho_reavaliacao():
+    # trabalho sobre todos os ficheiros atuais com as regras atuais
+    tabela_regras, versao = _regras_compiladas()
+    # ficheiros e assinatura do mesmo snapshot, pela ordem em que foram gravados
+    snapshot = abrir_snapshot()
+    snapshot.libertar()  # cada ficheiro é lido depois pelo nome
+    assinatura, ficheiros = snapshot.assinatura, snapshot.ficheiros
+    # o checkpoint de um trabalho interrompido é retomado já na thread
+    caminho = _checkpoint_reavaliacao(os.path.basename(snapshot.diretorio), versao)
+    return TrabalhoReavaliacao(versao, tabela_regras, ficheiros, assinatura, _carregar_documento,
+                               caminho, REAVALIACAO_TAMANHO_LOTE)
+
+
+def _checkpoint_reavaliacao(geracao, versao):
+    # checkpoint deste processo para a geração e a versão das regras
+    # com o nó e o pid no nome: outros processos no mesmo DATA_DIR (ou
+    # outros nós) nunca escrevem no mesmo ficheiro; o checkpoint de um
+    # processo que parou a meio é adotado (rename atómico) pelo primeiro
+    # que reavaliar a mesma geração com a mesma versão
+    prefixo = f"{_PREFIXO_CHECKPOINT}-{geracao}-{versao}."
+    proprio = f"{prefixo}{NO_ID}.{os.getpid()}.jsonl"
+    if not os.path.exists(proprio):
+        for caminho in glob.glob(f"{glob.escape(prefixo)}*.jsonl"):
+            no, pid = _dono_checkpoint(caminho[len(prefixo):])
+            if no == NO_ID and pid is not None and not processo_vivo(pid):
+                try:
+                    os.rename(caminho, proprio)
+                    break
+                except OSError:
+                    continue  # outro processo adotou-o primeiro
+    return proprio
+
+
+def _dono_checkpoint(nome):
+    # "<nó>.<pid>.jsonl" -> (nó, pid), ou (None, None)
+    no, _, pid = nome[:-len(".jsonl")].rpartition(".")
+    return (no, int(pid)) if pid.isdigit() else (None, None)
+
+
+def iniciar_reavaliacao():
+    # reavalia o histórico com as regras atuais numa thread; o conjunto
+    # servido só é trocado quando o trabalho termina (_concluir_reavaliacao)
+    # devolve o progresso do trabalho
+    tabela_regras, versao = _regras_compiladas()
+
+    with _ALERTAS_LOCK:
+        conjunto, trabalho = _ALERTAS["conjunto"], _ALERTAS["trabalho"]
+        if trabalho is not None and trabalho.ativo():
+            if trabalho.versao == versao:
+                return trabalho.progresso()
+            trabalho.cancelar()  # regras mudaram outra vez a meio
+            trabalho.remover_checkpoint()
+
+        if conjunto is not None and conjunto.versao == versao and conjunto.sincronizado(_assinatura_dados()):
+            # já em dia
+            _ALERTAS["trabalho"] = None
+            return consultar_reavaliacao()
+
+        snapshot = abrir_snapshot()
+        snapshot.libertar()
+        if not snapshot.ficheiros:
+            # sem ficheiros não há nada a avaliar
+            _ALERTAS["conjunto"] = ConjuntoAlertas(versao, tabela_regras, assinatura=snapshot.assinatura)
+            _ALERTAS["trabalho"] = None
+            return consultar_reavaliacao()
+
+        print(f"Log: A reavaliar os alertas com as regras {versao} em segundo plano...")
+        trabalho = _ALERTAS["trabalho"] = _novo_trabalho_reavaliacao()
+        trabalho.ao_concluir = _concluir_reavaliacao
+        trabalho.iniciar()
+        return trabalho.progresso()
+
+
+def _concluir_reavaliacao(trabalho):
+    # chamado pela thread do trabalho quando a fila de ficheiros esvazia
+    # sob o lock nenhum ficheiro novo pode entrar entre a verificação e a troca
+    with _ALERTAS_LOCK:
+        if trabalho.processados < len(trabalho.ficheiros):
+            return False  # chegaram ficheiros entretanto: continua
+        if _ALERTAS["trabalho"] is trabalho and trabalho.versao == _regras_compiladas()[1]:
+            _ALERTAS["conjunto"] = trabalho.resultado()
+            print(f"Log: Alertas com as regras {trabalho.versao} ativados.")
+        return True
+
+
+def consultar_reavaliacao():
+    # progresso da reavaliação mais recente (GET /api/configuracoes/reavaliacao)
+    with _ALERTAS_LOCK:
+        conjunto, trabalho = _ALERTAS["conjunto"], _ALERTAS["trabalho"]
+        progresso = trabalho.progresso() if trabalho is not None else {"estado": "inativo"}
+        progresso["versao_servida"] = conjunto.versao if conjunto is not None else None
+        return progresso
+
+
+def _registar_alertas(documento, assinatura_antes, assinatura_depois):
+    # leitura nova: entra no conjunto servido e na fila da reavaliação,
+    # com as que outros processos gravaram entretanto (ver _alcancar)
+    with _ALERTAS_LOCK:
+        conjunto, trabalho = _ALERTAS["conjunto"], _ALERTAS["trabalho"]
+        if conjunto is not None and _alcancar(conjunto, {documento["ficheiro"]: documento}) is None:
+            conjunto.registar(documento, assinatura_antes, assinatura_depois)
+        if trabalho is not None and trabalho.ativo():
+            novos = _ficheiros_novos(trabalho.assinatura)
+            if novos is None or not trabalho.alcancar(novos[0], trabalho.assinatura, novos[2]):
+                trabalho.adicionar_ficheiro(documento["ficheiro"], assinatura_antes, assinatura_depois)
+
+
+def _get_tabela_regras():
+    # devolve as regras compiladas (TabelaRegras)
+    return _regras_compiladas()[0]
+
+
+def _regras_compiladas():
+    # (TabelaRegras, versão) das regras atuais, sempre do mesmo ficheiro
+    # só recompila quando o 'regras_atuais.json' muda no disco
+    with _TABELA_REGRAS_LOCK:
+        try:
+            info = os.stat(REGRAS_VALIDACAO)
+            assinatura = (info.st_mtime_ns, info.st_size)
+        except OSError:
+            assinatura = None
+
+        anterior, tabela, versao = _TABELA_REGRAS["regras"]
+        if assinatura is None or anterior != assinatura:
+            regras = _get_regras_validacao()
+            tabela = TabelaRegras(regras)
+            versao = hashlib.sha1(json.dumps(regras, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+            _TABELA_REGRAS["regras"] = (assinatura, tabela, versao)
+        return tabela, versao
+
+
+def _invalidar_regras():
+    # força recompilar as regras na próxima leitura
+    with _TABELA_REGRAS_LOCK:
+        _, tabela, versao = _TABELA_REGRAS["regras"]
+        _TABELA_REGRAS["regras"] = (None, tabela, versao)
 
 
 def _get_regras_validacao():
@@ -288,6 +1041,8 @@ def _get_regras_validacao():
 
         with open(REGRAS_VALIDACAO, 'r', encoding='utf-8') as f:
             regras = json.load(f)
+        # ficheiro editado à mão: regras com outra forma não são usadas
+        validar_regras(regras)
         return regras
 
     except FileNotFoundError:
@@ -296,6 +1051,9 @@ def _get_regras_validacao():
     except json.JSONDecodeError:
         print(f"Erro Crítico: Ficheiro de regras {REGRAS_VALIDACAO} tem um JSON inválido.")
         return {}
+    except ValueError as e:
+        print(f"Erro Crítico: Ficheiro de regras {REGRAS_VALIDACAO} tem regras inválidas: {e}")
+        return {}
     except Exception as e:
         print(f"Erro inesperado ao ler ficheiro de regras: {e}")
         return {}
@@ -309,7 +1067,13 @@ def ler_configuracoes_regras():
 
 def atualizar_configuracoes_regras(novas_regras: dict):
     # recebe um dicionário Python e sobrescreve o 'regras.json'
+    # as regras são verificadas antes: nada é gravado se forem inválidas
     print("Log: A atualizar ficheiro de regras de negócio...")
+    try:
+        validar_regras(novas_regras)
+    except ValueError as e:
+        print(f"Erro ao atualizar regras (Formato): {e}")
+        abort(400, description=f"JSON de regras inválido: {e}")
     try:
         # REGRAS_VALIDACAO é o caminho para o 'regras.json'
         with open(REGRAS_VALIDACAO, 'w', encoding='utf-8') as f:
@@ -317,6 +1081,7 @@ def atualizar_configuracoes_regras(novas_regras: dict):
             # indent=4 torna o ficheiro legível
             json.dump(novas_regras, f, indent=4)
 
+        _invalidar_regras()
         print("Log: Ficheiro de regras atualizado com sucesso.")
         return True
 
@@ -335,6 +1100,7 @@ def resetar_regras_para_default():
     try:
         print("Log: A restaurar regras de negócio para o padrão...")
         shutil.copyfile(REGRAS_DEFAULT_PATH, REGRAS_VALIDACAO)
+        _invalidar_regras()
         print("Log: Regras restauradas com sucesso.")
         return True
     except Exception as e:
@@ -342,13 +1108,55 @@ def resetar_regras_para_default():
         abort(500, description="Erro interno ao restaurar as regras.")
 
 
-def exportar_dados_para_csv():
+def _excluir_ficheiros(ficheiros):
+    # remove os ficheiros indicados (exclusão vinda de outro nó): os
+    # ficheiros de uma geração nunca são apagados um a um, passa-se para
+    # uma geração nova só com os que ficam
+    excluir = set(ficheiros)
+    snapshot = abrir_snapshot()
+    snapshot.libertar()
+    antiga = GERACOES.trocar(manter=[f for f in snapshot.ficheiros if f not in excluir])
+    _descartar_memoria(ficheiros)
+    # os IDs excluídos podem voltar a ser usados (já estamos na thread da replicação)
+    CLUSTER.libertar(ficheiro[:-len(".xml")] for ficheiro in ficheiros)
+    GERACOES.recolher(antiga)
+
+
+def _descartar_memoria(ficheiros):
+    # as vistas em memória deixam de valer; os alertas continuam a ser
+    # servidos (sem os dos ficheiros excluídos) até a reavaliação em
+    # segundo plano terminar
+    for vista in _VISTAS:
+        vista.invalidar()
+    with _ALERTAS_LOCK:
+        if _ALERTAS["trabalho"] is not None:
+            _ALERTAS["trabalho"].cancelar()
+        _ALERTAS["trabalho"] = None
+        _remover_checkpoints()
+        if _ALERTAS["conjunto"] is not None and ficheiros:
+            _ALERTAS["conjunto"] = _ALERTAS["conjunto"].sem_ficheiros(ficheiros)
+        iniciar_reavaliacao()
+
+
+def _remover_checkpoints():
+    # a geração mudou: os checkpoints deste processo (e os de processos que
+    # já terminaram) deixam de servir; os de outros processos vivos ficam
+    for caminho in glob.glob(f"{glob.escape(_PREFIXO_CHECKPOINT)}-*.jsonl"):
+        _, pid = _dono_checkpoint(caminho)
+        if pid is not None and (pid == os.getpid() or not processo_vivo(pid)):
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+
+
+def exportar_dados_para_csv(snapshot=None):
     # Lê todos os dados persistidos, achata e converte
     # para uma string no formato CSV
     print("Log: Iniciando exportação para CSV...")
 
     # obter os dados (reutiliza a nossa função do GET)
-    todos_os_dados = ler_dados_persistidos()
+    todos_os_dados = ler_dados_persistidos(snapshot)
 
     # "achata" (Flatten) os dados
     # transforma a lista de estufas (com listas de leituras)
@@ -395,15 +1203,32 @@ def exportar_dados_para_csv():
 
 def excluir_todas_as_leituras():
     # Exclui permanentemente todos os ficheiros .xml da pasta DATA_DIR.
+    # troca para uma geração vazia (atómico) e apaga a antiga em segundo
+    # plano: o pedido não espera pelos os.remove de cada ficheiro
     print("Log: Recebida ordem para excluir todos os dados...")
     try:
-        ficheiros_excluidos = 0
-        for ficheiro in os.listdir(DATA_DIR):
-            if ficheiro.endswith('.xml'):
-                filepath = os.path.join(DATA_DIR, ficheiro)
-                os.remove(filepath)
-                ficheiros_excluidos += 1
-
+        # sob o lock dos alertas: uma gravação deste processo fica toda
+        # antes (e é excluída) ou toda depois da troca
+        with _ALERTAS_LOCK:
+            excluida_em = time.time()
+            antiga = GERACOES.trocar()
+            # a geração nova está vazia: as vistas e os alertas ficam vazios
+            _descartar_memoria(())
+        # os outros nós excluem exatamente estes ficheiros (leituras que
+        # entretanto chegaram a outro nó não são apagadas): os do manifesto
+        # da geração antiga, já em memória (sem percorrer a pasta); um
+        # ficheiro registado depois da troca é gravado de novo na geração nova
+        ficheiros = GERACOES.ficheiros(antiga)
+        CLUSTER.registo.acrescentar({"no": NO_ID, "op": "excluir", "ficheiros": ficheiros})
+
+        def libertar_reservas():
+            # os IDs excluídos voltam a poder ser usados (em segundo plano,
+            # com a geração antiga: são muitos ficheiros de reserva)
+            libertadas = CLUSTER.libertar((f[:-len(".xml")] for f in ficheiros), antes_de=excluida_em)
+            print(f"Log: {libertadas} reservas de IDs libertadas.")
+
+        GERACOES.recolher(antiga, depois=libertar_reservas if CLUSTER.ativo else None)
+        ficheiros_excluidos = len(ficheiros)
         print(f"Log: {ficheiros_excluidos} ficheiros excluídos.")
         return {"message": f"{ficheiros_excluidos} ficheiros de leitura foram excluídos com sucesso."}
 
@@ -0,0 +1,100 @@
+# base das estruturas em memória derivadas dos ficheiros do DATA_DIR
+# (cache de leituras recentes, estado atual dos sensores...)
+#
+# cada vista guarda a "assinatura" do DATA_DIR que reflete; se os ficheiros
+# mudarem por outra via a assinatura deixa de bater: ficheiros gravados por
+# outro processo entram pelo fim do manifesto (alcancar), o resto (ficheiros
+# apagados à mão, outra geração) faz a vista ser recarregada a partir do disco
+
+import threading
+from abc import ABC, abstractmethod
+
+
+class VistaMemoria(ABC):
+    # as subclasses implementam _limpar() e _adicionar_documento(documento)
+
+    def __init__(self):
+        self.assinatura = None
+        self._lock = threading.Lock()
+        self._ficheiros = set()  # ficheiros já refletidos na vista
+        self._limpar()
+
+    @abstractmethod
+    def _limpar(self):
+        # esvazia as estruturas da vista
+        ...
+
+    @abstractmethod
+    def _adicionar_documento(self, documento):
+        # reflete na vista um documento extraído (chamado com o _lock)
+        ...
+
+    def _incluir(self, documento):
+        # um ficheiro gravado enquanto a vista era recarregada pode chegar
+        # duas vezes (pela listagem e pelo registar); só conta uma
+        ficheiro = documento.get("ficheiro")
+        if ficheiro is not None:
+            if ficheiro in self._ficheiros:
+                return
+            self._ficheiros.add(ficheiro)
+        self._adicionar_documento(documento)
+
+    def nova(self):
+        # vista vazia com a mesma configuração, para ser recarregada fora
+        # do lock e depois adotada (ver service_xml._recarregar_vista)
+        return type(self)()
+
+    def incluir(self, documento):
+        with self._lock:
+            self._incluir(documento)
+
+    def adotar(self, outra):
+        # passa a usar o estado de outra vista, já recarregada
+        with self._lock, outra._lock:
+            estado = dict(vars(outra))
+            del estado["_lock"]
+            vars(self).update(estado)
+
+    def sincronizado(self, assinatura):
+        return self.assinatura is not None and self.assinatura == assinatura
+
+    def recarregar(self, documentos, assinatura):
+        # reconstrói a vista a partir dos documentos persistidos
+        with self._lock:
+            self._limpar()
+            self._ficheiros = set()
+            for documento in documentos:
+                self._incluir(documento)
+            self.assinatura = assinatura
+
+    def registar(self, documento, assinatura_antes, assinatura_depois):
+        # acrescenta um documento acabado de persistir
+        # se o DATA_DIR mudou por outra via entretanto, marca para recarregar
+        with self._lock:
+            if not self.sincronizado(assinatura_antes):
+                self.assinatura = None
+                return
+            self._incluir(documento)
+            self.assinatura = assinatura_depois
+
+    def desatualizar(self):
+        # marca para recarregar, sem deixar de servir o que já tem
+        with self._lock:
+            self.assinatura = None
+
+    def alcancar(self, documentos, assinatura_antes, assinatura):
+        # acrescenta os documentos gravados desde assinatura_antes (por
+        # outro processo); devolve False se a vista já não estiver nesse estado
+        with self._lock:
+            if not self.sincronizado(assinatura_antes):
+                return False
+            for documento in documentos:
+                self._incluir(documento)
+            self.assinatura = assinatura
+            return True
+
+    def invalidar(self):
+        with self._lock:
+            self._limpar()
+            self._ficheiros = set()
+            self.assinatura = None
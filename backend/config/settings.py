@@ -3,9 +3,79 @@ import os
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 XSD_PATH = os.path.join(BASE_DIR, "app", "model", "schema.xsd")
-DATA_DIR = os.path.join(BASE_DIR, "data")
+# (ESTUFA_DATA_DIR permite correr vários nós na mesma máquina)
+DATA_DIR = os.environ.get("ESTUFA_DATA_DIR", os.path.join(BASE_DIR, "data"))
+# segundos entre excluir tudo (troca de geração) e apagar a geração antiga;
+# depois disso a recolha ainda espera pelas leituras em curso (deste e de
+# outros processos do mesmo DATA_DIR, ver geracoes.py)
+GERACOES_ESPERA_RECOLHA = 1.0
 
 # as regras estão em um arquivo .json para que seja possível alterar
 # as configurações (min e máx dos sensores)
 REGRAS_VALIDACAO = os.path.join(BASE_DIR, "config", "regras_atuais.json")
 REGRAS_DEFAULT_PATH = os.path.join(BASE_DIR, "config", "regras_default.json")
+
+# cache em memória das leituras recentes (GET /api/leituras?horas=N)
+# janela guardada por sensor e número máximo de leituras por sensor
+CACHE_JANELA_HORAS = 24
+CACHE_CAPACIDADE_SENSOR = 4096
+
+# compressão das respostas (Accept-Encoding: zstd, br, gzip)
+# respostas menores do que o tamanho mínimo (bytes) vão sem compressão
+COMPRESSAO_TAMANHO_MINIMO = 1024
+COMPRESSAO_NIVEIS = {"zstd": 3, "br": 4, "gzip": 6}
+
+# GET /api/estado-atual: nº de leituras mais recentes de cada sensor
+# usadas nas estatísticas (média, mínimo, máximo)
+ESTADO_JANELA_ESTATISTICAS = 20
+
+# reavaliação dos alertas em segundo plano quando as regras mudam
+# nº de ficheiros por lote e prefixo do checkpoint (um por DATA_DIR, geração,
+# versão das regras e processo: ver service_xml._checkpoint_reavaliacao)
+REAVALIACAO_TAMANHO_LOTE = 200
+REAVALIACAO_CHECKPOINT = os.path.join(BASE_DIR, "config", "reavaliacao")
+# sem nenhum conjunto de alertas ainda (arranque), o GET /api/alertas espera
+# até ALERTAS_ESPERA_INICIAL segundos pela avaliação; depois responde 503
+ALERTAS_ESPERA_INICIAL = 10.0
+ALERTAS_RETRY_AVALIACAO = 1  # Retry-After (s) desse 503
+
+# replicação entre nós (ver replicacao.py)
+# ESTUFA_PARES: os outros nós, ex: "B=http://10.0.0.2:5000,C=http://10.0.0.3:5000"
+# (todos os nós precisam da mesma lista); sem pares o nó funciona sozinho
+NO_ID = os.environ.get("ESTUFA_NO_ID", "local")
+PARES = dict(par.split("=", 1) for par in os.environ.get("ESTUFA_PARES", "").split(",") if par)
+# segredo partilhado pelos nós: as rotas /api/replicacao/* só respondem a
+# pedidos com ele (cabeçalho X-Estufa-Cluster); sem pares dão 404
+REPLICACAO_SEGREDO = os.environ.get("ESTUFA_SEGREDO_CLUSTER", "")
+REPLICACAO_DIR = os.environ.get("ESTUFA_REPLICACAO_DIR", os.path.join(BASE_DIR, "replicacao"))
+REPLICACAO_INTERVALO = 1.0  # segundos entre cada leitura dos registos dos pares
+REPLICACAO_TIMEOUT = 2.0
+# segundos até uma reserva de ID que ficou para trás (gravação que nunca
+# chegou ao nó responsável) poder ser recuperada
+REPLICACAO_VALIDADE_RESERVA = 300.0
+
+# métricas derivadas na ingestão (ver metricas_derivadas.py)
+# distância máxima (s) entre a temperatura e a umidade usadas em conjunto,
+# fator lux -> PPFD (µmol/m²/s, luz solar) e maior intervalo (s) entre
+# leituras de luminosidade que ainda conta para o DLI
+DERIVADAS_JANELA_SEGUNDOS = 600
+DERIVADAS_LUX_PARA_PPFD = 0.0185
+DERIVADAS_DLI_INTERVALO_MAX = 3600
+# fuso horário (nome IANA) que define o "dia" do DLI; uma dataHora sem fuso
+# conta como UTC, por isso com "UTC" o dia é o que está escrito na dataHora
+DERIVADAS_DLI_FUSO = os.environ.get("ESTUFA_FUSO_DLI", "UTC")
+
+# controlo de admissão (ver admissao.py)
+# POSTs de leituras por segundo de cada gateway e rajada permitida
+ADMISSAO_TAXA_INGESTAO = 10.0
+ADMISSAO_RAJADA_INGESTAO = 50
+# pedidos em simultâneo que cada classe pode ter neste processo: a
+# ingestão pára antes do total, por isso há sempre lugares para as
+# leituras (dashboard) e para as configurações
+ADMISSAO_LIMITES_CLASSE = {"ingestao": 12, "leitura": 15, "configuracao": 16}
+ADMISSAO_RETRY_OCUPADO = 1  # Retry-After (s) do 503 quando não há lugar
+ADMISSAO_MAX_CLIENTES = 10000  # baldes guardados em memória
+# gateways (X-Estufa-Id) que um mesmo endereço pode ter a enviar à taxa
+# máxima: o balde do endereço tem esta taxa e rajada multiplicadas
+ADMISSAO_GATEWAYS_POR_IP = 8
+ADMISSAO_INTERVALO_LOG = 10  # segundos entre logs de pedidos recusados
@@ -2,8 +2,10 @@
 import pytest
 import os
 import json
+from flask.testing import FlaskClient
 from backend.app.main import app
-from backend.config.settings import DATA_DIR, REGRAS_VALIDACAO
+from backend.app import service_xml
+from backend.config.settings import REGRAS_VALIDACAO, ADMISSAO_TAXA_INGESTAO, ADMISSAO_RAJADA_INGESTAO
 
 XML_VALIDO = """
 <estufa id="E01">
@@ -121,6 +123,15 @@ REGRAS_DEFAULT = {
 }
 
 # prepara o app para testes
+class ClienteTeste(FlaskClient):
+    # fecha cada resposta logo depois de a ler, como um servidor WSGI: o
+    # lugar do controlo de admissão de um stream só é libertado quando a
+    # resposta fecha (buffered=False mantém o stream aberto)
+    def open(self, *args, **kwargs):
+        kwargs.setdefault("buffered", True)
+        return super().open(*args, **kwargs)
+
+
 @pytest.fixture
 def client():
     # configura um cliente de teste do Flask
@@ -129,11 +140,6 @@ def client():
 
     app.config['TESTING'] = True  # modo de teste
 
-    # antes de cada teste
-    for f in os.listdir(DATA_DIR):
-        if f.endswith('.xml'):
-            os.remove(os.path.join(DATA_DIR, f))
-
     # cria um 'regras.json' de teste limpo
     try:
         with open(REGRAS_VALIDACAO, 'w', encoding='utf-8') as f:
@@ -141,20 +147,22 @@ def client():
     except Exception as e:
         print(f"Erro ao criar regras de teste: {e}")
 
+    # antes de cada teste (também descarta os alertas em memória); depois
+    # das regras, para os alertas (vazios) já ficarem com as regras de teste
+    service_xml.excluir_todas_as_leituras()
+
     # roda o teste
-    with app.test_client() as client:
+    with ClienteTeste(app, app.response_class) as client:
         yield client  # <-- teste roda aqui
 
     # depois de cada teste
-    for f in os.listdir(DATA_DIR):
-        if f.endswith('.xml'):
-            os.remove(os.path.join(DATA_DIR, f))
+    service_xml.excluir_todas_as_leituras()
 
 
 # --- Testes ---
 def test_post_leitura_sucesso(client):
     # caminho esperado do ficheiro
-    expected_file_path = os.path.join(DATA_DIR, "L01.xml")
+    expected_file_path = os.path.join(service_xml.diretorio_dados(), "L01.xml")
     # garante que o ficheiro não existe (a fixture limpou)
     assert not os.path.exists(expected_file_path)
 
@@ -196,7 +204,7 @@ def test_post_leitura_falha_regras_negocio(client):
     # chamado para o alerta de sensor fora da faixa
     assert response.status_code == 201
     # verifica se o ficheiro foi criado
-    assert os.path.exists(os.path.join(DATA_DIR, "L03.xml"))
+    assert os.path.exists(os.path.join(service_xml.diretorio_dados(), "L03.xml"))
 
 
 def test_post_leitura_falha_conflito_409(client):
@@ -209,7 +217,7 @@ def test_post_leitura_falha_conflito_409(client):
                             content_type='application/xml')
     # Garante que a primeira chamada foi bem-sucedida
     assert response1.status_code == 201
-    assert os.path.exists(os.path.join(DATA_DIR, "L01.xml"))
+    assert os.path.exists(os.path.join(service_xml.diretorio_dados(), "L01.xml"))
 
     # segunda chamada (ID duplicado)
     # envia o mesmo XML da primeira chamada
@@ -223,13 +231,57 @@ def test_post_leitura_falha_conflito_409(client):
     assert "Conflito" in response2.json['error']['description']
 
 
+def test_reserva_desfeita_quando_gravacao_falha(client, monkeypatch, tmp_path):
+    # com réplicas, o ID é reservado antes de gravar; se a gravação falhar
+    # a reserva é desfeita e o mesmo ID pode ser reenviado
+    from backend.app.replicacao import Cluster
+
+    pares = {"A": "http://127.0.0.1:9", "B": "http://127.0.0.1:9"}
+    no = Cluster("A", {"B": pares["B"]}, str(tmp_path / "sonda")).no_responsavel("L01")
+    cluster = Cluster(no, {par: url for par, url in pares.items() if par != no},
+                      str(tmp_path / "replicacao"), validade=60)
+    monkeypatch.setattr(service_xml, "CLUSTER", cluster)
+
+    link = os.link
+    falhas = [OSError(28, "No space left on device")]
+
+    def link_que_falha(origem, destino):
+        if falhas:
+            raise falhas.pop()
+        return link(origem, destino)
+
+    monkeypatch.setattr(os, "link", link_que_falha)
+    assert client.post('/api/leituras', data=XML_VALIDO, content_type='application/xml').status_code == 500
+    assert client.post('/api/leituras', data=XML_VALIDO, content_type='application/xml').status_code == 201
+    assert client.post('/api/leituras', data=XML_VALIDO, content_type='application/xml').status_code == 409
+
+    # só o dono desfaz a reserva; uma reserva expirada é recuperada, a não
+    # ser que a leitura já exista neste nó
+    assert cluster.reservar_local("R1", "dono-1")
+    assert not cluster.reservar_local("R1", "dono-2")
+    cluster.desfazer_reserva_local("R1", "dono-2")
+    assert not cluster.reservar_local("R1", "dono-2")
+    with open(cluster._caminho_reserva("R1"), "w", encoding="utf-8") as f:
+        json.dump({"dono": "dono-1", "em": 0}, f)
+    assert not cluster.reservar_local("R1", "dono-2", existe=True)
+    assert cluster.reservar_local("R1", "dono-2")
+    assert not cluster.reservar_local("R1", "dono-3")
+
+
+def test_rotas_de_replicacao_sem_cluster(client):
+    # um nó sozinho não tem rotas de replicação
+    assert client.get('/api/replicacao/alteracoes').status_code == 404
+    assert client.post('/api/replicacao/reservas/L01?dono=x').status_code == 404
+    assert client.delete('/api/replicacao/reservas/L01?dono=x').status_code == 404
+
+
 def test_get_leituras(client):
     # Testa o GET /api/leituras.
     # cria dados válidos (POST) e verifica
     # se o GET os retorna corretamente.
 
     # cria os dados e garante q o ambiente tá limpo
-    test_file_path = os.path.join(DATA_DIR, "L01.xml")
+    test_file_path = os.path.join(service_xml.diretorio_dados(), "L01.xml")
     if os.path.exists(test_file_path):
         os.remove(test_file_path)
 
@@ -342,6 +394,23 @@ def test_post_configuracoes_reset(client):
     assert response_get_2.json['temperatura']['min'] == 12
 
 
+def test_put_configuracoes_invalidas(client):
+    # regras com outra forma: 400 e nada é gravado
+    client.put('/api/configuracoes', json=REGRAS_TESTE)
+    for regras in ([1, 2], {"ph": 5}, {"ph": {"min": "4"}}, {"ph": {"min": 7, "max": 6}},
+                   {"ph": {"histerese": -1}}, {"estufas": {"E01": {"sensores": []}}}):
+        response = client.put('/api/configuracoes', json=regras)
+        assert response.status_code == 400, regras
+    assert client.get('/api/configuracoes').json == REGRAS_TESTE
+    assert client.post('/api/leituras', data=XML_VALIDO, content_type='application/xml').status_code == 201
+
+    # um ficheiro editado à mão com outra forma não faz falhar a ingestão
+    with open(REGRAS_VALIDACAO, 'w') as f:
+        json.dump([1, 2], f)
+    assert client.post('/api/leituras', data=XML_INVALIDO_REGRAS,
+                       content_type='application/xml').status_code == 201
+
+
 def test_get_exportar_csv_sucesso(client):
     # testa o sucesso de GET /api/exportar?formato=csv
 
@@ -414,7 +483,7 @@ def test_delete_leituras(client):
     assert response_post.status_code == 201
 
     # Verifica se o ficheiro foi realmente criado
-    caminho_ficheiro = os.path.join(DATA_DIR, "L01.xml")
+    caminho_ficheiro = os.path.join(service_xml.diretorio_dados(), "L01.xml")
     assert os.path.exists(caminho_ficheiro)
 
     #  chama o DELETE
@@ -426,5 +495,944 @@ def test_delete_leituras(client):
     assert response_delete.status_code == 200
     assert 'message' in response_delete.json
     assert "excluídos com sucesso" in response_delete.json['message']
-    # O ficheiro não deve mais existir no disco
+    # O ficheiro já não está na geração ativa
+    assert not os.path.exists(os.path.join(service_xml.diretorio_dados(), "L01.xml"))
+    # e deixa de existir no disco quando a geração antiga for recolhida
+    service_xml.GERACOES.aguardar_recolhas(5)
     assert not os.path.exists(caminho_ficheiro)
+
+
+def test_motor_regras_avaliacao_em_lote():
+    # testa a avaliação vetorizada das regras (sem passar pela API)
+    # limites são inclusivos e tipos sem regra nunca geram alerta
+    from backend.app.motor_regras import LoteLeituras
+
+    lote = LoteLeituras()
+    ph = lote.codigo("ph", REGRAS_TESTE["ph"])
+    temperatura = lote.codigo("temperatura", REGRAS_TESTE["temperatura"])
+    desconhecido = lote.codigo("desconhecido", None)
+    lote.adicionar(ph, 4.0)              # no limite -> ok
+    lote.adicionar(temperatura, 31.0)    # acima do max -> alerta
+    lote.adicionar(ph, 3.9)              # abaixo do min -> alerta
+    lote.adicionar(desconhecido, 1e9)    # sem regra -> ok
+    lote.adicionar(temperatura, 30.0)    # no limite -> ok
+
+    assert lote.codigo("ph", dict(REGRAS_TESTE["ph"])) == ph
+    assert list(lote.avaliar()) == [1, 2]
+    assert list(LoteLeituras().avaliar()) == []
+
+
+def test_motor_regras_histerese_taxa_duracao():
+    # testa as regras com estado do avaliador incremental
+    from backend.app.motor_regras import AvaliadorIncremental
+
+    avaliador = AvaliadorIncremental()
+    regra = {"min": 10, "max": 25, "histerese": 1}
+    # oscila em cima do limite: só o primeiro cruzamento gera alerta
+    motivos = [avaliador.avaliar(("E01", "S01"), regra, 60 * i, valor)
+               for i, valor in enumerate([24.0, 25.5, 24.8, 25.3, 23.5, 25.2])]
+    assert motivos == [[], ["faixa"], [], [], [], ["faixa"]]
+
+    # só alerta depois de 10 minutos fora da faixa
+    regra = {"min": 10, "max": 25, "duracao_min": 10}
+    motivos = [avaliador.avaliar(("E01", "S02"), regra, 300 * i, 30.0) for i in range(4)]
+    assert motivos == [[], [], ["duracao"], []]
+
+    # subida rápida ainda dentro dos limites
+    regra = {"min": 10, "max": 25, "taxa_max": 0.5}
+    assert avaliador.avaliar(("E01", "S03"), regra, 0, 12.0) == []
+    assert avaliador.avaliar(("E01", "S03"), regra, 120, 13.0) == []
+    assert avaliador.avaliar(("E01", "S03"), regra, 240, 20.0) == ["taxa"]
+    # leitura fora de ordem não conta para a taxa
+    assert avaliador.avaliar(("E01", "S03"), regra, 60, 14.0) == []
+
+    # sem histerese nem duração a faixa não tem estado: alerta sempre
+    assert avaliador.avaliar(("E01", "S03"), regra, 360, 26.0) == ["faixa", "taxa"]
+    assert avaliador.avaliar(("E01", "S03"), regra, 480, 26.5) == ["faixa"]
+    assert avaliador.avaliar(("E01", "S03"), regra, 70, 99.0) == ["faixa"]
+
+
+def test_data_hora_para_epoch_xs_datetime():
+    # aceita as formas de xs:dateTime que o fromisoformat não lê
+    from backend.app.motor_regras import data_hora_para_epoch
+
+    base = data_hora_para_epoch("2025-11-10T00:00:00")
+    assert data_hora_para_epoch("2025-11-09T24:00:00") == base
+    assert data_hora_para_epoch("2025-11-10T00:00:00Z") == base
+    assert data_hora_para_epoch("2025-11-10T01:00:00+01:00") == base
+    assert data_hora_para_epoch("2025-11-10T00:00:00.123456789") == base + 0.123456
+    with pytest.raises(ValueError):
+        data_hora_para_epoch("10/11/2025 00:00")
+
+
+def test_post_leitura_ano_fora_do_intervalo(client):
+    # anos que o XSD aceita mas que não se convertem: 400 antes de gravar
+    for data_hora in ("12025-11-10T14:30:00", "-0005-11-10T14:30:00"):
+        xml = XML_VALIDO.replace("2025-11-10T14:30:00", data_hora)
+        response = client.post('/api/leituras', data=xml, content_type='application/xml')
+        assert response.status_code == 400
+        assert "0001 a 9999" in response.json["error"]["description"]
+    assert client.post('/api/leituras', data=XML_VALIDO, content_type='application/xml').status_code == 201
+
+    # um ficheiro assim já gravado é ignorado (com log) por quem o relê
+    snapshot = service_xml.abrir_snapshot()
+    snapshot.libertar()
+    with open(os.path.join(snapshot.diretorio, "L09.xml"), "w", encoding="utf-8") as f:
+        f.write(XML_VALIDO.replace("L01", "L09").replace("L02", "L10")
+                .replace("2025-11-10T14:30:00", "12025-11-10T14:30:00"))
+    service_xml.GERACOES.registar(snapshot.diretorio, "L09.xml")
+    response = client.get('/api/estado-atual')
+    assert response.status_code == 200
+    assert client.get('/api/alertas').status_code == 200
+
+
+def test_post_leitura_id_invalido_como_ficheiro(client):
+    # IDs que o XSD aceita mas que não podem dar nome a um ficheiro
+    # (o manifesto tem um nome por linha): 400 antes de gravar
+    for leitura_id in ("A&#10;B", "../L01", "A&#13;B"):
+        xml = XML_VALIDO.replace('id="L01"', f'id="{leitura_id}"')
+        response = client.post('/api/leituras', data=xml, content_type='application/xml')
+        assert response.status_code == 400
+        assert "ID de leitura inválido" in response.json["error"]["description"]
+    assert client.get('/api/leituras').json == []
+
+    # um ID com \u2028 é um nome válido e não parte a linha do manifesto
+    xml = XML_VALIDO.replace('id="L01"', 'id="A&#x2028;B"')
+    assert client.post('/api/leituras', data=xml, content_type='application/xml').status_code == 201
+    assert "A\u2028B" in [l["id"] for e in client.get('/api/leituras').json for l in e["leituras"]]
+
+
+def test_get_alertas_com_histerese(client):
+    # com histerese configurada, duas leituras seguidas fora da faixa
+    # no mesmo sensor geram um único alerta
+    regras = dict(REGRAS_TESTE, ph={"min": 4.0, "max": 6.0, "histerese": 0.2})
+    assert client.put('/api/configuracoes', json=regras).status_code == 200
+
+    xml = XML_INVALIDO_REGRAS.replace("<valor>22.5</valor>", "<valor>35.0</valor>")
+    xml = xml.replace('ref="S01"', 'ref="S02"').replace("3.0", "6.1")
+    assert client.post('/api/leituras', data=xml,
+                       content_type='application/xml').status_code == 201
+
+    alertas = client.get('/api/alertas').json
+    assert len(alertas) == 1
+    assert alertas[0]['leitura_id'] == 'L03'
+    assert alertas[0]['motivo'] == 'faixa'
+
+
+def test_avaliador_so_avanca_com_leitura_gravada(client):
+    # um documento rejeitado com 409 não conta como leitura vista
+    regras = dict(REGRAS_TESTE, ph={"min": 4.0, "max": 6.0, "histerese": 0.2})
+    assert client.put('/api/configuracoes', json=regras).status_code == 200
+    xml = XML_VALIDO.replace('id="E01"', 'id="E77"')
+    assert client.post('/api/leituras', data=xml, content_type='application/xml').status_code == 201
+    visto = service_xml._AVALIADOR.estados[("E77", "S02")].ultimo_instante
+
+    repetido = xml.replace("2025-11-10T14:31:00", "2025-11-10T18:00:00")
+    assert client.post('/api/leituras', data=repetido, content_type='application/xml').status_code == 409
+    assert service_xml._AVALIADOR.estados[("E77", "S02")].ultimo_instante == visto
+
+
+def test_motor_regras_camadas():
+    # global -> <configuracoes> do documento -> estufa -> sensor
+    from backend.app.motor_regras import TabelaRegras, faixa_ideal
+
+    tabela = TabelaRegras(dict(REGRAS_TESTE, estufas={
+        "E02": {"tipos": {"ph": {"max": 7.0}},
+                "sensores": {"S09": {"min": 5.0}}}
+    }))
+    limites_doc = {"ph": {"min": 4.5, "max": 6.5}}
+
+    assert tabela.regra("E01", "S01", "ph") == {"min": 4.0, "max": 6.0}
+    assert tabela.regra("E01", "S01", "ph", limites_doc) == {"min": 4.5, "max": 6.5}
+    assert tabela.regra("E02", "S01", "ph", limites_doc) == {"min": 4.5, "max": 7.0}
+    assert tabela.regra("E02", "S09", "ph") == {"min": 5.0, "max": 7.0}
+    assert tabela.regra("E02", "S09", "inexistente") == {"min": 5.0}
+    assert tabela.regra("E01", "S01", "inexistente") is None
+
+    # regras com valores aninhados também servem de chave
+    aninhado = {"ph": {"min": 4.5, "notas": {"origem": ["manual", "doc"]}}}
+    assert tabela.regra("E01", "S01", "ph", aninhado)["notas"] == {"origem": ["manual", "doc"]}
+
+    # faixas só com um dos limites
+    assert faixa_ideal({"min": 4.0, "max": 6.0}) == "4.0 - 6.0"
+    assert faixa_ideal({"min": 5.0}) == ">= 5.0"
+    assert faixa_ideal({"max": 7.0, "taxa_max": 1}) == "<= 7.0"
+
+
+def test_get_alertas_regras_por_estufa_e_documento(client):
+    # o limite da estufa E01 e o bloco <configuracoes> do documento
+    # mudam a faixa usada para gerar os alertas
+    regras = dict(REGRAS_TESTE, estufas={"E01": {"tipos": {"temperatura": {"max": 20}}}})
+    assert client.put('/api/configuracoes', json=regras).status_code == 200
+
+    xml = XML_VALIDO.replace("</leituras>", """</leituras>
+    <configuracoes>
+        <limiteSensor tipo="ph"><min>6.5</min><max>7.0</max></limiteSensor>
+    </configuracoes>""")
+    assert client.post('/api/leituras', data=xml,
+                       content_type='application/xml').status_code == 201
+
+    alertas = client.get('/api/alertas').json
+    assert [(a['leitura_id'], a['faixa_ideal']) for a in alertas] == [
+        ('L01', '6 - 20'), ('L02', '6.5 - 7.0')]
+
+
+def test_cache_anel_cresce_sem_perder_leituras():
+    # ao crescer, o anel cheio continua a escrever no fim (não por cima da 1a)
+    from backend.app.cache_leituras import AnelSensor
+    anel = AnelSensor(0, 256)
+    for i in range(65):
+        anel.adicionar(1000 + i, float(i), f"L{i}", None)
+    assert [anel.ids[i] for i in anel.desde(0)] == [f"L{i}" for i in range(65)]
+    assert anel.descartado is None
+
+
+def test_cache_nao_cobre_leituras_descartadas():
+    # um anel cheio perde as leituras mais antigas: a consulta que as
+    # incluiria deixa de ser coberta pela memória (vai ao disco)
+    from backend.app.cache_leituras import CacheLeituras
+    import time
+
+    cache = CacheLeituras(janela_horas=24, capacidade=4)
+    agora = int(time.time())
+    leituras = [(f"L{i}", _data_hora_utc(agora - 3600 * (10 - i)), "S01", 5.0) for i in range(6)]
+    leituras.append(("C1", _data_hora_utc(agora - 36000), "S02", 500.0))
+    cache.recarregar([{"estufa_id": "E01", "sensores": {"S01": "ph", "S02": "co2"},
+                       "leituras": leituras}], "assinatura")
+
+    assert cache.cobre(8.5)          # as 4 leituras que ficaram (há 8h a 5h)
+    assert not cache.cobre(9.5)      # L0 e L1 (há 10h e 9h) foram descartadas
+    assert cache.cobre(12, tipo="co2")
+    assert not cache.cobre(48)       # maior do que a janela
+
+
+def _data_hora_utc(instante):
+    from datetime import datetime, timezone
+    return datetime.fromtimestamp(int(instante), timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def test_get_leituras_recentes(client):
+    # testa o GET /api/leituras?horas=N (servido pelo cache em memória)
+    from datetime import datetime, timedelta, timezone
+
+    agora = datetime.now(timezone.utc).replace(microsecond=0, tzinfo=None)
+    xml = XML_VALIDO.replace("2025-11-10T14:30:00", (agora - timedelta(hours=2)).isoformat())
+    xml = xml.replace("2025-11-10T14:31:00", (agora - timedelta(hours=30)).isoformat())
+    assert client.post('/api/leituras', data=xml,
+                       content_type='application/xml').status_code == 201
+
+    response = client.get('/api/leituras?horas=6')
+    assert response.status_code == 200
+    assert len(response.json) == 1
+    assert response.json[0]['estufa_id'] == 'E01'
+    assert [l['id'] for l in response.json[0]['leituras']] == ['L01']
+    assert response.json[0]['leituras'][0]['dataHora'] == (agora - timedelta(hours=2)).isoformat()
+
+    # fora da janela do cache: lê do disco, mesmo formato
+    response = client.get('/api/leituras?horas=48&tipo=ph')
+    assert [l['id'] for l in response.json[0]['leituras']] == ['L02']
+
+    # ficheiros apagados por fora da API invalidam o cache
+    os.remove(os.path.join(service_xml.diretorio_dados(), "L01.xml"))
+    assert client.get('/api/leituras?horas=6').json == []
+
+    assert client.get('/api/leituras?horas=abc').status_code == 400
+
+    # a dataHora sai tal como foi enviada (fuso e frações incluídos)
+    enviada = (datetime.now(timezone.utc) - timedelta(hours=1)).isoformat(timespec="microseconds")
+    xml_fuso = XML_VALIDO.replace("L01", "F01").replace("L02", "F02")
+    xml_fuso = xml_fuso.replace("2025-11-10T14:30:00", enviada)
+    assert client.post('/api/leituras', data=xml_fuso,
+                       content_type='application/xml').status_code == 201
+    leituras = client.get('/api/leituras?horas=6').json[0]['leituras']
+    assert [l['dataHora'] for l in leituras if l['id'] == 'F01'] == [enviada]
+
+
+def test_recarga_do_cache_nao_bloqueia_gravacoes(client, monkeypatch):
+    # a recarga do cache (ex: depois de um arranque) lê o histórico fora do
+    # lock das gravações: um POST não espera por ela
+    import threading
+    assert client.post('/api/leituras', data=XML_VALIDO, content_type='application/xml').status_code == 201
+    service_xml.CACHE_LEITURAS.invalidar()
+
+    a_ler, continuar = threading.Event(), threading.Event()
+    iterar = service_xml._iterar_documentos
+
+    def iterar_devagar(snapshot=None):
+        a_ler.set()
+        continuar.wait(10)
+        yield from iterar(snapshot)
+
+    monkeypatch.setattr(service_xml, "_iterar_documentos", iterar_devagar)
+    resultado = {}
+    leitor = threading.Thread(target=lambda: resultado.update(
+        linhas=service_xml.ler_leituras_recentes(24 * 365 * 10)))
+    leitor.start()
+    try:
+        assert a_ler.wait(10)
+        assert client.post('/api/leituras', data=XML_INVALIDO_REGRAS,
+                           content_type='application/xml').status_code == 201
+    finally:
+        continuar.set()
+        leitor.join(10)
+    assert "linhas" in resultado
+    # a gravação feita durante a recarga também entrou na vista trocada
+    assert service_xml.CACHE_LEITURAS.sincronizado(service_xml._assinatura_dados())
+    assert service_xml.CACHE_LEITURAS._ficheiros == {"L01.xml", "L03.xml"}
+
+
+def test_gerar_array_json_em_blocos(monkeypatch):
+    # o array é escrito em vários blocos e o resultado é JSON válido,
+    # com e sem o orjson instalado
+    from backend.app import json_rapido
+
+    itens = [{"id": f"L{i}", "valor": i / 2, "tipo": "temperatura"} for i in range(500)]
+    blocos = list(json_rapido.gerar_array_json(iter(itens), tamanho_bloco=1024))
+    assert len(blocos) > 1
+    assert json.loads(b"".join(blocos)) == itens
+    assert b"".join(json_rapido.gerar_array_json([])) == b"[]"
+
+    monkeypatch.setattr(json_rapido, "orjson", None)
+    assert json.loads(b"".join(json_rapido.gerar_array_json(itens))) == itens
+
+
+def test_get_leituras_em_stream(client):
+    # GET /api/leituras é enviado em stream e continua a ser JSON válido
+    assert client.post('/api/leituras', data=XML_VALIDO,
+                       content_type='application/xml').status_code == 201
+    with client.get('/api/leituras', buffered=False) as response:
+        assert response.is_streamed
+        assert response.content_type == 'application/json'
+        assert response.json[0]['leituras'][1]['valor'] == 6.0
+
+
+def test_compressao_negociada(client):
+    # respostas grandes vêm comprimidas conforme o Accept-Encoding;
+    # respostas pequenas e clientes que recusam gzip recebem texto simples
+    import gzip
+
+    assert client.post('/api/leituras', data=XML_VALIDO,
+                       content_type='application/xml').status_code == 201
+
+    # stream (lista de leituras): o início é lido até ao tamanho mínimo
+    # antes de decidir; um stream pequeno vai sem compressão
+    response = client.get('/api/leituras', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.json[0]['estufa_id'] == 'E01'
+    response = client.get('/api/alertas?limite=1&estufa=E99', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.json == []
+
+    app.config['COMPRESSAO_TAMANHO_MINIMO'] = 100
+    try:
+        response = client.get('/api/leituras', headers={'Accept-Encoding': 'gzip'})
+    finally:
+        app.config['COMPRESSAO_TAMANHO_MINIMO'] = 1024
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert json.loads(gzip.decompress(response.data))[0]['estufa_id'] == 'E01'
+
+    # resposta pequena (abaixo do tamanho mínimo) vai sem compressão
+    response = client.get('/api/configuracoes', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.json == REGRAS_TESTE
+
+    # o cliente recusa gzip explicitamente
+    response = client.get('/api/leituras', headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 'Content-Encoding' not in response.headers
+
+    # CSV acima do tamanho mínimo configurado
+    app.config['COMPRESSAO_TAMANHO_MINIMO'] = 10
+    try:
+        response = client.get('/api/exportar?formato=csv', headers={'Accept-Encoding': 'gzip'})
+    finally:
+        app.config['COMPRESSAO_TAMANHO_MINIMO'] = 1024
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert "E01;L01" in gzip.decompress(response.data).decode('utf-8')
+
+
+DOCUMENTO_BINARIO = {
+    "estufa_id": "E02",
+    "sensores": {"S01": "temperatura", "S02": "ph"},
+    "unidades": {"S01": "°C", "S02": "pH"},
+    "leituras": [("B01", "2025-11-10T14:30:00", "S01", 22.5),
+                 ("B02", "2025-11-10T14:31:00.250000+01:00", "S02", 3.0)],
+    "limites": {"ph": {"min": 4.5, "max": 6.5}}
+}
+
+
+def test_post_leitura_binaria(client):
+    # o binário é validado, avaliado pelas regras e guardado como XML
+    from backend.app import formato_binario
+
+    dados = formato_binario.codificar(DOCUMENTO_BINARIO)
+    assert formato_binario.decodificar(dados) == DOCUMENTO_BINARIO
+
+    response = client.post('/api/leituras', data=dados,
+                           content_type=formato_binario.CONTENT_TYPE)
+    assert response.status_code == 201
+
+    # o ficheiro guardado é um XML válido no xsd, com os mesmos dados
+    caminho = os.path.join(service_xml.diretorio_dados(), "B01.xml")
+    with open(caminho, encoding='utf-8') as f:
+        service_xml.validar_xsd(f.read())
+
+    leituras = client.get('/api/leituras').json[0]['leituras']
+    assert [(l['id'], l['dataHora'], l['valor']) for l in leituras] == [
+        ('B01', '2025-11-10T14:30:00', 22.5),
+        ('B02', '2025-11-10T14:31:00.250000+01:00', 3.0)]
+
+    # o limite do bloco <configuracoes> foi guardado e é usado nos alertas
+    alertas = client.get('/api/alertas').json
+    assert [(a['leitura_id'], a['faixa_ideal']) for a in alertas] == [('B02', '4.5 - 6.5')]
+
+    # duplicado continua a dar 409
+    response = client.post('/api/leituras', data=dados,
+                           content_type=formato_binario.CONTENT_TYPE)
+    assert response.status_code == 409
+
+
+def test_post_leitura_binaria_invalida(client):
+    from backend.app import formato_binario
+
+    dados = formato_binario.codificar(DOCUMENTO_BINARIO)
+    sem_leituras = dict(DOCUMENTO_BINARIO, leituras=[])
+    valor_nan = dict(DOCUMENTO_BINARIO, leituras=[("B01", "2025-11-10T14:30:00", "S01", float('nan'))])
+    controlo = dict(DOCUMENTO_BINARIO, estufa_id="E01\x01")
+    fuso = dict(DOCUMENTO_BINARIO, leituras=[("B01", "2025-11-10T14:30:00+20:00", "S01", 22.5)])
+
+    for invalido in (b"XXXX" + dados[4:], dados[:-3], dados + b"\0",
+                     formato_binario.codificar(sem_leituras),
+                     formato_binario.codificar(valor_nan),
+                     formato_binario.codificar(controlo),
+                     formato_binario.codificar(fuso)):
+        response = client.post('/api/leituras', data=invalido,
+                               content_type=formato_binario.CONTENT_TYPE)
+        assert response.status_code == 400
+        assert "esquema" in response.json['error']['description']
+
+    assert not os.path.exists(os.path.join(service_xml.diretorio_dados(), "B01.xml"))
+
+
+def test_get_estado_atual(client):
+    # testa o GET /api/estado-atual: última leitura por sensor, status
+    # pelas regras atuais e estatísticas das leituras mais recentes
+    assert client.post('/api/leituras', data=XML_VALIDO,
+                       content_type='application/xml').status_code == 201
+    xml = XML_INVALIDO_REGRAS.replace("2025-11-10T14:31:00", "2025-11-10T15:31:00")
+    assert client.post('/api/leituras', data=xml,
+                       content_type='application/xml').status_code == 201
+
+    response = client.get('/api/estado-atual')
+    assert response.status_code == 200
+    assert len(response.json) == 1
+    estufa = response.json[0]
+    assert estufa['estufa_id'] == 'E01'
+
+    ph, temperatura = estufa['sensores'][1], estufa['sensores'][0]
+    assert ph['sensor_id'] == 'S02'
+    assert ph['ultima_leitura'] == {"id": "L04", "dataHora": "2025-11-10T15:31:00", "valor": 3.0}
+    assert ph['status'] == 'alerta'
+    assert ph['estatisticas'] == {"total_leituras": 2, "janela": 2, "media": 4.5,
+                                  "minimo": 3.0, "maximo": 6.0}
+    # duas leituras com o mesmo dataHora: fica a última recebida
+    assert temperatura['ultima_leitura']['id'] == 'L03'
+    assert temperatura['status'] == 'ok'
+
+    # o status segue as regras atuais, sem novo POST
+    regras = dict(REGRAS_TESTE, ph={"min": 2.0, "max": 4.0})
+    assert client.put('/api/configuracoes', json=regras).status_code == 200
+    assert client.get('/api/estado-atual').json[0]['sensores'][1]['status'] == 'ok'
+
+    assert client.delete('/api/leituras').status_code == 200
+    assert client.get('/api/estado-atual').json == []
+
+
+def _gravar_como_outro_processo(ficheiro, xml):
+    # o que outro processo no mesmo DATA_DIR faz: XML na geração + manifesto
+    diretorio = service_xml.diretorio_dados()
+    with open(os.path.join(diretorio, ficheiro), "w", encoding="utf-8") as f:
+        f.write(xml)
+    service_xml.GERACOES.registar(diretorio, ficheiro)
+
+
+def test_vistas_alcancam_gravacoes_de_outro_processo(client, monkeypatch):
+    # gravações de outro processo entram pelo fim do manifesto, sem reler
+    # o histórico (nem no GET, nem na gravação seguinte deste processo)
+    assert client.post('/api/leituras', data=XML_VALIDO, content_type='application/xml').status_code == 201
+    assert client.get('/api/estado-atual').status_code == 200
+    assert client.get('/api/alertas').status_code == 200
+
+    def recarregar(*args):
+        raise AssertionError("a vista foi recarregada do disco")
+
+    monkeypatch.setattr(service_xml, "_recarregar_vista", recarregar)
+    monkeypatch.setattr(service_xml, "iniciar_reavaliacao", recarregar)
+    _gravar_como_outro_processo("L03.xml", XML_INVALIDO_REGRAS)
+
+    estado = client.get('/api/estado-atual').json
+    sensores = {s["sensor_id"]: s for s in estado[0]["sensores"]}
+    assert sensores["S02"]["ultima_leitura"]["id"] == "L04"
+    assert [a["leitura_id"] for a in client.get('/api/alertas').json] == ["L04"]
+
+    _gravar_como_outro_processo("L05.xml", XML_VALIDO.replace("L01", "L05").replace("L02", "L06"))
+    xml = XML_INVALIDO_REGRAS.replace("L03", "L07").replace("L04", "L08")
+    assert client.post('/api/leituras', data=xml, content_type='application/xml').status_code == 201
+    assert service_xml.ESTADO_ATUAL._ficheiros == {"L01.xml", "L03.xml", "L05.xml", "L07.xml"}
+    assert service_xml.ESTADO_ATUAL.sincronizado(service_xml._assinatura_dados())
+    assert [a["leitura_id"] for a in client.get('/api/alertas').json] == ["L04", "L08"]
+
+
+def test_estado_atual_com_histerese(client):
+    # com histerese, o status segue o mesmo estado dos alertas: um valor
+    # já dentro da faixa mas ainda na banda continua em alerta
+    regras = dict(REGRAS_TESTE, ph={"min": 4.0, "max": 6.0, "histerese": 0.2})
+    assert client.put('/api/configuracoes', json=regras).status_code == 200
+    xml = XML_VALIDO.replace("<valor>6.0</valor>", "<valor>6.1</valor>")
+    assert client.post('/api/leituras', data=xml, content_type='application/xml').status_code == 201
+    xml = XML_INVALIDO_REGRAS.replace("2025-11-10T14:31:00", "2025-11-10T15:31:00")
+    xml = xml.replace("<valor>3.0</valor>", "<valor>5.9</valor>")
+    assert client.post('/api/leituras', data=xml, content_type='application/xml').status_code == 201
+
+    ph = client.get('/api/estado-atual').json[0]['sensores'][1]
+    assert ph['ultima_leitura']['valor'] == 5.9
+    assert ph['status'] == 'alerta'
+    assert [a['leitura_id'] for a in client.get('/api/alertas').json] == ['L02']
+
+
+def test_reavaliacao_em_segundo_plano(client, monkeypatch):
+    # testa a reavaliação dos alertas depois de um PUT nas regras:
+    # o conjunto antigo continua a ser servido até o trabalho terminar
+    import threading
+
+    assert client.post('/api/leituras', data=XML_INVALIDO_REGRAS,
+                       content_type='application/xml').status_code == 201
+    response = client.get('/api/alertas')
+    assert [a['leitura_id'] for a in response.json] == ['L04']
+    versao_antiga = response.headers['X-Versao-Regras']
+
+    # segura o trabalho antes do 1o ficheiro
+    liberar = threading.Event()
+    carregar = service_xml._carregar_documento
+    monkeypatch.setattr(service_xml, "_carregar_documento",
+                        lambda ficheiro: liberar.wait(5) and carregar(ficheiro))
+
+    regras = dict(REGRAS_TESTE, ph={"min": 2.0, "max": 4.0})
+    response = client.put('/api/configuracoes', json=regras)
+    assert response.status_code == 200
+    assert response.json['reavaliacao']['estado'] in ("pendente", "em_curso")
+    versao_nova = response.json['reavaliacao']['versao_regras']
+    assert versao_nova != versao_antiga
+
+    # leitura que chega a meio: entra no conjunto antigo e na fila do trabalho
+    assert client.post('/api/leituras', data=XML_VALIDO,
+                       content_type='application/xml').status_code == 201
+    response = client.get('/api/alertas')
+    assert response.headers['X-Versao-Regras'] == versao_antiga
+    assert [a['leitura_id'] for a in response.json] == ['L04']
+
+    liberar.set()
+    service_xml._ALERTAS["trabalho"].aguardar(5)
+
+    progresso = client.get('/api/configuracoes/reavaliacao').json
+    assert progresso['estado'] == 'concluido'
+    assert progresso['ficheiros_processados'] == progresso['ficheiros_total'] == 2
+    assert progresso['versao_servida'] == versao_nova
+
+    # com as regras novas o pH 6.0 (L02) é que está fora da faixa
+    response = client.get('/api/alertas')
+    assert response.headers['X-Versao-Regras'] == versao_nova
+    assert [a['leitura_id'] for a in response.json] == ['L02']
+
+
+def test_reavaliacao_retoma_checkpoint(client):
+    # um trabalho interrompido continua do último lote gravado, também
+    # noutro processo (o checkpoint de um processo que terminou é adotado)
+    import subprocess
+    from backend.app.alertas import TrabalhoReavaliacao
+    from backend.config.settings import NO_ID
+
+    for xml in (XML_VALIDO, XML_INVALIDO_REGRAS):
+        assert client.post('/api/leituras', data=xml,
+                           content_type='application/xml').status_code == 201
+    tabela, versao = service_xml._regras_compiladas()
+    snapshot = service_xml.abrir_snapshot()
+    snapshot.libertar()
+    ficheiros = snapshot.ficheiros
+    geracao = os.path.basename(snapshot.diretorio)
+    terminado = subprocess.Popen(["true"])
+    terminado.wait()
+    prefixo = f"{service_xml._PREFIXO_CHECKPOINT}-{geracao}-{versao}.{NO_ID}"
+    caminho = f"{prefixo}.{terminado.pid}.jsonl"
+    outro_vivo = f"{prefixo}.{os.getppid()}.jsonl"
+    lidos = []
+
+    def carregar(ficheiro):
+        lidos.append(ficheiro)
+        return service_xml._carregar_documento(ficheiro)
+
+    # 1o lote gravado e o processo "pára"
+    trabalho = TrabalhoReavaliacao(versao, tabela, ficheiros, None, carregar, caminho, tamanho_lote=1)
+    trabalho._iniciar_checkpoint()
+    carregar(ficheiros[0])
+    trabalho.processados = 1
+    trabalho._gravar_checkpoint([])
+    with open(outro_vivo, "w") as f:
+        f.write("{}\n")  # de um processo ainda vivo: não é tocado
+
+    proprio = service_xml._checkpoint_reavaliacao(geracao, versao)
+    assert proprio == f"{prefixo}.{os.getpid()}.jsonl"
+    assert not os.path.exists(caminho) and os.path.exists(outro_vivo)
+    retomado = TrabalhoReavaliacao(versao, tabela, ficheiros, None, carregar, proprio, tamanho_lote=1)
+    assert retomado.retomar_de_checkpoint(ficheiros)
+    assert retomado.executar()
+    assert lidos == ficheiros  # cada ficheiro lido uma única vez
+    assert [a['leitura_id'] for a in retomado.resultado().listar()] == ['L04']
+    assert not os.path.exists(proprio)
+
+    # a exclusão só apaga os checkpoints deste processo (e de processos terminados)
+    with open(proprio, "w") as f:
+        f.write("{}\n")
+    assert client.delete('/api/leituras').status_code == 200
+    assert not os.path.exists(proprio) and os.path.exists(outro_vivo)
+    os.remove(outro_vivo)
+
+
+def test_reavaliacao_nao_depende_do_tamanho_do_lote():
+    # regras com estado avaliadas por ordem temporal de cada sensor, mesmo
+    # com os ficheiros baralhados: o mesmo resultado com lotes de 1 ou de 10000
+    import random
+    from backend.app.alertas import TrabalhoReavaliacao
+    from backend.app.motor_regras import TabelaRegras
+
+    tabela = TabelaRegras(dict(REGRAS_TESTE, temperatura={"min": 6, "max": 30, "histerese": 1,
+                                                          "duracao_min": 2, "taxa_max": 4}))
+    aleatorio = random.Random(7)
+    documentos = {}
+    for n in range(200):
+        estufa = f"E{n % 3}"
+        data_hora = f"2025-11-10T{10 + n // 60:02d}:{n % 60:02d}:00"
+        valor = aleatorio.choice([5.0, 20.0, 29.5, 31.0, 35.0])
+        documentos[f"L{n}.xml"] = {"estufa_id": estufa, "sensores": {"S01": "temperatura"},
+                                   "leituras": [(f"L{n}", data_hora, "S01", valor)],
+                                   "ficheiro": f"L{n}.xml"}
+    ficheiros = list(documentos)
+    aleatorio.shuffle(ficheiros)
+
+    resultados = []
+    for tamanho_lote in (1, 10_000):
+        trabalho = TrabalhoReavaliacao("v", tabela, ficheiros, None, documentos.get,
+                                       tamanho_lote=tamanho_lote)
+        assert trabalho.executar()
+        resultados.append(sorted((a["leitura_id"], a["motivo"]) for a in trabalho.resultado().listar()))
+    assert resultados[0] == resultados[1]
+    assert {motivo for _, motivo in resultados[0]} >= {"duracao", "taxa"}
+
+
+def test_get_alertas_filtros_ordem_e_cursor(client):
+    # testa os filtros, a ordem, a paginação e a contagem do GET /api/alertas
+    sensores = {"S01": "temperatura", "S02": "ph"}
+    for estufa, prefixo in (("E01", "A"), ("E02", "B")):
+        leituras = [(f"{prefixo}{i}", f"2025-11-10T1{i}:00:00", "S01" if i % 2 else "S02",
+                     40.0 if i % 2 else 9.0) for i in range(6)]
+        xml = service_xml.documento_para_xml({"estufa_id": estufa, "sensores": sensores,
+                                              "leituras": leituras})
+        assert client.post('/api/leituras', data=xml,
+                           content_type='application/xml').status_code == 201
+
+    # estufa + janela de tempo, mais recentes primeiro
+    response = client.get('/api/alertas?estufa=E01&desde=2025-11-10T12:00:00&ordem=desc')
+    assert [a['leitura_id'] for a in response.json] == ['A5', 'A4', 'A3', 'A2']
+
+    response = client.get('/api/alertas?tipo=ph&ate=2025-11-10T12:00:00')
+    assert [a['leitura_id'] for a in response.json] == ['A0', 'B0', 'A2', 'B2']
+
+    # paginação: as páginas juntas dão a lista completa, sem repetições
+    paginas, url = [], '/api/alertas?tipo=temperatura&limite=2'
+    response = client.get(url)
+    while True:
+        paginas.append([a['leitura_id'] for a in response.json])
+        cursor = response.headers.get('X-Proximo-Cursor')
+        if not cursor:
+            break
+        response = client.get(f'{url}&cursor={cursor}')
+    assert paginas[:3] == [['A1', 'B1'], ['A3', 'B3'], ['A5', 'B5']]
+    assert sum(paginas, []) == ['A1', 'B1', 'A3', 'B3', 'A5', 'B5']
+
+    # contagens
+    assert client.get('/api/alertas?contagem=tipo').json == {
+        "total": 12, "por_tipo": {"ph": 6, "temperatura": 6}}
+    assert client.get('/api/alertas?contagem=estufa&desde=2025-11-10T14:00:00').json == {
+        "total": 4, "por_estufa": {"E01": 2, "E02": 2}}
+    assert client.get('/api/alertas?contagem=total&estufa=E02&tipo=ph').json == {"total": 3}
+
+    for parametros in ('ordem=cima', 'limite=0', 'desde=ontem', 'contagem=sensor', 'cursor=xyz'):
+        assert client.get(f'/api/alertas?{parametros}').status_code == 400
+
+
+def test_delete_com_leitura_em_curso(client):
+    # o DELETE troca de geração logo; uma leitura em stream já iniciada
+    # continua a ver a geração antiga inteira, que só é apagada no fim
+    for xml in (XML_VALIDO, XML_INVALIDO_REGRAS):
+        assert client.post('/api/leituras', data=xml,
+                           content_type='application/xml').status_code == 201
+    antiga = service_xml.diretorio_dados()
+
+    stream = service_xml.iterar_dados_persistidos()
+    primeiro = next(stream)
+
+    assert client.delete('/api/leituras').json['message'].startswith("2 ficheiros")
+    assert service_xml.diretorio_dados() != antiga
+    assert client.get('/api/leituras').json == []
+    service_xml.GERACOES.aguardar_recolhas(0.2)
+    assert os.path.isdir(antiga)  # ainda em uso pelo stream
+
+    restantes = list(stream)
+    assert len([primeiro, *restantes]) == 2
+    service_xml.GERACOES.aguardar_recolhas(5)
+    assert not os.path.exists(antiga)
+
+
+def test_geracoes_leitores_de_outros_processos(tmp_path):
+    # a pasta de dados é criada ao arrancar; a recolha de uma geração
+    # espera pelos marcadores de leitura de outros processos (vivos)
+    import subprocess
+    import sys
+    from backend.app.geracoes import GeracoesDados, LEITORES
+
+    geracoes = GeracoesDados(str(tmp_path / "data"))
+    geracoes.preparar()
+    antiga = geracoes.atual()
+    with open(os.path.join(antiga, "L01.xml"), "w", encoding="utf-8") as f:
+        f.write("<estufa/>")
+    geracoes.registar(antiga, "L01.xml")
+
+    # um snapshot deste processo não muda a versão da geração
+    versao = geracoes.versao()
+    snapshot = geracoes.fixar()
+    assert geracoes.versao() == versao
+    snapshot.libertar()
+    assert os.listdir(os.path.join(antiga, LEITORES)) == []
+
+    outro = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        open(os.path.join(antiga, LEITORES, str(outro.pid)), "w").close()
+        recolha = geracoes.recolher(geracoes.trocar())
+        recolha.join(0.5)
+        assert recolha.is_alive() and os.path.isdir(antiga)
+    finally:
+        outro.kill()
+        outro.wait()
+    recolha.join(5)
+    assert not os.path.exists(antiga)
+
+
+def test_leituras_por_snapshot(client):
+    # o X-Snapshot de uma leitura permite repeti-la sobre o mesmo estado,
+    # mesmo depois de novas gravações (listagem, alertas e exportação)
+    assert client.post('/api/leituras', data=XML_INVALIDO_REGRAS,
+                       content_type='application/xml').status_code == 201
+    response = client.get('/api/leituras')
+    snapshot = response.headers['X-Snapshot']
+    geracao, quantidade = snapshot.split('.')
+    assert quantidade == '1'
+
+    xml = XML_INVALIDO_REGRAS.replace('id="L03"', 'id="L13"').replace('id="L04"', 'id="L14"')
+    assert client.post('/api/leituras', data=xml,
+                       content_type='application/xml').status_code == 201
+
+    assert client.get('/api/leituras').headers['X-Snapshot'] == f"{geracao}.2"
+    response = client.get(f'/api/leituras?snapshot={snapshot}')
+    assert [l['id'] for e in response.json for l in e['leituras']] == ['L03', 'L04']
+    assert response.headers['X-Snapshot'] == snapshot
+
+    response = client.get(f'/api/alertas?snapshot={snapshot}')
+    assert [a['leitura_id'] for a in response.json] == ['L04']
+    assert client.get(f'/api/alertas?contagem=total&snapshot={snapshot}').json == {"total": 1}
+    assert len(client.get('/api/alertas').json) == 2
+
+    response = client.get(f'/api/exportar?formato=csv&snapshot={snapshot}')
+    assert response.headers['X-Snapshot'] == snapshot
+    assert "L14" not in response.data.decode('utf-8')
+
+    response = client.get(f'/api/leituras?horas=100000&snapshot={snapshot}')
+    assert [l['id'] for e in response.json for l in e['leituras']] == ['L03', 'L04']
+
+    for invalido in ('abc', f'{geracao}.9'):
+        assert client.get(f'/api/leituras?snapshot={invalido}').status_code == 400
+
+    # depois de excluir tudo, os snapshots antigos expiram
+    assert client.delete('/api/leituras').status_code == 200
+    assert client.get(f'/api/leituras?snapshot={snapshot}').status_code == 410
+
+
+XML_AR_E_LUZ = """
+<estufa id="E01">
+    <sensores>
+        <sensor id="S01" tipo="temperatura"><unidade>°C</unidade></sensor>
+        <sensor id="S03" tipo="umidadear"><unidade>%</unidade></sensor>
+        <sensor id="S04" tipo="luminosidade"><unidade>lux</unidade></sensor>
+    </sensores>
+    <leituras>
+        <leitura id="{prefixo}1">
+            <dataHora>{data_hora}</dataHora>
+            <sensorRef ref="S01"/>
+            <valor>25.0</valor>
+        </leitura>
+        <leitura id="{prefixo}2">
+            <dataHora>{data_hora}</dataHora>
+            <sensorRef ref="S03"/>
+            <valor>70.0</valor>
+        </leitura>
+        <leitura id="{prefixo}3">
+            <dataHora>{data_hora}</dataHora>
+            <sensorRef ref="S04"/>
+            <valor>{lux}</valor>
+        </leitura>
+    </leituras>
+</estufa>
+"""
+
+
+def test_metricas_derivadas(client):
+    # VPD, ponto de orvalho e DLI são gravados como leituras e as regras
+    # aplicam-se aos tipos derivados como a qualquer outro
+    regras = dict(REGRAS_TESTE, vpd={"min": 0.4, "max": 0.9})
+    assert client.put('/api/configuracoes', json=regras).status_code == 200
+
+    for prefixo, data_hora, lux in (("A", "2025-11-10T10:00:00", 10000),
+                                    ("B", "2025-11-10T10:30:00", 20000),
+                                    ("C", "2025-11-11T08:00:00", 5000)):
+        xml = XML_AR_E_LUZ.format(prefixo=prefixo, data_hora=data_hora, lux=lux)
+        assert client.post('/api/leituras', data=xml,
+                           content_type='application/xml').status_code == 201
+
+    derivadas = {l['id']: l for e in client.get('/api/leituras').json for l in e['leituras']
+                 if l['tipo'] in ('vpd', 'pontoorvalho', 'dli')}
+    assert derivadas['@A1.vpd']['valor'] == pytest.approx(0.9504, abs=1e-3)
+    assert derivadas['@A1.pontoorvalho']['valor'] == pytest.approx(19.15, abs=1e-2)
+    assert derivadas['@A1.dli']['valor'] == 0
+    # (185 + 370) / 2 µmol/m²/s durante 30 minutos; no dia seguinte recomeça
+    assert derivadas['@B1.dli']['valor'] == pytest.approx(0.4995)
+    assert derivadas['@C1.dli']['valor'] == 0
+
+    alertas = client.get('/api/alertas?tipo=vpd').json
+    assert [a['leitura_id'] for a in alertas] == ['@A1.vpd', '@B1.vpd', '@C1.vpd']
+
+    # um documento repetido (409) não gera derivadas de novo
+    xml = XML_AR_E_LUZ.format(prefixo="A", data_hora="2025-11-10T10:00:00", lux=10000)
+    assert client.post('/api/leituras', data=xml, content_type='application/xml').status_code == 409
+
+    # os IDs derivados não colidem com os dos clientes: o prefixo '@' é reservado
+    xml = XML_AR_E_LUZ.format(prefixo="@A", data_hora="2025-11-10T11:00:00", lux=10000)
+    response = client.post('/api/leituras', data=xml, content_type='application/xml')
+    assert response.status_code == 400
+    assert "reservado" in response.json['error']['description']
+    xml = XML_AR_E_LUZ.format(prefixo="A1-", data_hora="2025-11-10T11:00:00", lux=10000)
+    assert client.post('/api/leituras', data=xml, content_type='application/xml').status_code == 201
+
+
+def test_metricas_derivadas_sem_recarregar_no_post(client, monkeypatch):
+    # o POST nunca volta a ler o DATA_DIR para as derivadas, e uma derivada
+    # que falha nas regras não faz falhar um pedido já confirmado
+    from backend.app.metricas_derivadas import IntegralLuzDiaria
+
+    xml = XML_AR_E_LUZ.format(prefixo="A", data_hora="2025-11-10T10:00:00", lux=10000)
+    assert client.post('/api/leituras', data=xml, content_type='application/xml').status_code == 201
+    recarga = service_xml._RECARGA_METRICAS["thread"]
+    if recarga is not None:
+        recarga.join(5)
+    assert service_xml.METRICAS_DERIVADAS.sincronizado(service_xml._assinatura_dados())
+
+    def nao_le_o_disco(*args, **kwargs):
+        raise AssertionError("DATA_DIR lido no POST")
+
+    monkeypatch.setattr(service_xml, "_iterar_documentos", nao_le_o_disco)
+    monkeypatch.setattr(service_xml, "_log_alertas_derivados", lambda derivado: 1 / 0)
+    xml = XML_AR_E_LUZ.format(prefixo="B", data_hora="2025-11-10T10:30:00", lux=20000)
+    assert client.post('/api/leituras', data=xml, content_type='application/xml').status_code == 201
+
+    # o "dia" do DLI é o do fuso configurado (UTC por omissão)
+    instante = 1762815600  # 2025-11-10T23:00:00Z
+    assert IntegralLuzDiaria().dia(instante) != IntegralLuzDiaria().dia(instante + 3600)
+    sao_paulo = IntegralLuzDiaria(fuso="America/Sao_Paulo")
+    assert sao_paulo.dia(instante) == sao_paulo.dia(instante + 3600)
+
+
+def test_admissao_limite_por_gateway(client):
+    # cada gateway tem o seu balde: o 429 chega antes de o XML ser lido
+    app.config.update(ADMISSAO_TAXA_INGESTAO=0.5, ADMISSAO_RAJADA_INGESTAO=2)
+    try:
+        for xml in (XML_VALIDO, XML_INVALIDO_REGRAS):
+            assert client.post('/api/leituras', data=xml, content_type='application/xml',
+                               headers={"X-Estufa-Id": "GW1"}).status_code == 201
+        response = client.post('/api/leituras', data="isto não é XML", content_type='application/xml',
+                               headers={"X-Estufa-Id": "GW1"})
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) >= 1
+        assert "GW1" in response.json['error']['description']
+
+        # outro gateway e as leituras não são afetados
+        assert client.post('/api/leituras', data="isto não é XML", content_type='application/xml',
+                           headers={"X-Estufa-Id": "GW2"}).status_code == 400
+        assert client.get('/api/leituras').status_code == 200
+    finally:
+        app.config.update(ADMISSAO_TAXA_INGESTAO=ADMISSAO_TAXA_INGESTAO,
+                          ADMISSAO_RAJADA_INGESTAO=ADMISSAO_RAJADA_INGESTAO)
+
+
+def test_admissao_balde_por_endereco(client):
+    # o balde é o do endereço: o X-Estufa-Id só separa os gateways atrás
+    # dele, não gasta o balde de outro endereço nem aumenta o do próprio
+    from backend.config.settings import ADMISSAO_GATEWAYS_POR_IP, ADMISSAO_LIMITES_CLASSE
+
+    def post(endereco, gateway=None):
+        return client.post('/api/leituras', data="isto não é XML", content_type='application/xml',
+                           headers={"X-Estufa-Id": gateway} if gateway else {},
+                           environ_base={"REMOTE_ADDR": endereco}).status_code
+
+    app.config.update(ADMISSAO_TAXA_INGESTAO=0.01, ADMISSAO_RAJADA_INGESTAO=1)
+    try:
+        assert [post("10.0.0.1", "GW1"), post("10.0.0.1", "GW1")] == [400, 429]
+        assert post("10.0.0.2", "GW1") == 400
+        estados = [post("10.0.0.3", f"G{i}") for i in range(ADMISSAO_GATEWAYS_POR_IP + 1)]
+        assert estados == [400] * ADMISSAO_GATEWAYS_POR_IP + [429]
+
+        # sem lugar (503) não se gasta o token
+        app.config["ADMISSAO_LIMITES_CLASSE"] = dict(ADMISSAO_LIMITES_CLASSE, ingestao=0)
+        assert post("10.0.0.4") == 503
+        app.config["ADMISSAO_LIMITES_CLASSE"] = ADMISSAO_LIMITES_CLASSE
+        assert post("10.0.0.4") == 400
+    finally:
+        app.config.update(ADMISSAO_TAXA_INGESTAO=ADMISSAO_TAXA_INGESTAO,
+                          ADMISSAO_RAJADA_INGESTAO=ADMISSAO_RAJADA_INGESTAO,
+                          ADMISSAO_LIMITES_CLASSE=ADMISSAO_LIMITES_CLASSE)
+
+    # o lugar de uma resposta em stream só é libertado quando ela fecha
+    app.config["ADMISSAO_LIMITES_CLASSE"] = {"ingestao": 1, "leitura": 1, "configuracao": 1}
+    try:
+        stream = client.get('/api/leituras', buffered=False)
+        assert stream.is_streamed
+        assert client.get('/api/leituras').status_code == 503
+        stream.close()
+        assert client.get('/api/leituras').status_code == 200
+
+        # uma resposta que não é stream liberta o lugar no after_request,
+        # mesmo que ninguém a feche
+        simples = app.test_client()
+        assert [simples.get('/api/estado-atual').status_code for _ in range(3)] == [200] * 3
+    finally:
+        app.config["ADMISSAO_LIMITES_CLASSE"] = ADMISSAO_LIMITES_CLASSE
+
+
+def test_admissao_classes_prioridade():
+    # a ingestão esgota os seus lugares sem tocar nos reservados
+    from backend.app.admissao import ClassesPrioridade
+    classes = ClassesPrioridade({"ingestao": 2, "leitura": 3, "configuracao": 4})
+    assert [classes.entrar("ingestao") for _ in range(3)] == [True, True, False]
+    assert classes.entrar("leitura")
+    assert not classes.entrar("leitura")
+    assert classes.entrar("configuracao")
+    for _ in range(3):
+        classes.sair()
+    assert classes.entrar("ingestao")
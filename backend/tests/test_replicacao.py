@@ -0,0 +1,155 @@
+# testa a replicação entre nós, com vários processos locais do backend
+# (cada um com o seu DATA_DIR e o seu registo de alterações)
+import os
+import json
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+XML = """<estufa id="{estufa}">
+    <sensores>
+        <sensor id="S01" tipo="temperatura"><unidade>°C</unidade></sensor>
+    </sensores>
+    <leituras>
+        <leitura id="{leitura_id}">
+            <dataHora>2025-11-10T14:30:00</dataHora>
+            <sensorRef ref="S01"/>
+            <valor>22.5</valor>
+        </leitura>
+    </leituras>
+</estufa>
+"""
+
+
+def _porta_livre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+SEGREDO = "segredo-de-teste"
+
+
+def _pedido(url, metodo="GET", dados=None, cabecalhos=None):
+    # devolve (status, json) sem levantar exceção nos 4xx/5xx
+    pedido = urllib.request.Request(url, data=dados, method=metodo,
+                                    headers={"Content-Type": "application/xml", **(cabecalhos or {})})
+    try:
+        with urllib.request.urlopen(pedido, timeout=5) as resposta:
+            return resposta.status, json.load(resposta)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def _esperar(condicao, timeout=15):
+    limite = time.time() + timeout
+    while time.time() < limite:
+        if condicao():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+@pytest.fixture
+def cluster(tmp_path):
+    # três nós (A, B e C), cada um num processo com a sua porta
+    nos = {no: f"http://127.0.0.1:{_porta_livre()}" for no in "ABC"}
+    processos = []
+    for no, url in nos.items():
+        os.makedirs(tmp_path / no / "data")
+        env = dict(os.environ,
+                   ESTUFA_NO_ID=no,
+                   ESTUFA_DATA_DIR=str(tmp_path / no / "data"),
+                   ESTUFA_REPLICACAO_DIR=str(tmp_path / no / "replicacao"),
+                   ESTUFA_SEGREDO_CLUSTER=SEGREDO,
+                   ESTUFA_PARES=",".join(f"{par}={u}" for par, u in nos.items() if par != no))
+        porta = url.rsplit(":", 1)[1]
+        processos.append(subprocess.Popen(
+            [sys.executable, "-c",
+             f"from backend.app.main import app; app.run(host='127.0.0.1', port={porta}, threaded=True)"],
+            cwd=RAIZ, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    def pronto(url):
+        try:
+            return _pedido(f"{url}/api/replicacao/alteracoes", cabecalhos={"X-Estufa-Cluster": SEGREDO})[0] == 200
+        except OSError:
+            return False
+
+    try:
+        assert all(_esperar(lambda: pronto(url)) for url in nos.values())
+        yield nos
+    finally:
+        for processo in processos:
+            processo.terminate()
+            processo.wait(timeout=10)
+
+
+def _ids(url):
+    return sorted(l["id"] for e in _pedido(f"{url}/api/leituras")[1] for l in e["leituras"])
+
+
+def test_leituras_replicadas_e_409_no_cluster(cluster):
+    # uma leitura gravada num nó aparece em todos
+    for i, no in enumerate("ABC"):
+        status, _ = _pedido(f"{cluster[no]}/api/leituras", "POST",
+                            XML.format(estufa="E01", leitura_id=f"R{i}").encode())
+        assert status == 201
+    assert all(_esperar(lambda url=url: _ids(url) == ["R0", "R1", "R2"]) for url in cluster.values())
+
+    # o mesmo ID noutro nó dá 409, logo na hora (sem esperar pela replicação)
+    for i in range(10):
+        leitura_id = f"D{i}"
+        assert _pedido(f"{cluster['A']}/api/leituras", "POST",
+                       XML.format(estufa="E01", leitura_id=leitura_id).encode())[0] == 201
+        status, resposta = _pedido(f"{cluster['C']}/api/leituras", "POST",
+                                   XML.format(estufa="E02", leitura_id=leitura_id).encode())
+        assert status == 409
+        assert "já existe" in resposta["error"]["description"]
+
+
+def test_replicacao_so_para_os_pares(cluster):
+    # sem o segredo do cluster, as rotas de replicação recusam o pedido
+    url = cluster["A"]
+    assert _pedido(f"{url}/api/replicacao/alteracoes")[0] == 403
+    assert _pedido(f"{url}/api/replicacao/alteracoes", cabecalhos={"X-Estufa-Cluster": "errado"})[0] == 403
+    assert _pedido(f"{url}/api/replicacao/reservas/L01?dono=x", "POST")[0] == 403
+    assert _pedido(f"{url}/api/replicacao/reservas/L01?dono=x", "DELETE")[0] == 403
+
+    # o POST recusado não reservou nada
+    assert _pedido(f"{url}/api/replicacao/reservas/L01?dono=x", "POST",
+                   cabecalhos={"X-Estufa-Cluster": SEGREDO})[0] == 201
+
+
+def test_exclusao_replicada(cluster):
+    assert _pedido(f"{cluster['A']}/api/leituras", "POST",
+                   XML.format(estufa="E01", leitura_id="X1").encode())[0] == 201
+    assert _esperar(lambda: _ids(cluster["C"]) == ["X1"])
+
+    assert _pedido(f"{cluster['C']}/api/leituras", "DELETE")[0] == 200
+    assert all(_esperar(lambda url=url: _ids(url) == []) for url in cluster.values())
+
+    # depois de excluído em todo o lado, o ID pode voltar a ser usado
+    assert _esperar(lambda: _pedido(f"{cluster['B']}/api/leituras", "POST",
+                                    XML.format(estufa="E01", leitura_id="X1").encode())[0] == 201)
+    assert all(_esperar(lambda url=url: _ids(url) == ["X1"]) for url in cluster.values())
+
+
+def test_replicacao_iniciada_uma_vez(tmp_path):
+    # criar a app várias vezes não cria mais threads de replicação
+    import threading
+    from backend.app.replicacao import Cluster
+
+    cluster = Cluster("Z", {"Y": "http://127.0.0.1:9"}, str(tmp_path), timeout=0.1)
+    for _ in range(3):
+        cluster.iniciar(lambda alteracao: None, 60)
+    assert sum(t.name == "replicacao-Z" for t in threading.enumerate()) == 1
+
+    cluster._gravar_posicoes({"Y": 3})
+    assert cluster.posicoes() == {"Y": 3}
+    assert os.listdir(tmp_path / "reservas") == [] and not list(tmp_path.glob("*.tmp"))
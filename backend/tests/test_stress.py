@@ -0,0 +1,275 @@
+# testes de carga ("stress" e "soak"): gravações, listagens, alertas,
+# exportação e exclusões em simultâneo, com threads e com processos,
+# contra o create_app(). verificam o que os testes sequenciais não apanham:
+#   - cada ID recebe exatamente um 201; os IDs repetidos (enviados de
+#     propósito por vários trabalhadores ao mesmo tempo) dão 409
+#   - nenhuma gravação confirmada (201) se perde, a não ser que um DELETE
+#     feito depois dela a tenha apagado
+#   - nenhum XML fica gravado pela metade
+# o débito e a latência são registados segundo a segundo (com a memória
+# do processo), para detetar lentidão ou crescimento de memória
+#
+# ESTUFA_STRESS_SEGUNDOS: duração de cada cenário (2 por omissão)
+# ESTUFA_STRESS_RELATORIO: pasta onde gravar as métricas de cada cenário
+# ex (soak): ESTUFA_STRESS_SEGUNDOS=600 ESTUFA_STRESS_RELATORIO=/tmp/soak python -m pytest backend/tests/test_stress.py
+#
+# o backend só é importado dentro das funções: cada processo do pool tem
+# de definir o seu DATA_DIR antes de o importar
+import glob
+import json
+import multiprocessing
+import os
+import random
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from lxml import etree
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SEGUNDOS = float(os.environ.get("ESTUFA_STRESS_SEGUNDOS", "2"))
+RELATORIO = os.environ.get("ESTUFA_STRESS_RELATORIO")
+THREADS = 8
+PROCESSOS = 3
+THREADS_POR_PROCESSO = 3
+INTERVALO_EXCLUSOES = 0.5  # segundos entre os DELETE do trabalhador 0
+
+XML = """<estufa id="E{estufa}">
+    <sensores>
+        <sensor id="S01" tipo="temperatura"><unidade>°C</unidade></sensor>
+        <sensor id="S03" tipo="umidadear"><unidade>%</unidade></sensor>
+    </sensores>
+    <leituras>
+        <leitura id="{leitura_id}">
+            <dataHora>{data_hora}</dataHora>
+            <sensorRef ref="S01"/>
+            <valor>{temperatura}</valor>
+        </leitura>
+        <leitura id="{leitura_id}-ur">
+            <dataHora>{data_hora}</dataHora>
+            <sensorRef ref="S03"/>
+            <valor>70.0</valor>
+        </leitura>
+    </leituras>
+</estufa>
+"""
+
+Registo = namedtuple("Registo", "operacao leitura_id inicio fim status memoria")
+
+
+def _memoria():
+    # pico de memória do processo (KB no Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+
+
+def _carga(client, trabalhador, fim, excluir):
+    # um trabalhador: grava IDs próprios e IDs partilhados com os outros
+    # trabalhadores (D0, D1, ... todos enviam a mesma sequência), lê e,
+    # se 'excluir', apaga tudo de tempos a tempos
+    aleatorio = random.Random(trabalhador)
+    registos = []
+    proprios = duplicados = 0
+    proxima_exclusao = time.time() + INTERVALO_EXCLUSOES
+    while time.time() < fim:
+        sorteio = aleatorio.random()
+        leitura_id = None
+        inicio = time.time()
+        if excluir and inicio >= proxima_exclusao:
+            with client.delete('/api/leituras') as resposta:
+                operacao, status = "DELETE", resposta.status_code
+            proxima_exclusao = time.time() + INTERVALO_EXCLUSOES
+        elif sorteio < 0.7:
+            if sorteio < 0.35:
+                proprios += 1
+                leitura_id = f"T{trabalhador}-{proprios}"
+            else:
+                duplicados += 1
+                leitura_id = f"D{duplicados}"
+            xml = XML.format(estufa=trabalhador % 3, leitura_id=leitura_id,
+                             data_hora=time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(inicio)),
+                             temperatura=round(aleatorio.uniform(10, 30), 1))
+            operacao = "POST"
+            with client.post('/api/leituras', data=xml, content_type='application/xml') as resposta:
+                status = resposta.status_code
+        else:
+            operacao = aleatorio.choice(["/api/leituras?horas=1", "/api/leituras?horas=1",
+                                         "/api/alertas?limite=50", "/api/alertas?contagem=tipo",
+                                         "/api/estado-atual", "/api/leituras",
+                                         "/api/exportar?formato=csv"])
+            # consome o stream e fecha a resposta (liberta o lugar da admissão)
+            with client.get(operacao) as resposta:
+                resposta.get_data()
+                status = resposta.status_code
+        registos.append(Registo(operacao, leitura_id, inicio, time.time(), status, _memoria()))
+    return registos
+
+
+def _ids_listados(client):
+    with client.get('/api/leituras') as resposta:
+        return {l["id"] for e in resposta.json for l in e["leituras"]}
+
+
+# --- processos (cada um com a sua instância da aplicação) ---
+
+_APP = None
+
+
+def _iniciar_processo(data_dir, replicacao_dir):
+    global _APP
+    os.environ["ESTUFA_DATA_DIR"] = data_dir
+    os.environ["ESTUFA_REPLICACAO_DIR"] = os.path.join(replicacao_dir, str(os.getpid()))
+    from backend.app.routes import create_app
+    _APP = create_app()
+    _APP.config['TESTING'] = True
+    _APP.config['ADMISSAO_TAXA_INGESTAO'] = None  # todos os pedidos vêm do mesmo cliente
+
+
+def _pronto(_):
+    time.sleep(0.2)
+    return os.getpid()
+
+
+def _carga_em_threads(fim, excluir):
+    with ThreadPoolExecutor(THREADS) as pool:
+        partes = pool.map(lambda t: _carga(_APP.test_client(), t, fim, excluir and t == 0), range(THREADS))
+        registos = [registo for parte in partes for registo in parte]
+    from backend.app import service_xml
+    service_xml.GERACOES.aguardar_recolhas(timeout=10)
+    return registos
+
+
+def _carga_em_processo(processo, fim, excluir):
+    with ThreadPoolExecutor(THREADS_POR_PROCESSO) as pool:
+        partes = pool.map(lambda t: _carga(_APP.test_client(), processo * THREADS_POR_PROCESSO + t,
+                                           fim, excluir and processo == 0 and t == 0),
+                          range(THREADS_POR_PROCESSO))
+        return [registo for parte in partes for registo in parte]
+
+
+def _ids_listados_em_processo(_):
+    return _ids_listados(_APP.test_client())
+
+
+# --- verificações ---
+
+def _xml_incompletos(base):
+    # XMLs que não passam no schema (gravados pela metade)
+    from backend.config.settings import XSD_PATH
+    schema = etree.XMLSchema(etree.parse(XSD_PATH))
+    incompletos = []
+    for caminho in glob.glob(os.path.join(base, "**", "*.xml"), recursive=True):
+        try:
+            if not schema.validate(etree.parse(caminho)):
+                incompletos.append(caminho)
+        except FileNotFoundError:
+            pass  # geração antiga recolhida entretanto
+        except etree.XMLSyntaxError:
+            incompletos.append(caminho)
+    return incompletos
+
+
+def _verificar(registos, ids_finais, base):
+    esperados = {"POST": (201, 409), "DELETE": (200,)}
+    inesperados = [r for r in registos if r.status not in esperados.get(r.operacao, (200,))]
+    assert not inesperados, inesperados[:10]
+
+    posts = [r for r in registos if r.operacao == "POST"]
+    exclusoes = [r for r in registos if r.operacao == "DELETE"]
+    assert any(r.status == 409 for r in posts)
+
+    # um ID só pode voltar a ter 201 se um DELETE o apagou entretanto
+    criados = {}
+    for r in sorted((r for r in posts if r.status == 201), key=lambda r: r.inicio):
+        criados.setdefault(r.leitura_id, []).append(r)
+    for leitura_id, confirmados in criados.items():
+        for anterior, seguinte in zip(confirmados, confirmados[1:]):
+            assert any(d.fim > anterior.inicio and d.inicio < seguinte.fim for d in exclusoes), leitura_id
+    if not exclusoes:
+        contagem = Counter({r.leitura_id: 0 for r in posts})
+        contagem.update(r.leitura_id for r in posts if r.status == 201)
+        assert [i for i, n in contagem.items() if n != 1] == []
+
+    # gravações perdidas: 201 sem o ficheiro no fim e sem DELETE depois
+    perdidos = [r.leitura_id for r in posts if r.status == 201 and r.leitura_id not in ids_finais
+                and not any(d.fim > r.inicio for d in exclusoes)]
+    assert perdidos == []
+
+    assert _xml_incompletos(base) == []
+
+
+def _relatorio(cenario, registos):
+    # débito, latência (ms) e memória em janelas de 1 segundo
+    inicio = min(r.inicio for r in registos)
+    janelas = {}
+    for r in registos:
+        janelas.setdefault(int(r.inicio - inicio), []).append(r)
+    linhas = []
+    for segundo in sorted(janelas):
+        janela = janelas[segundo]
+        latencias = sorted((r.fim - r.inicio) * 1000 for r in janela)
+        posts = sorted((r.fim - r.inicio) * 1000 for r in janela if r.operacao == "POST")
+        memoria = [r.memoria for r in janela if r.memoria is not None]
+        linhas.append({
+            "segundo": segundo,
+            "pedidos": len(janela),
+            "p50_ms": round(latencias[len(latencias) // 2], 2),
+            "p95_ms": round(latencias[int(len(latencias) * 0.95)], 2),
+            "post_p95_ms": round(posts[int(len(posts) * 0.95)], 2) if posts else None,
+            "memoria_kb": max(memoria) if memoria else None,
+        })
+    print(f"\n{cenario}: {len(registos)} pedidos em {len(linhas)} s")
+    for linha in linhas:
+        print("  ", linha)
+    if RELATORIO:
+        os.makedirs(RELATORIO, exist_ok=True)
+        with open(os.path.join(RELATORIO, f"{cenario}.json"), "w", encoding="utf-8") as f:
+            json.dump(linhas, f, indent=2)
+
+    # num soak, a gravação não pode ficar muito mais lenta com o tempo
+    # (as listagens completas crescem com os dados, por isso não contam)
+    if SEGUNDOS >= 60:
+        terco = len(linhas) // 3
+        p95 = lambda parte: max(l["post_p95_ms"] or 0 for l in parte)
+        assert p95(linhas[-terco:]) <= 5 * p95(linhas[:terco]) + 50
+    return linhas
+
+
+# --- cenários ---
+
+@pytest.mark.parametrize("excluir", [False, True], ids=["sem_exclusoes", "com_exclusoes"])
+def test_carga_em_threads(tmp_path, excluir):
+    # um só processo (com o seu DATA_DIR temporário, nunca o backend/data
+    # real) e vários pedidos em threads
+    data_dir = tmp_path / "data"
+    os.makedirs(data_dir)
+    contexto = multiprocessing.get_context("spawn")
+    with contexto.Pool(1, initializer=_iniciar_processo,
+                       initargs=(str(data_dir), str(tmp_path / "replicacao"))) as pool:
+        fim = time.time() + SEGUNDOS
+        registos = pool.apply(_carga_em_threads, (fim, excluir))
+        ids_finais = pool.apply(_ids_listados_em_processo, (None,))
+
+    _verificar(registos, ids_finais, str(data_dir))
+    _relatorio(f"threads-{'com' if excluir else 'sem'}-exclusoes", registos)
+
+
+@pytest.mark.parametrize("excluir", [False, True], ids=["sem_exclusoes", "com_exclusoes"])
+def test_carga_em_processos(tmp_path, excluir):
+    # vários processos sobre o mesmo DATA_DIR (como vários workers do servidor)
+    data_dir = tmp_path / "data"
+    os.makedirs(data_dir)
+    contexto = multiprocessing.get_context("spawn")
+    with contexto.Pool(PROCESSOS, initializer=_iniciar_processo,
+                       initargs=(str(data_dir), str(tmp_path / "replicacao"))) as pool:
+        pool.map(_pronto, range(PROCESSOS), chunksize=1)
+        fim = time.time() + SEGUNDOS
+        partes = pool.starmap(_carga_em_processo, [(p, fim, excluir) for p in range(PROCESSOS)], chunksize=1)
+        ids_finais = pool.apply(_ids_listados_em_processo, (None,))
+    registos = [registo for parte in partes for registo in parte]
+
+    _verificar(registos, ids_finais, str(data_dir))
+    _relatorio(f"processos-{'com' if excluir else 'sem'}-exclusoes", registos)
@@ -333,6 +333,8 @@ async function carregarConfiguracao(form, feedback) {
         form.innerHTML = ''; 
         
         Object.keys(regras).forEach(tipoSensor => { 
+            // "estufas" guarda as regras por estufa/sensor, não é um tipo
+            if (tipoSensor === 'estufas') return;
             const regra = regras[tipoSensor];
             const fieldset = document.createElement('fieldset');
             fieldset.dataset.tipo = tipoSensor;
@@ -369,7 +371,9 @@ async function salvarConfiguracao(form, feedback) {
                 const minInput = document.getElementById(`config-${tipo}-min`);
                 const maxInput = document.getElementById(`config-${tipo}-max`);
                 if (minInput && maxInput) {
+                    // mantém as chaves extra da regra (histerese, taxa_max, duracao_min)
                     novasRegras[tipo] = { 
+                        ...(regrasDeValidacaoCache[tipo] || {}),
                         min: parseFloat(minInput.value), 
                         max: parseFloat(maxInput.value) 
                     };
@@ -379,6 +383,11 @@ async function salvarConfiguracao(form, feedback) {
             }
         }
 
+        // as regras por estufa/sensor não são editadas no form, mantém as atuais
+        if (regrasDeValidacaoCache.estufas) {
+            novasRegras.estufas = regrasDeValidacaoCache.estufas;
+        }
+
         const response = await fetch(`${API_URL}/api/configuracoes`, {
             method: 'PUT',
             headers: { 'Content-Type': 'application/json' },